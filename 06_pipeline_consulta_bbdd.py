@@ -1,27 +1,49 @@
-import requests
 import logging
 import os
-import psycopg2
-import aiohttp
-import asyncio
-from typing import List, Union, Generator, Iterator
-from pydantic import BaseModel
+import sys
 import json
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nucleo.etapas import (PipelineEtapas, Contexto, obtener_esquema, seguimiento, responder_catalogo,
+                           consultar_por_fuente, aplicar_plantilla, buscar_en_cache, generar_sql, validar_sql, ejecutar_sql, sin_resultados,
+                           guardar_aprendizaje, resumir_resultados, redactar_respuesta)
+from nucleo.esquema import LEYENDA_ESQUEMA, codificar_esquema
+from nucleo.recursos import ValvesBase
+from nucleo.texto import estimar_tokens
 
 logging.basicConfig(level=logging.DEBUG)
 
-class Pipeline:
-    class Valves(BaseModel):
-        DB_HOST: str
-        DB_PORT: str
-        DB_USER: str
-        DB_PASSWORD: str
-        DB_DATABASE: str
+# Ejemplos fijos que se usan cuando la caché semántica no tiene vecinos parecidos
+EJEMPLOS_POR_DEFECTO = [
+    ("¿Cuántos nacimientos hubieron en Aragón en 2023 según el ine?",
+     "SELECT COUNT(*) FROM ine_1_3_nacimientos;"),
+    ("¿Cuántos nacimientos de hombres hubieron en 2023 según el ine?",
+     "SELECT valor\nFROM ine_1_3_nacimientos \nWHERE sexo = 'hombres' AND periodo = 2023;"),
+]
+
+
+class Pipeline(PipelineEtapas):
+    class Valves(ValvesBase):
+        SEMANTIC_CACHE_PATH: str
+        SEMANTIC_CACHE_THRESHOLD: float  # Similitud mínima para reutilizar el SQL sin llamar al LLM
+        FEW_SHOT_THRESHOLD: float  # Similitud mínima para usar un par como ejemplo en el prompt
+        FEW_SHOT_EXAMPLES: int
+        SNAPSHOT_TABLES: List[str]  # Patrones de tablas a servir en local, p. ej. ine_*
+        SNAPSHOT_DIR: str
+        SNAPSHOT_REFRESH_SECONDS: int
+        PROFILE_PATH: str  # Perfiles de valores por columna calculados en segundo plano
+        PROFILE_REFRESH_SECONDS: int
+        PROFILE_MAX_DISTINCT: int  # Columnas con hasta estos valores distintos se listan enteras
+        PROFILE_TABLES_IN_PROMPT: int  # Tablas cuyos perfiles se incluyen en el prompt
+        DECOMPOSE_SOURCES: bool  # Una subconsulta por fuente si la pregunta compara varias
+        SOURCE_PREFIXES: List[str]  # Prefijos de tabla de cada fuente
+        SCHEMA_FORMAT: str  # compacto (tipo DDL, agrupado por columnas y prefijo) o json
 
     def __init__(self):
         self.name = "Consulta a Base de Datos"
-        self.conn = None
-        self.nlsql_response = ""
+        self.model = "llama3"  # Modelo que estás usando
 
         self.valves = self.Valves(
             **{
@@ -30,130 +52,132 @@ class Pipeline:
                 "DB_USER": os.getenv("PG_USER", "XXXXX"),
                 "DB_PASSWORD": os.getenv("PG_PASSWORD", "XXXXX"),
                 "DB_DATABASE": os.getenv("PG_DB", "XXXXX"),
+                "SEMANTIC_CACHE_PATH": os.getenv("SEMANTIC_CACHE_PATH", "cache_semantica_sql.json"),
+                "SEMANTIC_CACHE_THRESHOLD": os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.8),
+                "FEW_SHOT_THRESHOLD": os.getenv("FEW_SHOT_THRESHOLD", 0.45),
+                "FEW_SHOT_EXAMPLES": os.getenv("FEW_SHOT_EXAMPLES", 3),
+                "SNAPSHOT_TABLES": [t for t in os.getenv("SNAPSHOT_TABLES", "").split(",") if t],
+                "SNAPSHOT_DIR": os.getenv("SNAPSHOT_DIR", "instantaneas"),
+                "SNAPSHOT_REFRESH_SECONDS": os.getenv("SNAPSHOT_REFRESH_SECONDS", 600),
+                "PROFILE_PATH": os.getenv("PROFILE_PATH", "perfiles_columnas.json"),
+                "PROFILE_REFRESH_SECONDS": os.getenv("PROFILE_REFRESH_SECONDS", 600),
+                "PROFILE_MAX_DISTINCT": os.getenv("PROFILE_MAX_DISTINCT", 25),
+                "PROFILE_TABLES_IN_PROMPT": os.getenv("PROFILE_TABLES_IN_PROMPT", 3),
+                "DECOMPOSE_SOURCES": os.getenv("DECOMPOSE_SOURCES", "true"),
+                "SOURCE_PREFIXES": [p for p in os.getenv("SOURCE_PREFIXES", "ine,istac").split(",") if p],
+                "SCHEMA_FORMAT": os.getenv("SCHEMA_FORMAT", "compacto"),
             }
         )
 
-        self.url = "http://host.docker.internal:11434/v1/chat/completions"  # API de Ollama
-        self.headers = {"Content-Type": "application/json"}
-        self.model = "llama3"  # Modelo que estás usando
+        # Camino de una pregunta hasta tener su resultado; las que comparan fuentes lo recorren una vez por fuente
+        resolver_sql = [
+            aplicar_plantilla,
+            buscar_en_cache,
+            generar_sql(self.sql_prompt, temperatura=0.3),
+            validar_sql,
+            ejecutar_sql,
+        ]
+        self.etapas = [
+            seguimiento,
+            responder_catalogo,
+            consultar_por_fuente(resolver_sql + [guardar_aprendizaje]),
+            *resolver_sql,
+            sin_resultados("No hay resultados para tu consulta."),
+            guardar_aprendizaje,
+            resumir_resultados,
+            redactar_respuesta(self.response_prompt, temperatura=0.7),
+        ]
+
+    async def on_startup(self):
+        await super().on_startup()
+        self.recursos.iniciar_instantaneas(
+            self.valves.SNAPSHOT_DIR, self.valves.SNAPSHOT_TABLES, self.valves.SNAPSHOT_REFRESH_SECONDS
+        )
+        self.recursos.iniciar_perfiles(
+            self.valves.PROFILE_PATH, self.valves.PROFILE_REFRESH_SECONDS, self.valves.PROFILE_MAX_DISTINCT
+        )
 
-    def get_db_schema(self):
-        """Obtiene la estructura de la base de datos (tablas y columnas)."""
-        schema_info = {}
-
-        try:
-            conn = psycopg2.connect(
-                database=self.valves.DB_DATABASE,
-                user=self.valves.DB_USER,
-                password=self.valves.DB_PASSWORD,
-                host=self.valves.DB_HOST.split('//')[-1],
-                port=self.valves.DB_PORT
-            )
-            cursor = conn.cursor()
-
-            # Obtener todas las tablas
-            cursor.execute("""
-                SELECT table_name, column_name
-                FROM information_schema.columns
-                WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
-                ORDER BY table_name, ordinal_position;
-            """)
-                # Organizar los datos en un diccionario {tabla: [columnas]}
-            schema = {}
-            for table, column in cursor.fetchall():
-                if table not in schema:
-                    schema[table] = []
-                schema[table].append(column)
-
-            cursor.close()
-            conn.close()
-
-            return schema
-
-        except psycopg2.Error as e:
-            logging.error(f"Error al obtener la estructura de la base de datos: {e}")
-            return {}
-
-    def generate_sql_query(self, user_message: str) -> str:
-        """Genera una consulta SQL basada en una pregunta en lenguaje natural."""
-        
-        # Obtener la estructura de la base de datos
-        db_schema = self.get_db_schema()
+    def select_examples(self, user_message: str) -> list:
+        """Elige como ejemplos los pares validados más parecidos a la pregunta."""
+        cache = self.recursos.cache_semantica(self.valves.SEMANTIC_CACHE_PATH)
+        vecinos = cache.buscar(user_message, k=self.valves.FEW_SHOT_EXAMPLES)
+        ejemplos = [(e["pregunta"], e["sql"]) for similitud, e in vecinos
+                    if similitud >= self.valves.FEW_SHOT_THRESHOLD]
+        return ejemplos or EJEMPLOS_POR_DEFECTO
+
+    def column_profiles(self, ctx: Contexto, db_schema: dict) -> str:
+        """Valores y rangos de las columnas de las tablas más relacionadas con la pregunta."""
+        perfiles = ctx.recursos.perfiles
+        if perfiles is None:
+            return ""
+        with ctx.traza.span("perfiles") as atributos:
+            tablas = perfiles.relevantes(ctx.user_message, db_schema, self.valves.PROFILE_TABLES_IN_PROMPT)
+            texto = perfiles.compacto(tablas)
+            atributos.update(tablas=len(tablas), caracteres=len(texto))
+        if not texto:
+            return ""
+        return f"""
+        **Valores de las columnas de las tablas más relacionadas con la pregunta:**
+{texto}
+"""
+
+    def schema_text(self, ctx: Contexto, db_schema: dict) -> str:
+        """Esquema para el prompt en el formato de la valve SCHEMA_FORMAT."""
+        with ctx.traza.span("codificar_esquema", formato=self.valves.SCHEMA_FORMAT) as atributos:
+            if self.valves.SCHEMA_FORMAT == "json":
+                texto = json.dumps(db_schema, indent=2)
+            else:
+                texto = LEYENDA_ESQUEMA + "\n" + codificar_esquema(db_schema)
+            atributos["tokens"] = estimar_tokens(texto)
+        return texto
 
+    def sql_prompt(self, ctx: Contexto):
+        """Prompt para generar el SQL con el esquema en memoria y ejemplos parecidos a la pregunta."""
+        db_schema = obtener_esquema(ctx)
         if not db_schema:
-            return "Error: No se pudo obtener la estructura de la base de datos."
+            ctx.error = "Error: No se pudo obtener la estructura de la base de datos."
+            return None
+
+        ejemplos = "\n\n".join(
+            f'Entrada: "{pregunta}"\nSalida:\n{json.dumps({"sql": sql}, ensure_ascii=False)}'
+            for pregunta, sql in self.select_examples(ctx.user_message)
+        )
 
         prompt = f"""
         Eres un asistente experto en bases de datos PostgreSQL. Tu tarea es generar una consulta SQL válida
         usando exclusivamente las siguientes tablas y columnas disponibles en la base de datos:
 
-        {json.dumps(db_schema, indent=2)}
-
+{self.schema_text(ctx, db_schema)}
+{self.column_profiles(ctx, db_schema)}
         **Reglas:**
-        1. Devuelve solo la consulta SQL sin explicaciones adicionales ni comentarios.
+        1. No añadas explicaciones ni comentarios: la consulta va en el campo "sql" del JSON.
         2. La consulta debe ser válida en PostgreSQL y solo puede usar tablas y columnas listadas arriba.
         3. Usa `JOIN` si la información se encuentra en múltiples tablas.
         4. No inventes nombres de tablas o columnas. Usa solo las que existen.
-        5. No devuelvas texto descriptivo, solo la consulta SQL.
-        6. Si el usuario especifica ine, tienes que buscar entre las tablas que empiezan por ine
-        7. Si el usuario especifica istac, tienes que buscar entre las tablas que empiezan por istac
-        8. Si el usuario especifica un año, tienes que buscar en la columna periodo
+        5. Si el usuario especifica ine, tienes que buscar entre las tablas que empiezan por ine
+        6. Si el usuario especifica istac, tienes que buscar entre las tablas que empiezan por istac
+        7. Si el usuario especifica un año, tienes que buscar en la columna periodo
+        8. Escribe los valores de los filtros exactamente como aparecen en los valores de las columnas (mayúsculas, tildes y tipo)
 
         **Ejemplos de entrada y salida:**
 
-        Entrada: "¿Cuántos nacimientos hubieron en Aragón en 2023 según el ine?"
-        Salida:
-        SELECT COUNT(*) FROM ine_1_3_nacimientos;
-
-        Entrada: "¿Cuántos nacimientos de hombres hubieron en 2023 según el ine?"
-        Salida:
-        SELECT valor
-        FROM ine_1_3_nacimientos 
-        WHERE sexo = 'hombres' AND periodo = 2023;
+{ejemplos}
 
         Entrada del usuario:
-        "{user_message}"
+        "{ctx.user_message}"
 
-        Salida esperada (solo consulta SQL válida):
+        Salida esperada:
         """
 
-        payload = {
-            "model": self.model,
-            "messages": [{"role": "system", "content": prompt}],
-            "temperature": 0.3
-        }
-
-        try:
-            response = requests.post(self.url, headers=self.headers, json=payload)
-            response.raise_for_status()
-
-            response_data = response.json()
-            if 'choices' in response_data and len(response_data['choices']) > 0:
-                sql_query = response_data['choices'][0]['message']['content'].strip()
-
-                # Validar que la respuesta es SQL válido
-                if not sql_query.lower().startswith(("select", "insert", "update", "delete", "with")):
-                    logging.error(f"Error: El modelo no devolvió SQL válido: {sql_query}")
-                    return "Error: El modelo no devolvió una consulta SQL válida."
-
-                return sql_query
-            else:
-                logging.error("La respuesta no contiene contenido válido.")
-                return "Error: La respuesta no contiene contenido válido."
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error al realizar la solicitud a la API de Ollama: {e}")
-            return "Error al generar la consulta SQL."
-
-
+        return prompt
 
-    def generate_natural_language_response(self, query_result: list) -> str:
-        """Convierte los resultados de la consulta en una respuesta en lenguaje natural."""
+    def response_prompt(self, ctx: Contexto) -> str:
+        """Prompt para convertir los resultados en una respuesta en lenguaje natural."""
         prompt = f"""
         Eres un asistente que transforma resultados de consultas SQL en respuestas en lenguaje natural en español.
         
-        **Resultados de la consulta:**
-        {query_result}
+        **Resultados de la consulta ({ctx.valves.RESULT_FORMAT} con cabecera):**
+{ctx.resumen}
 
         **Reglas:**
         1. Si la consulta no devuelve resultados, responde "No se encontraron datos".
@@ -164,78 +188,4 @@ class Pipeline:
         **Salida esperada:**
         """
 
-        payload = {
-            "model": self.model,
-            "messages": [{"role": "system", "content": prompt}],
-            "temperature": 0.7
-        }
-
-        try:
-            response = requests.post(self.url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            response_data = response.json()
-
-            if 'choices' in response_data and len(response_data['choices']) > 0:
-                return response_data['choices'][0]['message']['content'].strip()
-            else:
-                return "Error: La respuesta no contiene contenido válido."
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error al generar la respuesta en lenguaje natural: {e}")
-            return "Error al generar la respuesta."
-        
-    def execute_query(self, sql_query: str):
-        """Ejecuta una consulta SQL en la base de datos PostgreSQL y devuelve los resultados."""
-        try:
-            # Establecer conexión con la base de datos
-            conn = psycopg2.connect(
-                database=self.valves.DB_DATABASE,
-                user=self.valves.DB_USER,
-                password=self.valves.DB_PASSWORD,
-                host=self.valves.DB_HOST.split('//')[-1],
-                port=self.valves.DB_PORT
-            )
-            cursor = conn.cursor()
-
-            # Ejecutar la consulta
-            cursor.execute(sql_query)
-
-            # Obtener los resultados
-            results = cursor.fetchall()
-
-            # Cerrar conexión
-            cursor.close()
-            conn.close()
-
-            return results
-
-        except psycopg2.Error as e:
-            logging.error(f"Error al ejecutar la consulta SQL: {e}")
-            return f"Error en la ejecución de la consulta SQL: {e}"
-
-
-    def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
-        try:
-            sql_query = self.generate_sql_query(user_message)
-
-            # Validar que se generó una consulta SQL válida
-            if sql_query.startswith("Error"):
-                return sql_query
-
-            # Ejecutar la consulta en PostgreSQL
-            results = self.execute_query(sql_query)
-
-            # Si no hay resultados, devolver un mensaje apropiado
-            if not results:
-                return "No hay resultados para tu consulta."
-
-            # Convertir los resultados en una respuesta en lenguaje natural
-            respuesta = self.generate_natural_language_response(results)
-
-            return respuesta
-
-        except Exception as e:
-            logging.error(f"Error en el proceso: {e}")
-            return f"Error en el proceso: {e}"
-
-
+        return prompt
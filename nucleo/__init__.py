@@ -0,0 +1,9 @@
+"""Núcleo compartido por las pipelines: recursos del proceso y motor de etapas.
+
+Es un paquete (directorio) para que el cargador de pipelines, que solo lee los .py del
+directorio raíz, no lo trate como una pipeline más.
+"""
+from nucleo.etapas import Contexto, PipelineEtapas, ejecutar_etapas
+from nucleo.recursos import Recursos, ValvesBase
+
+__all__ = ["Contexto", "PipelineEtapas", "Recursos", "ValvesBase", "ejecutar_etapas"]
@@ -0,0 +1,270 @@
+"""Acceso a PostgreSQL compartido: pool de conexiones, réplicas de lectura y catálogo de tablas."""
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+# Retraso de una réplica en segundos: 0 si ya ha aplicado todo lo recibido del primario
+CONSULTA_RETRASO = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+ESCRITURA = re.compile(r"\b(insert|update|delete|merge|truncate|create|drop|alter|grant|revoke|copy|into|call|"
+                       r"lock|vacuum|analyze|refresh|nextval|setval)\b", re.IGNORECASE)
+
+
+def es_solo_lectura(sql: str) -> bool:
+    """SELECT o WITH sin nada que escriba (los literales no cuentan)."""
+    sin_literales = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    return sin_literales.lstrip().lower().startswith(("select", "with")) and not ESCRITURA.search(sin_literales)
+
+
+class Replica:
+    """Una réplica de lectura con su pool y el último estado comprobado."""
+
+    def __init__(self, direccion: str):
+        host, _, puerto = direccion.split("//")[-1].partition(":")
+        self.nombre = direccion
+        self.host = host
+        self.puerto = puerto or None
+        self.pool = None
+        self.huecos = None
+        self.sana = False  # Hasta la primera comprobación no se usa
+        self.retraso = None
+        self.en_uso = 0
+
+
+class BaseDatos:
+    """Pool de conexiones y catálogo en memoria que comparten todas las pipelines del proceso.
+
+    Con réplicas, las lecturas (catálogo y consultas de solo lectura) van a la réplica sana
+    con menos retraso y menos conexiones en uso; si ninguna está sana y al día, o la elegida
+    falla, se leen del primario.
+    """
+
+    def __init__(self, params: dict, max_conexiones: int = 8, ttl_esquema: int = 300,
+                 replicas: List[str] = None, max_retraso: float = 30.0, espera_conexion: float = 30.0):
+        self.params = dict(params, client_encoding="UTF8")
+        self.max_conexiones = max_conexiones
+        self.espera_conexion = espera_conexion
+        # El pool lanza PoolError si se le pide una conexión más de las que tiene; antes de
+        # pedirla se espera un hueco aquí
+        self.huecos = threading.BoundedSemaphore(max_conexiones)
+        self.ttl_esquema = ttl_esquema
+        self.pool = None
+        self.replicas = [Replica(r) for r in replicas or []]
+        self.max_retraso = max_retraso
+        self.esquema = None
+        self.esquema_instante = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def desde_entorno(cls, **opciones) -> "BaseDatos":
+        """Conexión con las variables PG_* que usan las pipelines, para las herramientas de línea de comandos."""
+        return cls({
+            "database": os.getenv("PG_DB"),
+            "user": os.getenv("PG_USER"),
+            "password": os.getenv("PG_PASSWORD"),
+            "host": os.getenv("PG_HOST", "").split("//")[-1],
+            "port": os.getenv("PG_PORT"),
+        }, **opciones)
+
+    def conectar(self):
+        """Conexión dedicada, fuera del pool (COPY largos, instantáneas)."""
+        return psycopg2.connect(**self.params)
+
+    @contextmanager
+    def conexion(self):
+        """Presta una conexión del pool y la devuelve limpia al terminar."""
+        with self.lock:
+            if self.pool is None:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.max_conexiones, **self.params)
+        with self._prestar(self.pool, self.huecos) as conn:
+            yield conn
+
+    @contextmanager
+    def _prestar(self, pool, huecos: threading.BoundedSemaphore):
+        """Espera como mucho espera_conexion segundos a que el pool tenga una conexión libre."""
+        if not huecos.acquire(timeout=self.espera_conexion):
+            raise psycopg2.pool.PoolError(
+                f"Error: no hay conexiones libres con la base de datos tras {self.espera_conexion:g} s")
+        try:
+            conn = pool.getconn()
+            try:
+                yield conn
+            finally:
+                rota = bool(conn.closed)
+                if not rota:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        rota = True
+                pool.putconn(conn, close=rota)
+        finally:
+            huecos.release()
+
+    def _params_replica(self, replica: Replica) -> dict:
+        params = dict(self.params, host=replica.host)
+        if replica.puerto:
+            params["port"] = replica.puerto
+        return params
+
+    def elegir_replica(self):
+        """La réplica sana y al día con menos retraso; a igual retraso (al segundo), la menos ocupada."""
+        with self.lock:
+            candidatas = [r for r in self.replicas
+                          if r.sana and r.retraso is not None and r.retraso <= self.max_retraso]
+            if not candidatas:
+                return None
+            replica = min(candidatas, key=lambda r: (int(r.retraso), r.en_uso))
+            replica.en_uso += 1
+            if replica.pool is None:
+                replica.pool = psycopg2.pool.ThreadedConnectionPool(0, self.max_conexiones,
+                                                                    **self._params_replica(replica))
+                replica.huecos = threading.BoundedSemaphore(self.max_conexiones)
+            return replica
+
+    def leer(self, funcion: Callable):
+        """Ejecuta funcion(conn) en una réplica si hay alguna disponible, si no en el primario.
+
+        Si la réplica falla (conexión caída, conflicto con la recuperación) se marca como no
+        sana y la lectura se repite en el primario. Una cancelación no se repite.
+        """
+        replica = self.elegir_replica()
+        if replica is not None:
+            try:
+                with self._prestar(replica.pool, replica.huecos) as conn:
+                    return funcion(conn)
+            except psycopg2.extensions.QueryCanceledError:
+                raise
+            except (psycopg2.OperationalError, psycopg2.extensions.TransactionRollbackError) as e:
+                logging.warning(f"La réplica {replica.nombre} falló ({str(e).strip()}); se lee del primario")
+                if isinstance(e, psycopg2.OperationalError):
+                    with self.lock:
+                        replica.sana = False
+            finally:
+                with self.lock:
+                    replica.en_uso -= 1
+        with self.conexion() as conn:
+            return funcion(conn)
+
+    def comprobar_replicas(self):
+        """Mide la salud y el retraso de cada réplica con una conexión aparte."""
+        for replica in self.replicas:
+            try:
+                conn = psycopg2.connect(connect_timeout=3, **self._params_replica(replica))
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute(CONSULTA_RETRASO)
+                    retraso = cursor.fetchone()[0]
+                    cursor.close()
+                finally:
+                    conn.close()
+                # pg_is_in_recovery() falso: no es una réplica (p. ej. tras una promoción)
+                sana, retraso = retraso is not None, float(retraso) if retraso is not None else None
+            except psycopg2.Error as e:
+                logging.debug(f"No se pudo comprobar la réplica {replica.nombre}: {e}")
+                sana, retraso = False, None
+            with self.lock:
+                if sana != replica.sana:
+                    logging.info(f"Réplica {replica.nombre}: {'disponible' if sana else 'no disponible'}")
+                replica.sana, replica.retraso = sana, retraso
+                if retraso is not None and retraso > self.max_retraso:
+                    logging.info(f"Réplica {replica.nombre} con {retraso:.0f} s de retraso; se lee del primario")
+
+    def estado_replicas(self) -> list:
+        with self.lock:
+            return [{"replica": r.nombre, "sana": r.sana, "retraso": r.retraso, "en_uso": r.en_uso}
+                    for r in self.replicas]
+
+    def cerrar(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+            for replica in self.replicas:
+                if replica.pool is not None:
+                    replica.pool.closeall()
+                    replica.pool = None
+
+    def get_db_schema(self) -> dict:
+        """Obtiene la estructura de la base de datos (tablas y columnas)."""
+        def leer_esquema(conn):
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT table_name, column_name
+                FROM information_schema.columns
+                WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
+                ORDER BY table_name, ordinal_position;
+            """)
+            # Organizar los datos en un diccionario {tabla: [columnas]}
+            schema = {}
+            for table, column in cursor.fetchall():
+                schema.setdefault(table, []).append(column)
+            cursor.close()
+            return schema
+
+        try:
+            return self.leer(leer_esquema)
+
+        except psycopg2.Error as e:
+            logging.error(f"Error al obtener la estructura de la base de datos: {e}")
+            return {}
+
+    def cached_schema(self) -> dict:
+        """Esquema en memoria; se vuelve a leer de la base de datos cada ttl_esquema segundos."""
+        if self.esquema is None or time.monotonic() - self.esquema_instante > self.ttl_esquema:
+            esquema = self.get_db_schema()
+            if esquema:
+                self.esquema, self.esquema_instante = esquema, time.monotonic()
+            return esquema or self.esquema or {}
+        return self.esquema
+
+    def list_tables(self, terminos: List[str]) -> list:
+        """Tablas (esquema, nombre) cuyo nombre contiene todos los términos."""
+        condiciones = "".join(" AND table_name ILIKE %s" for _ in terminos)
+
+        def leer_tablas(conn):
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT table_schema, table_name
+                FROM information_schema.tables
+                WHERE table_type = 'BASE TABLE'
+                AND table_schema NOT IN ('information_schema', 'pg_catalog'){condiciones}
+                ORDER BY table_name;
+            """, [f"%{t}%" for t in terminos])
+            tablas = cursor.fetchall()
+            cursor.close()
+            return tablas
+
+        return self.leer(leer_tablas)
+
+    def list_columns(self, terminos: List[str]) -> list:
+        """Columnas (tabla, columna, tipo) de las tablas cuyo nombre contiene todos los términos."""
+        condiciones = "".join(" AND table_name ILIKE %s" for _ in terminos)
+
+        def leer_columnas(conn):
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT table_name, column_name, data_type
+                FROM information_schema.columns
+                WHERE table_schema NOT IN ('information_schema', 'pg_catalog'){condiciones}
+                ORDER BY table_name, ordinal_position;
+            """, [f"%{t}%" for t in terminos])
+            columnas = cursor.fetchall()
+            cursor.close()
+            return columnas
+
+        return self.leer(leer_columnas)
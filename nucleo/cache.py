@@ -0,0 +1,139 @@
+"""Caché semántica de pares pregunta→SQL validados."""
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from nucleo.texto import normalizar_texto
+
+
+# Formas equivalentes que se reducen a una sola antes de comparar preguntas
+SINONIMOS = {
+    "varones": "hombres", "varon": "hombres", "hombre": "hombres", "masculino": "hombres", "masculinos": "hombres",
+    "mujer": "mujeres", "hembras": "mujeres", "femenino": "mujeres", "femeninos": "mujeres",
+    "nacidos": "nacimientos", "nacimiento": "nacimientos", "nacieron": "nacimientos",
+    "fallecimientos": "defunciones", "fallecidos": "defunciones", "muertes": "defunciones", "defuncion": "defunciones",
+    "murieron": "defunciones", "fallecieron": "defunciones",
+    "turista": "turistas", "visitantes": "turistas", "desempleo": "paro", "parados": "paro",
+    "habitantes": "poblacion", "ocupados": "empleo",
+}
+SEXOS = {"hombres", "mujeres"}
+REGIONES = {
+    "canarias", "lanzarote", "fuerteventura", "gran canaria", "tenerife", "la gomera", "el hierro", "la palma",
+    "espana", "andalucia", "aragon", "asturias", "baleares", "cantabria", "castilla y leon", "castilla la mancha",
+    "cataluna", "valencia", "comunidad valenciana", "extremadura", "galicia", "madrid", "murcia", "navarra",
+    "pais vasco", "la rioja", "ceuta", "melilla",
+}
+MEDIDAS = {
+    "nacimientos", "defunciones", "matrimonios", "turistas", "pernoctaciones", "paro", "empleo", "poblacion",
+    "ipc", "precios", "salarios", "hogares", "viviendas",
+}
+# Palabras que no distinguen una pregunta de otra y solo restan similitud
+VACIAS = {
+    "el", "la", "los", "las", "de", "del", "en", "y", "a", "al", "por", "para", "que", "con", "un", "una",
+    "cuantos", "cuantas", "cual", "cuales", "hubo", "hay", "dame", "dime", "segun", "datos", "numero",
+    # Verbos de relleno: "cuántos hubieron", "que se registraron", "quiero saber"
+    "hubieron", "habia", "habian", "fue", "fueron", "es", "son", "se", "registraron", "registrados",
+    "registradas", "tuvo", "tuvieron", "quiero", "saber", "muestra", "muestrame",
+}
+
+
+def canonica(texto: str) -> str:
+    """Texto normalizado con los sinónimos reducidos a una sola forma: varones → hombres."""
+    return " ".join(SINONIMOS.get(p, p) for p in normalizar_texto(texto).split())
+
+
+class CacheSemantica:
+    """Índice local de pares pregunta→SQL validados, buscado por similitud coseno.
+
+    Los embeddings son vectores de n-gramas de caracteres proyectados con hashing,
+    de modo que no hace falta ningún modelo ni conexión externa.
+    """
+
+    def __init__(self, ruta: str, dimension: int = 1024):
+        self.ruta = ruta
+        self.dimension = dimension
+        self.entradas = []
+        self.matriz = np.zeros((0, dimension), dtype=np.float32)
+        self.lock = threading.Lock()
+        self.cargar()
+
+    def embedding(self, texto: str) -> np.ndarray:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for palabra in canonica(texto).split():
+            if palabra in VACIAS:
+                continue
+            vector[zlib.crc32(palabra.encode()) % self.dimension] += 2.0
+            marcada = f" {palabra} "
+            for i in range(len(marcada) - 2):
+                vector[zlib.crc32(marcada[i:i + 3].encode()) % self.dimension] += 1.0
+        norma = np.linalg.norm(vector)
+        return vector / norma if norma else vector
+
+    @staticmethod
+    def firma(texto: str) -> tuple:
+        """Números, fuentes, sexo, región o isla y medida citados en la pregunta.
+
+        Deben coincidir todos para reutilizar el SQL: "nacimientos de mujeres" y "nacimientos
+        de hombres" se parecen mucho pero no comparten consulta.
+        """
+        texto = canonica(texto)
+        palabras = texto.split()
+        numeros = sorted(p for p in palabras if p.isdigit())
+        fuentes = sorted({p for p in palabras if p in ("ine", "istac")})
+        sexos = sorted({p for p in palabras if p in SEXOS})
+        regiones = sorted(r for r in REGIONES if re.search(rf"\b{r}\b", texto))
+        medidas = sorted({p for p in palabras if p in MEDIDAS})
+        return tuple(numeros), tuple(fuentes), tuple(sexos), tuple(regiones), tuple(medidas)
+
+    def buscar(self, pregunta: str, k: int = 3) -> list:
+        """Devuelve hasta k tuplas (similitud, entrada) ordenadas de mayor a menor."""
+        with self.lock:
+            if not self.entradas:
+                return []
+            similitudes = self.matriz @ self.embedding(pregunta)
+            indices = np.argsort(-similitudes)[:k]
+            return [(float(similitudes[i]), self.entradas[i]) for i in indices]
+
+    def reutilizable(self, pregunta: str, umbral: float):
+        """Devuelve el SQL almacenado si existe una pregunta casi idéntica con la misma firma."""
+        for similitud, entrada in self.buscar(pregunta, k=3):
+            if similitud >= umbral and self.firma(entrada["pregunta"]) == self.firma(pregunta):
+                return entrada["sql"]
+        return None
+
+    def agregar(self, pregunta: str, sql_query: str):
+        vector = self.embedding(pregunta)
+        with self.lock:
+            if len(self.entradas) and float(np.max(self.matriz @ vector)) > 0.999:
+                return
+            self.entradas.append({"pregunta": pregunta, "sql": sql_query})
+            self.matriz = np.vstack([self.matriz, vector[None, :]])
+            self.guardar()
+
+    def cargar(self):
+        if not os.path.exists(self.ruta):
+            return
+        try:
+            with open(self.ruta, encoding="utf-8") as f:
+                self.entradas = json.load(f)
+            self.matriz = np.array([self.embedding(e["pregunta"]) for e in self.entradas],
+                                   dtype=np.float32).reshape(-1, self.dimension)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"No se pudo cargar la caché semántica {self.ruta}: {e}")
+            self.entradas = []
+            self.matriz = np.zeros((0, self.dimension), dtype=np.float32)
+
+    def guardar(self):
+        try:
+            # Se escribe aparte y se sustituye: un corte a medias no deja la caché vacía
+            temporal = self.ruta + ".tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(self.entradas, f, ensure_ascii=False, indent=1)
+            os.replace(temporal, self.ruta)
+        except OSError as e:
+            logging.error(f"No se pudo guardar la caché semántica {self.ruta}: {e}")
@@ -0,0 +1,65 @@
+"""Cancelación de peticiones: cuando el cliente se va se corta el trabajo pendiente en Ollama y PostgreSQL."""
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable
+
+
+class Cancelado(Exception):
+    """La petición se ha cancelado (el usuario paró la generación o cerró la pestaña)."""
+
+
+class Cancelacion:
+    """Señal de cancelación de una petición con las acciones que la propagan.
+
+    Mientras dura una operación larga se registra cómo abortarla (cancelar la tarea del
+    cliente HTTP, conn.cancel() de psycopg2...). cancelar() las ejecuta todas al momento,
+    desde el hilo que detecta que el cliente se ha ido.
+    """
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.acciones = {}
+        self.siguiente = 0
+        self.lock = threading.Lock()
+
+    @property
+    def cancelada(self) -> bool:
+        return self.evento.is_set()
+
+    def cancelar(self):
+        with self.lock:
+            if self.evento.is_set():
+                return
+            self.evento.set()
+            acciones = list(self.acciones.values())
+        for accion in acciones:
+            self._ejecutar(accion)
+
+    def comprobar(self):
+        """Lanza Cancelado si la petición ya se ha cancelado."""
+        if self.evento.is_set():
+            raise Cancelado("Petición cancelada por el cliente")
+
+    @contextmanager
+    def propagar(self, accion: Callable):
+        """Durante el bloque, cancelar() llama a accion; si ya estaba cancelada se llama al entrar."""
+        with self.lock:
+            clave = self.siguiente
+            self.siguiente += 1
+            self.acciones[clave] = accion
+            ya_cancelada = self.evento.is_set()
+        if ya_cancelada:
+            self._ejecutar(accion)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.acciones.pop(clave, None)
+
+    @staticmethod
+    def _ejecutar(accion: Callable):
+        try:
+            accion()
+        except Exception as e:
+            logging.error(f"Error al propagar la cancelación: {e}")
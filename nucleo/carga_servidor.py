@@ -0,0 +1,241 @@
+"""Prueba de carga de servidor.py para elegir workers de uvicorn e hilos de torch.
+
+Arranca el servidor con cada combinación de workers y TORCH_THREADS y envía a /consulta/
+preguntas en español e inglés con contextos cortos, medios y largos, con varios niveles de
+concurrencia. Para cada configuración da peticiones por segundo, latencia p50/p99 y uso
+de CPU del equipo, y al final recomienda la que más rinde sin pasarse del p99 pedido:
+
+    python -m nucleo.carga_servidor --workers 1,2,4 --hilos 1,2,4 --concurrencias 1,4,8,16
+
+Con --url se mide un servidor ya arrancado y solo se recorren las concurrencias.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from nucleo.trazas import percentil
+
+
+SERVIDOR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "servidor.py")
+
+# (pregunta, párrafo con la respuesta) en los dos idiomas que recibe el servidor
+PREGUNTAS = [
+    ("¿Cuántos nacimientos hubo en Canarias en 2023?",
+     "Según el ISTAC, en Canarias se registraron 13.402 nacimientos en 2023, un 2,1 % menos que el año anterior."),
+    ("¿Qué isla tiene la mayor tasa de paro?",
+     "La encuesta de población activa sitúa a Lanzarote como la isla con la mayor tasa de paro, un 18,4 %."),
+    ("¿En qué año se publicó el último padrón?",
+     "El INE publicó las cifras oficiales del padrón municipal a 1 de enero en diciembre de 2024."),
+    ("¿Cuál fue la variación del IPC en marzo?",
+     "El índice de precios de consumo subió un 3,2 % interanual en marzo, impulsado por la electricidad."),
+    ("How many tourists visited the islands in 2023?",
+     "Frontur reports that the Canary Islands received 13.9 million foreign tourists in 2023, a record high."),
+    ("Which sector employs the most people?",
+     "Services employ about 86 percent of the workforce, led by hospitality, retail and public administration."),
+    ("What is the average household size?",
+     "The latest household survey puts the average household size at 2.5 people, slightly below the national mean."),
+    ("When was the census conducted?",
+     "The population and housing census was conducted in 2021 using administrative registers instead of door-to-door visits."),
+]
+
+# Párrafos de relleno para alargar el contexto sin cambiar la respuesta
+RELLENO = [
+    "Las estadísticas se elaboran a partir de registros administrativos y encuestas a hogares.",
+    "Los datos de los últimos trimestres son provisionales y pueden revisarse en publicaciones posteriores.",
+    "Figures are broken down by island, municipality, sex and age group where sample sizes allow it.",
+    "Methodological notes describe the sampling frame, the weighting procedure and the imputation of missing values.",
+    "La serie histórica se ha enlazado para corregir los cambios de base y de clasificación.",
+    "Seasonally adjusted series are published alongside the original data for the main indicators.",
+]
+
+LONGITUDES = {"corto": 0, "medio": 6, "largo": 24}  # Párrafos de relleno por contexto
+
+
+def casos(semilla: int = 0) -> list:
+    """Todas las combinaciones de pregunta y longitud de contexto, con la respuesta en medio del relleno."""
+    aleatorio = random.Random(semilla)
+    resultado = []
+    for pregunta, parrafo in PREGUNTAS:
+        for longitud, n in LONGITUDES.items():
+            relleno = [aleatorio.choice(RELLENO) for _ in range(n)]
+            relleno.insert(aleatorio.randint(0, n), parrafo)
+            resultado.append({"pregunta": pregunta, "contexto": " ".join(relleno), "longitud": longitud})
+    return resultado
+
+
+def cpu_equipo():
+    """Tiempos acumulados (ocupado, total) de /proc/stat; None fuera de Linux."""
+    try:
+        with open("/proc/stat") as f:
+            campos = [int(x) for x in f.readline().split()[1:]]
+    except OSError:
+        return None
+    inactivo = campos[3] + (campos[4] if len(campos) > 4 else 0)
+    return sum(campos) - inactivo, sum(campos)
+
+
+def porcentaje_cpu(antes, despues):
+    if antes is None or despues is None or despues[1] == antes[1]:
+        return None
+    return 100 * (despues[0] - antes[0]) / (despues[1] - antes[1])
+
+
+def consultar(url: str, caso: dict, timeout: float) -> float:
+    """Envía una pregunta y devuelve su latencia en milisegundos; lanza si la respuesta no es 200."""
+    datos = json.dumps({"pregunta": caso["pregunta"], "contexto": caso["contexto"]}).encode("utf-8")
+    peticion = urllib.request.Request(f"{url}/consulta/", data=datos, headers={"Content-Type": "application/json"})
+    inicio = time.perf_counter()
+    with urllib.request.urlopen(peticion, timeout=timeout) as respuesta:
+        respuesta.read()
+    return (time.perf_counter() - inicio) * 1000
+
+
+def medir(url: str, concurrencia: int, peticiones: int, timeout: float = 120) -> dict:
+    """Lanza `peticiones` preguntas con `concurrencia` clientes a la vez."""
+    lista = casos()
+    # Calentamiento: la primera inferencia de cada worker es mucho más lenta
+    try:
+        with ThreadPoolExecutor(max_workers=concurrencia) as executor:
+            list(executor.map(lambda c: consultar(url, c, timeout), lista[:concurrencia]))
+    except (urllib.error.URLError, OSError) as e:
+        logging.error(f"Error en el calentamiento: {e}")
+
+    latencias, errores = [], []
+
+    def una(i):
+        try:
+            latencias.append(consultar(url, lista[i % len(lista)], timeout))
+        except (urllib.error.URLError, OSError) as e:
+            logging.error(f"Error en la petición {i}: {e}")
+            errores.append(i)
+
+    cpu_antes = cpu_equipo()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as executor:
+        list(executor.map(una, range(peticiones)))
+    duracion = time.perf_counter() - inicio
+    cpu = porcentaje_cpu(cpu_antes, cpu_equipo())
+
+    return {
+        "concurrencia": concurrencia,
+        "peticiones": peticiones,
+        "errores": len(errores),
+        "rps": len(latencias) / duracion if duracion else 0.0,
+        "p50_ms": percentil(latencias, 0.5) if latencias else None,
+        "p99_ms": percentil(latencias, 0.99) if latencias else None,
+        "cpu": cpu,
+    }
+
+
+def arrancar_servidor(workers: int, hilos: int, puerto: int, espera: float = 300) -> subprocess.Popen:
+    """Arranca servidor.py con la configuración dada y espera a que responda en /."""
+    entorno = dict(os.environ, SERVIDOR_WORKERS=str(workers), TORCH_THREADS=str(hilos), SERVIDOR_PORT=str(puerto))
+    proceso = subprocess.Popen([sys.executable, SERVIDOR], env=entorno,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    limite = time.monotonic() + espera
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError(f"Error: el servidor terminó al arrancar (código {proceso.returncode})")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/", timeout=2):
+                return proceso
+        except (urllib.error.URLError, OSError):
+            time.sleep(1)
+    parar_servidor(proceso)
+    raise RuntimeError(f"Error: el servidor no respondió en {espera:.0f} s")
+
+
+def parar_servidor(proceso: subprocess.Popen):
+    proceso.terminate()
+    try:
+        proceso.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proceso.kill()
+        proceso.wait()
+
+
+def recomendar(resultados: list, p99_max: float = None):
+    """La medición con más peticiones por segundo, sin errores y dentro del p99 pedido."""
+    validos = [r for r in resultados if not r["errores"] and r["p99_ms"] is not None
+               and (p99_max is None or r["p99_ms"] <= p99_max)]
+    return max(validos, key=lambda r: r["rps"], default=None)
+
+
+def _num(valor, formato: str) -> str:
+    return format(valor, formato) if valor is not None else "-"
+
+
+def tabla(resultados: list) -> str:
+    lineas = [f"{'workers':>8}{'hilos':>7}{'conc.':>7}{'rps':>9}{'p50 ms':>10}{'p99 ms':>10}{'cpu %':>8}{'errores':>9}"]
+    for r in resultados:
+        lineas.append(f"{r.get('workers', '-'):>8}{r.get('hilos', '-'):>7}{r['concurrencia']:>7}"
+                      f"{r['rps']:>9.2f}{_num(r['p50_ms'], '.0f'):>10}{_num(r['p99_ms'], '.0f'):>10}"
+                      f"{_num(r['cpu'], '.0f'):>8}{r['errores']:>9}")
+    return "\n".join(lineas)
+
+
+def _enteros(texto: str) -> list:
+    return [int(x) for x in texto.split(",") if x]
+
+
+if __name__ == "__main__":
+    nucleos = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Prueba de carga de servidor.py")
+    parser.add_argument("--url", help="Servidor ya arrancado (solo se recorren las concurrencias)")
+    parser.add_argument("--workers", type=_enteros, default=[1, 2, 4])
+    parser.add_argument("--hilos", type=_enteros, default=sorted({1, max(1, nucleos // 2), nucleos}))
+    parser.add_argument("--concurrencias", type=_enteros, default=[1, 2, 4, 8, 16])
+    parser.add_argument("--peticiones", type=int, default=48, help="Peticiones por nivel de concurrencia")
+    parser.add_argument("--p99-max", type=float, help="Latencia p99 máxima aceptable en ms")
+    parser.add_argument("--puerto", type=int, default=5099)
+    parser.add_argument("--sobresuscribir", action="store_true",
+                        help="Probar también combinaciones con más hilos que núcleos")
+    parser.add_argument("--salida", help="Fichero JSON con todas las mediciones")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    resultados = []
+    if args.url:
+        for concurrencia in args.concurrencias:
+            resultados.append(medir(args.url.rstrip("/"), concurrencia, args.peticiones))
+            logging.info(f"concurrencia {concurrencia}: {resultados[-1]['rps']:.2f} rps")
+    else:
+        for workers in args.workers:
+            for hilos in args.hilos:
+                if workers * hilos > nucleos and not args.sobresuscribir:
+                    logging.info(f"Se omite workers={workers} hilos={hilos}: más hilos que núcleos ({nucleos})")
+                    continue
+                logging.info(f"Arrancando servidor con workers={workers} hilos={hilos}")
+                try:
+                    proceso = arrancar_servidor(workers, hilos, args.puerto)
+                except RuntimeError as e:
+                    logging.error(str(e))
+                    continue
+                try:
+                    for concurrencia in args.concurrencias:
+                        medicion = medir(f"http://127.0.0.1:{args.puerto}", concurrencia, args.peticiones)
+                        resultados.append(dict(medicion, workers=workers, hilos=hilos))
+                        logging.info(f"workers={workers} hilos={hilos} concurrencia={concurrencia}: "
+                                     f"{medicion['rps']:.2f} rps")
+                finally:
+                    parar_servidor(proceso)
+
+    print(tabla(resultados))
+    mejor = recomendar(resultados, args.p99_max)
+    if mejor:
+        print(f"\nRecomendado en este equipo ({nucleos} núcleos): SERVIDOR_WORKERS={mejor.get('workers', '-')} "
+              f"TORCH_THREADS={mejor.get('hilos', '-')} con hasta {mejor['concurrencia']} clientes a la vez "
+              f"({mejor['rps']:.2f} rps, p99 {mejor['p99_ms']:.0f} ms)")
+    else:
+        print("\nNinguna configuración cumple el p99 pedido sin errores")
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
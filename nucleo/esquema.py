@@ -0,0 +1,150 @@
+"""Esquema del catálogo en formato compacto tipo DDL para los prompts.
+
+Las tablas con las mismas columnas se agrupan y, dentro de cada grupo, las que comparten
+prefijo se escriben una sola vez: ine_1_3_{nacimientos|defunciones}(periodo, sexo, valor).
+
+Comparación de tokens y tiempo de evaluación del prompt frente al volcado JSON:
+
+    python -m nucleo.esquema --fichero esquema.json --ollama http://localhost:11434 --modelo llama3
+"""
+import argparse
+import json
+import re
+import time
+import urllib.request
+import uuid
+
+from nucleo.texto import estimar_tokens
+
+
+LEYENDA_ESQUEMA = ("Formato: tabla(columnas). prefijo_{a|b}(columnas) son varias tablas, prefijo_a y prefijo_b, "
+                   "con las mismas columnas.")
+
+IDENTIFICADOR_SIMPLE = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def identificador(nombre: str) -> str:
+    """El nombre tal cual si PostgreSQL lo acepta sin comillas; si no, entre comillas dobles."""
+    return nombre if IDENTIFICADOR_SIMPLE.match(nombre) else '"' + nombre.replace('"', '""') + '"'
+
+
+def prefijo(tabla: str) -> str:
+    """Todo hasta el último "_" inclusive: ine_1_3_nacimientos → ine_1_3_."""
+    return tabla[:tabla.rfind("_") + 1]
+
+
+def codificar_esquema(esquema: dict) -> str:
+    """Una línea por grupo de tablas con las mismas columnas y el mismo prefijo.
+
+    Las líneas salen ordenadas por nombre de tabla para que el prompt sea estable entre
+    peticiones y Ollama pueda reutilizar el prefijo ya evaluado.
+    """
+    grupos = {}  # {(columnas, prefijo): [tablas]}
+    for tabla, columnas in esquema.items():
+        clave = (tuple(columnas), prefijo(tabla) if IDENTIFICADOR_SIMPLE.match(tabla) else tabla)
+        grupos.setdefault(clave, []).append(tabla)
+
+    lineas = []
+    for (columnas, comun), tablas in grupos.items():
+        tablas = sorted(tablas)
+        if len(tablas) > 1 and comun:
+            nombre = comun + "{" + "|".join(t[len(comun):] for t in tablas) + "}"
+        else:
+            nombre = ", ".join(identificador(t) for t in tablas)
+        lineas.append((tablas[0], f"{nombre}({', '.join(identificador(c) for c in columnas)})"))
+    return "\n".join(linea for _, linea in sorted(lineas))
+
+
+def expandir_esquema(texto: str) -> dict:
+    """Inversa de codificar_esquema, para comprobar que no se pierde información."""
+    esquema = {}
+    for linea in texto.splitlines():
+        encontrado = re.match(r"^(.*?)\((.*)\)$", linea.strip())
+        if not encontrado:
+            continue
+        nombres, columnas = encontrado.groups()
+        columnas = [c.strip().strip('"').replace('""', '"') for c in columnas.split(", ")] if columnas else []
+        agrupado = re.match(r"^(.*)\{(.*)\}$", nombres)
+        if agrupado:
+            tablas = [agrupado.group(1) + s for s in agrupado.group(2).split("|")]
+        else:
+            tablas = [t.strip().strip('"').replace('""', '"') for t in nombres.split(", ")]
+        for tabla in tablas:
+            esquema[tabla] = list(columnas)
+    return esquema
+
+
+def evaluar_en_ollama(url: str, modelo: str, prompt: str) -> dict:
+    """Tokens del prompt y tiempo de evaluación según Ollama, generando un solo token.
+
+    Se antepone un identificador único para que Ollama no reutilice un prefijo ya evaluado.
+    """
+    datos = json.dumps({
+        "model": modelo,
+        "prompt": f"[{uuid.uuid4().hex}]\n{prompt}",
+        "stream": False,
+        "options": {"num_predict": 1},
+    }).encode("utf-8")
+    peticion = urllib.request.Request(f"{url.rstrip('/')}/api/generate", data=datos,
+                                      headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(peticion, timeout=600) as respuesta:
+        resultado = json.loads(respuesta.read())
+    return {"tokens": resultado.get("prompt_eval_count"),
+            "evaluacion_ms": (resultado.get("prompt_eval_duration") or 0) / 1e6}
+
+
+def comparar(esquema: dict, url: str = None, modelo: str = None, repeticiones: int = 3) -> list:
+    """Caracteres, tokens estimados y, con Ollama, tokens y milisegundos reales de cada formato."""
+    formatos = {
+        "json indent=2": json.dumps(esquema, indent=2),
+        "json compacto": json.dumps(esquema, separators=(",", ":"), ensure_ascii=False),
+        "compacto": LEYENDA_ESQUEMA + "\n" + codificar_esquema(esquema),
+    }
+    filas = []
+    for nombre, texto in formatos.items():
+        fila = {"formato": nombre, "caracteres": len(texto), "tokens_estimados": estimar_tokens(texto)}
+        if url:
+            medidas = [evaluar_en_ollama(url, modelo, texto) for _ in range(repeticiones)]
+            fila["tokens_ollama"] = medidas[-1]["tokens"]
+            fila["evaluacion_ms"] = sorted(m["evaluacion_ms"] for m in medidas)[len(medidas) // 2]
+        filas.append(fila)
+    return filas
+
+
+def _esquema_de_la_bd() -> dict:
+    from nucleo.bd import BaseDatos
+    bd = BaseDatos.desde_entorno(max_conexiones=1)
+    try:
+        return bd.get_db_schema()
+    finally:
+        bd.cerrar()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokens del esquema en JSON frente al formato compacto")
+    parser.add_argument("--fichero", help="Esquema en JSON {tabla: [columnas]}; sin él se lee de PG_* del entorno")
+    parser.add_argument("--ollama", help="URL de Ollama para medir tokens y tiempo de evaluación reales")
+    parser.add_argument("--modelo", default="llama3")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.fichero:
+        with open(args.fichero, encoding="utf-8") as f:
+            catalogo = json.load(f)
+    else:
+        catalogo = _esquema_de_la_bd()
+    if expandir_esquema(codificar_esquema(catalogo)) != catalogo:
+        print("Aviso: el formato compacto no reproduce exactamente el esquema")
+
+    inicio = time.perf_counter()
+    codificar_esquema(catalogo)
+    print(f"{len(catalogo)} tablas; codificación compacta en {(time.perf_counter() - inicio) * 1000:.1f} ms\n")
+    resultados = comparar(catalogo, args.ollama, args.modelo, args.repeticiones)
+    base = resultados[0]
+    print(f"{'formato':<16}{'caracteres':>12}{'tokens est.':>13}{'tokens':>9}{'eval. ms':>10}{'ahorro':>9}")
+    for r in resultados:
+        tokens = r.get("tokens_ollama") or r["tokens_estimados"]
+        tokens_base = base.get("tokens_ollama") or base["tokens_estimados"]
+        print(f"{r['formato']:<16}{r['caracteres']:>12}{r['tokens_estimados']:>13}"
+              f"{r.get('tokens_ollama') or '-':>9}{r.get('evaluacion_ms', 0):>10.0f}"
+              f"{100 * (1 - tokens / tokens_base):>8.0f}%")
@@ -0,0 +1,850 @@
+"""Motor de etapas: cada pipeline se declara como una lista de etapas que comparten un Contexto.
+
+Una etapa es una función que recibe el Contexto y lo completa. Las etapas que ya no tienen
+nada que hacer (por ejemplo, generar SQL cuando una plantilla ya dio el resultado) vuelven
+sin tocarlo, y el recorrido se detiene en cuanto alguna fija la respuesta o un error.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Generator, Iterator, List, Union
+
+import psycopg2
+
+from nucleo import sesiones
+from nucleo.bd import es_solo_lectura
+from nucleo.cancelacion import Cancelacion, Cancelado
+from nucleo.exportacion import export_csv_text, export_to_file
+from nucleo.intencion import INTENCION_COLUMNAS, INTENCION_TABLAS
+from nucleo.llm import ErrorOllama
+from nucleo.modelos import puntuar_complejidad
+from nucleo.planificador import INTERACTIVA, LOTE
+from nucleo.recursos import Recursos
+from nucleo.texto import codificar_resultados, estimar_tokens
+from nucleo.trazas import EscritorTrazas, Traza
+
+
+class Contexto:
+    """Estado de una petición a lo largo de las etapas."""
+
+    def __init__(self, pipeline, user_message: str, messages: List[dict] = None, body: dict = None):
+        self.pipeline = pipeline
+        self.valves = pipeline.valves
+        self.recursos = pipeline.recursos
+        self.user_message = user_message
+        self.messages = messages or []
+        self.body = body or {}
+
+        self.intencion = None
+        self.terminos = []
+        self.sql = None
+        self.origen_sql = None  # usuario, memoria, seguimiento, plantilla, cache, llm o fuentes
+        self.fuente = None  # Prefijo de tablas al que se limita la pregunta (subconsultas por fuente)
+        self.columnas = None
+        self.filas = None
+        self.resumen = None
+        self.respuesta = None
+        self.error = None
+        self.avisos = []  # Notas para el usuario que se añaden al final de la respuesta
+        self.tiempos = {}  # {etapa: milisegundos}
+        self.generacion_ms = 0.0  # Tiempo total esperando al LLM
+        self.espera_llm_ms = 0.0  # Parte de ese tiempo en la cola del planificador, antes de llegar a Ollama
+        self.usuario = usuario_de(self.body)
+        self.prioridad = INTERACTIVA
+        self.modelos = {}  # {tarea: modelo que dio la salida aceptada}
+        self.cancelacion = Cancelacion()
+        self.traza = Traza({"pipeline": getattr(pipeline, "name", None), "pregunta": user_message[:200]})
+
+    @property
+    def terminado(self) -> bool:
+        return self.respuesta is not None or self.error is not None
+
+
+def usuario_de(body: dict) -> str:
+    """Usuario de Open WebUI que hace la petición (body["user"]), para repartir el LLM entre usuarios."""
+    usuario = body.get("user") or {}
+    if isinstance(usuario, dict):
+        return str(usuario.get("id") or usuario.get("email") or usuario.get("name") or "anonimo")
+    return str(usuario)
+
+
+def ejecutar_etapas(etapas: List[Callable], ctx: Contexto) -> Union[str, Generator, Iterator]:
+    """Recorre las etapas midiendo cuánto tarda cada una y deja la traza de la petición."""
+    recorrer_etapas(etapas, ctx)
+    logging.info("Tiempos por etapa (ms): " + ", ".join(f"{n}={t:.1f}" for n, t in ctx.tiempos.items())
+                 + f"; generación LLM: {ctx.generacion_ms:.1f} (en cola: {ctx.espera_llm_ms:.1f})")
+    escribir_traza(ctx)
+    if ctx.avisos and isinstance(ctx.respuesta, str) and not ctx.error:
+        ctx.respuesta += "\n\n" + "\n".join(ctx.avisos)
+    return ctx.error or ctx.respuesta
+
+
+def recorrer_etapas(etapas: List[Callable], ctx: Contexto):
+    for etapa in etapas:
+        if ctx.cancelacion.cancelada:
+            ctx.error = "Error: petición cancelada."
+            break
+        inicio = time.perf_counter()
+        try:
+            with ctx.traza.span(etapa.__name__):
+                etapa(ctx)
+        except Cancelado:
+            logging.info(f"Petición cancelada durante la etapa {etapa.__name__}")
+            ctx.error = "Error: petición cancelada."
+        except Exception as e:
+            logging.error(f"Error en la etapa {etapa.__name__}: {e}")
+            ctx.error = f"Error en el proceso: {e}"
+        ctx.tiempos[etapa.__name__] = (time.perf_counter() - inicio) * 1000
+        if ctx.terminado:
+            break
+
+
+def escribir_traza(ctx: Contexto):
+    """Encola la traza de la petición para el fichero TRACE_PATH (vacío: sin trazas)."""
+    if not ctx.valves.TRACE_PATH:
+        return
+    escritor = EscritorTrazas.para(ctx.valves.TRACE_PATH, ctx.valves.TRACE_MAX_BYTES, ctx.valves.TRACE_BACKUPS)
+    escritor.escribir(ctx.traza.registro(
+        intencion=ctx.intencion,
+        origen_sql=ctx.origen_sql,
+        filas=len(ctx.filas) if ctx.filas is not None else None,
+        generacion_ms=round(ctx.generacion_ms, 3),
+        espera_llm_ms=round(ctx.espera_llm_ms, 3),
+        usuario=ctx.usuario,
+        modelos=ctx.modelos,
+        error=ctx.error,
+    ))
+
+
+class PipelineEtapas:
+    """Base de las pipelines: recursos compartidos del proceso y pipe() que recorre self.etapas."""
+
+    etapas = []
+    error_sql = "Error en la ejecución de la consulta SQL"  # Delante del error de PostgreSQL al ejecutar el SQL
+
+    @property
+    def recursos(self) -> Recursos:
+        return Recursos.para(self.valves)
+
+    async def on_startup(self):
+        self.recursos.iniciar()
+
+    async def on_shutdown(self):
+        self.recursos.liberar()
+
+    async def on_valves_updated(self):
+        # El planificador es compartido: el límite solo cambia cuando alguien edita las valves
+        self.recursos.planificador.ajustar(self.valves.LLM_MAX_CONCURRENCY)
+
+    def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
+        ctx = Contexto(self, user_message, messages, body)
+        if not (body or {}).get("stream"):
+            return ejecutar_etapas(self.etapas, ctx)
+        return self.pipe_cancelable(ctx)
+
+    def pipe_cancelable(self, ctx: Contexto) -> Generator:
+        """Ejecuta las etapas en otro hilo y vigila si el cliente sigue conectado.
+
+        Mientras se trabaja se emite un fragmento vacío cada CANCEL_CHECK_SECONDS. Si el
+        usuario para la generación o cierra la pestaña, el servidor deja de leer y cierra
+        el generador en ese punto: la cancelación corta la llamada a Ollama y la sentencia
+        en PostgreSQL en lugar de dejarlas terminar.
+        """
+        resultado = {}
+        hilo = threading.Thread(target=lambda: resultado.update(respuesta=ejecutar_etapas(self.etapas, ctx)),
+                                daemon=True)
+        hilo.start()
+        try:
+            while hilo.is_alive():
+                hilo.join(self.valves.CANCEL_CHECK_SECONDS)
+                if hilo.is_alive():
+                    yield ""
+            respuesta = resultado.get("respuesta")
+            if isinstance(respuesta, str) or respuesta is None:
+                yield respuesta or ""
+            else:
+                yield from respuesta
+        finally:
+            if hilo.is_alive():
+                logging.info("El cliente ha cerrado la conexión; se cancela la petición")
+                ctx.cancelacion.cancelar()
+
+    def pipe_batch(self, user_messages: List[str], body: dict = None) -> List[dict]:
+        """Responde una lista de preguntas en una sola llamada.
+
+        Las preguntas repetidas se resuelven una vez, todas comparten el catálogo y el pool
+        de conexiones, y como mucho BATCH_CONCURRENCY preguntas llaman al LLM a la vez.
+        Devuelve un diccionario por pregunta, en el mismo orden, con su respuesta o error.
+        """
+        unicas = list(dict.fromkeys(user_messages))
+        if not unicas:
+            return []
+
+        def responder(pregunta):
+            ctx = Contexto(self, pregunta, body=body)
+            # Las preguntas de un lote ceden el LLM a las conversaciones interactivas
+            ctx.prioridad = LOTE
+            ejecutar_etapas(self.etapas, ctx)
+            return {"pregunta": pregunta, "sql": ctx.sql, "respuesta": ctx.respuesta,
+                    "error": ctx.error, "tiempos": ctx.tiempos, "espera_llm_ms": ctx.espera_llm_ms}
+
+        hilos = max(1, min(self.valves.BATCH_CONCURRENCY, len(unicas)))
+        with ThreadPoolExecutor(max_workers=hilos) as executor:
+            resueltas = dict(zip(unicas, executor.map(responder, unicas)))
+        return [dict(resueltas[m]) for m in user_messages]
+
+    def estado_planificador(self) -> dict:
+        """Llamadas al LLM en curso y en cola por usuario (valve LLM_MAX_CONCURRENCY)."""
+        return self.recursos.planificador.estado()
+
+    def estadisticas_modelos(self) -> dict:
+        """Aciertos del modelo pequeño y ahorro de latencia por tarea (valve LLM_SMALL_MODEL)."""
+        return self.recursos.niveles.informe()
+
+    def estadisticas_llm(self) -> dict:
+        """Llamadas agrupadas con otra idéntica en curso, coberturas y estado de cada instancia de Ollama."""
+        cliente = self.recursos.llm_cliente  # Sin crearlo si aún no se ha llamado al LLM
+        return cliente.estadisticas() if cliente is not None else {}
+
+
+class SalidaInvalida(Exception):
+    """El modelo devolvió algo que no cumple el formato pedido (JSON mal formado o cortado)."""
+
+
+# Salida estructurada de la generación de SQL
+ESQUEMA_SQL = {
+    "type": "object",
+    "properties": {"sql": {"type": "string"}},
+    "required": ["sql"],
+}
+INSTRUCCION_JSON_SQL = """
+        Responde únicamente con un objeto JSON de la forma {"sql": "<consulta SQL>"}, sin texto adicional.
+"""
+PARADAS_SQL = ["```", "\n\n\n"]
+
+
+def llamar_llm(ctx: Contexto, prompt: str, temperatura: float, modelo: str = None, **opciones):
+    """Envía el prompt al modelo (por defecto el de la pipeline); devuelve la primera elección o None.
+
+    opciones se añade al payload (max_tokens, stop, response_format...).
+    """
+    modelo = modelo or ctx.pipeline.model
+    payload = {
+        "model": modelo,
+        "messages": [{"role": "system", "content": prompt}],
+        "temperature": temperatura,
+        **opciones,
+    }
+    cola = {"espera_ms": 0.0, "en_cola": 0}
+
+    @contextmanager
+    def turno():
+        # El planificador decide cuándo le toca a la llamada según su usuario y prioridad
+        with ctx.recursos.planificador.turno(ctx.usuario, ctx.prioridad, ctx.cancelacion) as medida:
+            cola.update(medida)
+            yield
+
+    inicio = time.perf_counter()
+    try:
+        with ctx.traza.span("llm", modelo=modelo, temperatura=temperatura,
+                            prompt_caracteres=len(prompt), prompt_tokens=estimar_tokens(prompt),
+                            max_tokens=opciones.get("max_tokens")) as atributos:
+            # Una llamada idéntica a otra en curso espera su respuesta sin pedir turno
+            response_data = ctx.recursos.llm.chat(payload, cancelacion=ctx.cancelacion, turno=turno)
+            atributos["espera_cola_ms"] = round(cola["espera_ms"], 1)
+            atributos["en_cola"] = cola["en_cola"]
+            ctx.espera_llm_ms += cola["espera_ms"]
+            metricas = response_data.get("metricas", {})
+            atributos["backend"] = metricas.get("backend")
+            if metricas.get("primer_token") is not None:
+                atributos["primer_token_ms"] = round(metricas["primer_token"] * 1000, 1)
+            atributos["tokens_generados"] = (response_data.get("usage") or {}).get("completion_tokens")
+            if 'choices' in response_data and len(response_data['choices']) > 0:
+                eleccion = response_data['choices'][0]
+                atributos["finalizacion"] = eleccion.get("finish_reason")
+                atributos["respuesta_caracteres"] = len(eleccion['message']['content'] or "")
+                return eleccion
+            return None
+    finally:
+        ctx.generacion_ms += (time.perf_counter() - inicio) * 1000
+
+
+def consultar_llm(ctx: Contexto, prompt: str, temperatura: float, **opciones):
+    """Envía el prompt al modelo de la pipeline y devuelve el texto, o None si no hay contenido."""
+    eleccion = llamar_llm(ctx, prompt, temperatura, **opciones)
+    if eleccion is None:
+        return None
+    return (eleccion['message']['content'] or "").strip()
+
+
+def por_niveles(ctx: Contexto, tarea: str, intentar: Callable):
+    """Resuelve la tarea con el modelo pequeño (LLM_SMALL_MODEL) y, si no vale, con el de la pipeline.
+
+    intentar(modelo) devuelve el resultado, None si no hubo contenido, o lanza SalidaInvalida
+    si no pasa la validación. Con el modelo pequeño cualquiera de esos fallos, o un error de
+    Ollama, hace que se repita con el grande; con el grande se devuelven tal cual. Las
+    preguntas con complejidad por encima de LLM_COMPLEXITY_THRESHOLD van directas al grande.
+    """
+    grande = ctx.pipeline.model
+    pequeno = ctx.valves.LLM_SMALL_MODEL
+    estadisticas = ctx.recursos.niveles
+    ms_pequeno, motivo = 0.0, None
+    if pequeno and pequeno != grande:
+        complejidad = puntuar_complejidad(ctx.user_message)
+        if complejidad <= ctx.valves.LLM_COMPLEXITY_THRESHOLD:
+            inicio = time.perf_counter()
+            try:
+                resultado = intentar(pequeno)
+                motivo = None if resultado is not None else "sin contenido"
+            except SalidaInvalida as e:
+                motivo = f"salida no válida: {e}"
+            except ErrorOllama as e:
+                motivo = f"error de Ollama: {e}"
+            ms_pequeno = (time.perf_counter() - inicio) * 1000
+            if motivo is None:
+                estadisticas.registrar(tarea, "pequeno", ms_pequeno=ms_pequeno)
+                ctx.modelos[tarea] = pequeno
+                return resultado
+            logging.info(f"El modelo {pequeno} no sirvió para {tarea} ({motivo}); se pasa a {grande}")
+        else:
+            motivo = "complejidad"
+            logging.info(f"Pregunta compleja ({complejidad:.1f}): {tarea} directamente con {grande}")
+
+    inicio = time.perf_counter()
+    try:
+        resultado = intentar(grande)
+    finally:
+        ms_grande = (time.perf_counter() - inicio) * 1000
+        if motivo is not None and motivo != "complejidad":
+            estadisticas.registrar(tarea, "escalado", ms_pequeno, ms_grande, motivo)
+        elif pequeno:
+            estadisticas.registrar(tarea, "grande", ms_grande=ms_grande)
+    ctx.modelos[tarea] = grande
+    return resultado
+
+
+def comprobar_sql(ctx: Contexto, sql_query: str):
+    """Lanza SalidaInvalida si el SQL no es una consulta o PostgreSQL no puede planificarlo.
+
+    Con EXPLAIN (sin ejecutar) se detectan tablas y columnas inventadas antes de gastar la
+    ejecución; se usa para decidir si la salida del modelo pequeño es aceptable.
+    """
+    if not sql_query.lower().startswith(("select", "with")):
+        raise SalidaInvalida(f"no es una consulta: {sql_query[:200]!r}")
+    def explicar(conn):
+        cursor = conn.cursor()
+        with ctx.cancelacion.propagar(conn.cancel):
+            cursor.execute(f"EXPLAIN {sql_query}")
+        cursor.close()
+
+    try:
+        ctx.recursos.bd.leer(explicar)
+    except psycopg2.Error as e:
+        ctx.cancelacion.comprobar()
+        raise SalidaInvalida(f"EXPLAIN falló: {str(e).strip()}")
+
+
+def interpretar_json(eleccion: dict, esquema: dict) -> dict:
+    """Extrae el objeto JSON de la respuesta y comprueba sus campos obligatorios.
+
+    Lanza SalidaInvalida en cuanto algo no cuadra: no se reintenta con el mismo prompt.
+    """
+    if eleccion.get("finish_reason") == "length":
+        raise SalidaInvalida("la respuesta se cortó al llegar a max_tokens")
+    texto = (eleccion['message']['content'] or "").strip()
+    texto = re.sub(r"^```(?:json)?\s*|\s*```$", "", texto)
+    try:
+        datos = json.loads(texto)
+    except ValueError:
+        # Texto alrededor del objeto: se toma el primer {...}
+        encontrado = re.search(r"\{.*\}", texto, re.DOTALL)
+        try:
+            datos = json.loads(encontrado.group(0)) if encontrado else None
+        except ValueError:
+            datos = None
+    if not isinstance(datos, dict):
+        raise SalidaInvalida(f"no es un objeto JSON: {texto[:200]!r}")
+    for campo in esquema.get("required", []):
+        if not isinstance(datos.get(campo), str) or not datos[campo].strip():
+            raise SalidaInvalida(f"falta el campo {campo!r}: {texto[:200]!r}")
+    return datos
+
+
+def limpiar_sql(sql_query: str) -> str:
+    """Quita las marcas ```sql que a veces el modelo mete dentro del propio valor."""
+    return re.sub(r"^```(?:sql)?\s*|\s*```$", "", sql_query.strip()).strip()
+
+
+def construir_prompt_medido(ctx: Contexto, construir_prompt: Callable):
+    with ctx.traza.span("construir_prompt") as atributos:
+        prompt = construir_prompt(ctx)
+        atributos["caracteres"] = len(prompt or "")
+    return prompt
+
+
+def obtener_esquema(ctx: Contexto) -> dict:
+    """Esquema del catálogo en memoria, medido en la traza."""
+    with ctx.traza.span("esquema") as atributos:
+        esquema = ctx.recursos.bd.cached_schema()
+        if ctx.fuente:
+            esquema = {t: c for t, c in esquema.items() if t.lower().startswith(ctx.fuente)}
+        atributos["tablas"] = len(esquema)
+    return esquema
+
+
+def formatear_tablas(tablas: list) -> str:
+    """Lista de "esquema.tabla" como la devolvían las pipelines originales."""
+    return str([".".join(str(v) for v in fila) for fila in tablas])
+
+
+def formatear_columnas(columnas: list) -> str:
+    tablas = {}
+    for tabla, columna, tipo in columnas:
+        tablas.setdefault(tabla, []).append(f"{columna} ({tipo})")
+    return "\n".join(f"- {tabla}: {', '.join(cols)}" for tabla, cols in tablas.items())
+
+
+# Etapas de conexión y eco
+
+def comprobar_conexion(ctx: Contexto):
+    """Comprueba que la base de datos responde."""
+    try:
+        with ctx.recursos.bd.conexion() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+    except psycopg2.Error as e:
+        logging.error(f"Error connecting to PostgreSQL: {e}")
+        ctx.error = f"Error connecting to PostgreSQL: {e}"
+
+
+def responder_texto(texto: str) -> Callable:
+    def responder_texto(ctx: Contexto):
+        ctx.respuesta = texto
+    return responder_texto
+
+
+def repetir_mensaje(ctx: Contexto):
+    ctx.respuesta = ctx.user_message
+
+
+# Etapas de catálogo
+
+def extraer_palabra_clave(separador: str) -> Callable:
+    """Toma como término de búsqueda lo que sigue a separador en el mensaje."""
+    def extraer_palabra_clave(ctx: Contexto):
+        ctx.terminos = [ctx.user_message.lower().split(separador)[-1].strip()]
+    return extraer_palabra_clave
+
+
+def listar_tablas(ctx: Contexto):
+    try:
+        tablas = ctx.recursos.bd.list_tables(ctx.terminos)
+    except psycopg2.Error as e:
+        logging.error(f"Error al obtener las tablas: {e}")
+        ctx.error = f"Error al obtener las tablas: {e}"
+        return
+    if not tablas:
+        ctx.respuesta = f"No hay tablas que contenga la palabra: {' '.join(ctx.terminos)}"
+        return
+    ctx.respuesta = formatear_tablas(tablas)
+
+
+def responder_catalogo(ctx: Contexto):
+    """Clasifica la intención y contesta las preguntas sobre el catálogo sin llamar al LLM."""
+    if ctx.sql or ctx.filas is not None:
+        return
+    inicio = time.perf_counter()
+    ctx.intencion, confianza, ctx.terminos = ctx.recursos.clasificador.clasificar(ctx.user_message)
+    logging.info(f"Intención {ctx.intencion} ({confianza:.2f}) en {(time.perf_counter() - inicio) * 1e6:.0f} µs")
+
+    if ctx.intencion == INTENCION_TABLAS:
+        listar_tablas(ctx)
+    elif ctx.intencion == INTENCION_COLUMNAS and ctx.terminos:
+        columnas = ctx.recursos.bd.list_columns(ctx.terminos)
+        ctx.respuesta = (formatear_columnas(columnas)
+                         or f"No hay tablas que contenga la palabra: {' '.join(ctx.terminos)}")
+
+
+# Etapas de obtención del SQL
+
+def seguimiento(ctx: Contexto):
+    """Responde seguimientos ("¿y en 2022?", "ordénalo por valor") con el resultado anterior."""
+    if len(ctx.messages) <= 1:
+        return
+    sesion = ctx.recursos.sesiones.obtener(sesiones.clave_conversacion(ctx.body, ctx.messages))
+    resultado = sesiones.resolver_seguimiento(ctx.user_message, sesion) if sesion else None
+    if not resultado:
+        return
+    if "filas" in resultado:
+        logging.info(f"Seguimiento resuelto en memoria para '{ctx.user_message}'")
+        ctx.columnas, ctx.filas = resultado["columnas"], resultado["filas"]
+        ctx.origen_sql = "memoria"
+    else:
+        logging.info(f"Seguimiento resuelto reutilizando el SQL anterior: {resultado['sql']}")
+        ctx.sql = resultado["sql"]
+        ctx.origen_sql = "seguimiento"
+
+
+def aplicar_plantilla(ctx: Contexto):
+    """Preguntas con forma conocida: plantilla preparada, sin LLM."""
+    if ctx.sql or ctx.filas is not None:
+        return
+    plan = ctx.recursos.plantillas.reconocer(ctx.user_message, obtener_esquema(ctx))
+    resultado = ctx.recursos.plantillas.ejecutar(plan, ctx.cancelacion, ctx.traza) if plan else None
+    # Sin filas puede que la plantilla no haya entendido bien la pregunta: se genera el SQL
+    if resultado and not resultado[2]:
+        logging.info(f"La plantilla no devolvió filas para '{ctx.user_message}'; se genera el SQL")
+        return
+    if resultado:
+        logging.info(f"Plantilla SQL aplicada para '{ctx.user_message}'")
+        ctx.sql, ctx.columnas, ctx.filas = resultado
+        ctx.origen_sql = "plantilla"
+
+
+def buscar_en_cache(ctx: Contexto):
+    """Reutiliza el SQL de una pregunta casi idéntica ya validada (valves SEMANTIC_CACHE_*)."""
+    if ctx.sql or ctx.filas is not None:
+        return
+    cache = ctx.recursos.cache_semantica(ctx.valves.SEMANTIC_CACHE_PATH)
+    sql_query = cache.reutilizable(ctx.user_message, ctx.valves.SEMANTIC_CACHE_THRESHOLD)
+    if sql_query:
+        logging.info(f"Caché semántica: reutilizando SQL para '{ctx.user_message}'")
+        ctx.sql = sql_query
+        ctx.origen_sql = "cache"
+
+
+def fuentes_mencionadas(mensaje: str, prefijos: List[str]) -> List[str]:
+    palabras = set(re.findall(r"\w+", mensaje.lower()))
+    return [p for p in prefijos if p in palabras]
+
+
+# Con el artículo contracto que pueda seguirle: "frente al istac", "y del ine", "frente a la ..."
+CONECTOR = r"(?:(?:y|e|o|frente|vs|versus)(?:\s+(?:al|del|a\s+la|de\s+la|a))?)"
+PREPOSICION = r"(?:según|segun|del|de|en)"
+ARTICULO = r"(?:el|la|los|las)"
+# Palabras de una cláusula que solo repite la pregunta para otra fuente: "y cuántos según el ine"
+ELIPSIS = r"(?:cu[aá]nt[oa]s?|qu[eé]|cu[aá]l(?:es)?|lo|los|las|el|la|datos|hubo|hay|hab[ií]a|fueron|son)"
+
+
+def subpregunta(mensaje: str, fuente: str, otras: List[str]) -> str:
+    """La pregunta solo para una fuente.
+
+    "¿cuántos turistas según el istac y cuántos según el ine?" → "¿cuántos turistas según el istac?"
+    para el istac y "¿cuántos turistas según el ine?" para el ine; "... según el ine y el istac"
+    → "... según el ine".
+    """
+    preposicion = None
+    for otra in otras:
+        # Cláusula coordinada que solo cambia la fuente: "y cuántos según el ine", "y el ine"
+        sin_clausula = re.sub(rf"\s*,?\s*\b{CONECTOR}\s+(?:{ELIPSIS}\s+)*(?:{PREPOSICION}\s+)?(?:{ARTICULO}\s+)?"
+                              rf"{otra}\b", "", mensaje, flags=re.IGNORECASE)
+        if sin_clausula != mensaje:
+            mensaje = sin_clausula
+            continue
+        # Mención dentro de la pregunta: "según el ine" entero, para no dejar "según" colgando
+        frase = re.search(rf"\s*\b({PREPOSICION})\s+(?:{ARTICULO}\s+)?{otra}\b", mensaje, flags=re.IGNORECASE)
+        if frase:
+            preposicion = preposicion or frase.group(1)
+            mensaje = mensaje[:frase.start()] + mensaje[frase.end():]
+        else:
+            mensaje = re.sub(rf"\s*\b{CONECTOR}?\s*\b(?:el|del|al|la)?\s*\b{otra}\b", "", mensaje, flags=re.IGNORECASE)
+
+    # La cláusula de esta fuente se queda solo con la fuente: "turistas y cuántos según el ine"
+    # → "turistas según el ine"; "compara ine e istac" → "compara istac"
+    def fuente_sola(m):
+        resto = m.group(1)
+        if preposicion and not re.match(PREPOSICION + r"\s", resto, flags=re.IGNORECASE):
+            articulo = "" if preposicion.lower() == "del" or re.match(ARTICULO + r"\s", resto, flags=re.IGNORECASE) else "el "
+            resto = f"{preposicion} {articulo}{resto}"
+        return " " + resto
+
+    mensaje = re.sub(rf"\s*,?\s*\b{CONECTOR}\s+(?:{ELIPSIS}\s+)*((?:{PREPOSICION}\s+)?(?:{ARTICULO}\s+)?{fuente}\b)",
+                     fuente_sola, mensaje, count=1, flags=re.IGNORECASE)
+    mensaje = re.sub(r"\s+([?.!,])", r"\1", mensaje)
+    mensaje = re.sub(r"¿\s*\?", "", re.sub(r"¿\s+", "¿", mensaje))
+    return re.sub(r"\s+", " ", mensaje).strip()
+
+
+def combinar_resultados(parciales: list) -> tuple:
+    """Une los resultados de cada fuente en una tabla con una columna "fuente" delante.
+
+    parciales es una lista de (fuente, columnas, filas); las columnas que no tenga una
+    fuente quedan vacías en sus filas.
+    """
+    columnas = []
+    for _, cols, _ in parciales:
+        columnas += [c for c in cols if c not in columnas]
+    filas = []
+    for fuente, cols, filas_fuente in parciales:
+        for fila in filas_fuente:
+            valores = dict(zip(cols, fila))
+            filas.append((fuente, *(valores.get(c) for c in columnas)))
+    return ["fuente"] + columnas, filas
+
+
+def consultar_por_fuente(subetapas: List[Callable]) -> Callable:
+    """Divide las preguntas que comparan fuentes ("según el ine y el istac") en una subconsulta
+    por fuente, las resuelve a la vez y une los resultados antes de redactar la respuesta.
+
+    Cada subpregunta recorre subetapas con el esquema limitado a las tablas de su prefijo
+    (valve SOURCE_PREFIXES) y ejecuta su SQL en su propia conexión del pool, así que el
+    tiempo total es el de la fuente más lenta y no la suma.
+    """
+    def consultar_por_fuente(ctx: Contexto):
+        if ctx.sql or ctx.filas is not None or not ctx.valves.DECOMPOSE_SOURCES:
+            return
+        fuentes = fuentes_mencionadas(ctx.user_message, ctx.valves.SOURCE_PREFIXES)
+        if len(fuentes) < 2:
+            return
+
+        hijos = []
+        for fuente in fuentes:
+            hijo = Contexto(ctx.pipeline, subpregunta(ctx.user_message, fuente, [f for f in fuentes if f != fuente]),
+                            body=ctx.body)
+            hijo.fuente = fuente
+            hijo.cancelacion = ctx.cancelacion
+            hijo.prioridad = ctx.prioridad
+            hijos.append(hijo)
+        logging.info("Pregunta dividida por fuente: " + "; ".join(f"{h.fuente}: {h.user_message}" for h in hijos))
+
+        with ThreadPoolExecutor(max_workers=len(hijos)) as executor:
+            list(executor.map(lambda hijo: recorrer_etapas(subetapas, hijo), hijos))
+
+        # Los spans de cada subconsulta se cuelgan de esta etapa en la traza de la petición
+        for hijo in hijos:
+            desfase = (hijo.traza.inicio_monotonico - ctx.traza.inicio_monotonico) * 1000
+            for span in hijo.traza.spans:
+                ctx.traza.spans.append(dict(span, nombre=f"{hijo.fuente}:{span['nombre']}",
+                                            padre=span["padre"] and f"{hijo.fuente}:{span['padre']}" or "consultar_por_fuente",
+                                            inicio_ms=round(span["inicio_ms"] + desfase, 3)))
+            ctx.generacion_ms += hijo.generacion_ms
+            ctx.espera_llm_ms += hijo.espera_llm_ms
+            ctx.modelos.update({f"{hijo.fuente}:{tarea}": modelo for tarea, modelo in hijo.modelos.items()})
+
+        ctx.cancelacion.comprobar()
+        correctos = [h for h in hijos if h.filas is not None]
+        for hijo in hijos:
+            if hijo.filas is None:
+                logging.error(f"La subconsulta de {hijo.fuente} no dio resultado: {hijo.error}")
+        fallidas = [h.fuente for h in hijos if h.filas is None]
+        if fallidas and correctos:
+            ctx.avisos.append(f"Aviso: no se pudieron obtener los datos de {', '.join(fallidas)}; "
+                              f"la respuesta solo incluye {', '.join(h.fuente for h in correctos)}.")
+        if not correctos:
+            ctx.error = hijos[0].error or "Error: No se pudo resolver la pregunta en ninguna fuente."
+            return
+        ctx.columnas, ctx.filas = combinar_resultados([(h.fuente, h.columnas, h.filas) for h in correctos])
+        ctx.sql = "\n".join(f"-- {h.fuente}\n{h.sql.rstrip().rstrip(';')};" for h in correctos)
+        ctx.origen_sql = "fuentes"
+    return consultar_por_fuente
+
+
+def usar_mensaje_como_sql(ctx: Contexto):
+    ctx.sql = ctx.user_message
+    ctx.origen_sql = "usuario"
+
+
+def generar_sql(construir_prompt: Callable, temperatura: float) -> Callable:
+    """Genera el SQL con el LLM a partir del prompt que construye la pipeline.
+
+    La salida se pide como JSON {"sql": ...} con esquema, limitada a SQL_MAX_TOKENS y con
+    secuencias de parada. construir_prompt puede fijar ctx.error y devolver None si no
+    puede construirlo.
+    """
+    def generar_sql(ctx: Contexto):
+        if ctx.sql or ctx.filas is not None:
+            return
+        prompt = construir_prompt_medido(ctx, construir_prompt)
+        if prompt is None:
+            return
+
+        def intentar(modelo):
+            eleccion = llamar_llm(
+                ctx, prompt + INSTRUCCION_JSON_SQL, temperatura, modelo=modelo,
+                max_tokens=ctx.valves.SQL_MAX_TOKENS,
+                stop=PARADAS_SQL,
+                response_format={"type": "json_schema",
+                                 "json_schema": {"name": "consulta_sql", "schema": ESQUEMA_SQL}},
+            )
+            if eleccion is None:
+                return None
+            sql_query = limpiar_sql(interpretar_json(eleccion, ESQUEMA_SQL)["sql"])
+            # Solo se valida contra la base de datos lo que escribe el modelo pequeño
+            if modelo != ctx.pipeline.model:
+                comprobar_sql(ctx, sql_query)
+            return sql_query
+
+        try:
+            sql_query = por_niveles(ctx, "sql", intentar)
+        except ErrorOllama as e:
+            logging.error(f"Error al realizar la solicitud a la API de Ollama: {e}")
+            ctx.error = "Error al generar la consulta SQL."
+            return
+        except SalidaInvalida as e:
+            logging.error(f"Salida del modelo mal formada: {e}")
+            ctx.error = "Error: El modelo no devolvió una consulta SQL válida."
+            return
+        if sql_query is None:
+            logging.error("La respuesta no contiene contenido válido.")
+            ctx.error = "Error: La respuesta no contiene contenido válido."
+            return
+        ctx.sql = sql_query
+        ctx.origen_sql = "llm"
+    return generar_sql
+
+
+def validar_sql(ctx: Contexto):
+    """Comprueba que lo devuelto por el modelo parece SQL."""
+    if ctx.origen_sql != "llm":
+        return
+    if not ctx.sql.lower().startswith(("select", "insert", "update", "delete", "with")):
+        logging.error(f"Error: El modelo no devolvió SQL válido: {ctx.sql}")
+        ctx.error = "Error: El modelo no devolvió una consulta SQL válida."
+
+
+# Etapas de ejecución
+
+def ejecutar_sql(ctx: Contexto):
+    """Ejecuta el SQL en una instantánea local si la hay o en PostgreSQL con el pool compartido.
+
+    Solo el SQL que escribe el propio usuario (prueba_pipeline) puede modificar datos; el que
+    sale del LLM, de la caché o de un seguimiento se rechaza si no es de solo lectura.
+    """
+    if ctx.filas is not None or not ctx.sql:
+        return
+    solo_lectura = es_solo_lectura(ctx.sql)
+    if not solo_lectura and ctx.origen_sql != "usuario":
+        logging.error(f"Error: SQL que modifica datos rechazado (origen {ctx.origen_sql}): {ctx.sql}")
+        ctx.error = "Error: Solo se permiten consultas de lectura."
+        return
+    if ctx.recursos.instantaneas:
+        with ctx.traza.span("sql_local") as atributos:
+            local = ctx.recursos.instantaneas.ejecutar(ctx.sql, ctx.cancelacion, ctx.traza, ctx.origen_sql)
+            atributos["filas"] = len(local[1]) if local is not None else None
+        if local is not None:
+            ctx.columnas, ctx.filas = local
+            return
+    def consultar(conn):
+        cursor = conn.cursor()
+        # Si el cliente se va, conn.cancel() aborta la sentencia en el servidor
+        with ctx.cancelacion.propagar(conn.cancel):
+            with ctx.traza.ejecucion_sql(ctx.sql, ctx.origen_sql, conn.get_dsn_parameters().get("host")):
+                cursor.execute(ctx.sql)
+            with ctx.traza.span("sql_lectura") as atributos:
+                # INSERT, UPDATE y demás sin RETURNING no devuelven filas
+                filas = cursor.fetchall() if cursor.description else []
+                atributos["filas"] = len(filas)
+        columnas = [d[0] for d in cursor.description] if cursor.description else []
+        cursor.close()
+        return columnas, filas
+
+    try:
+        # Las consultas de solo lectura pueden ir a una réplica (valve DB_REPLICAS)
+        if solo_lectura:
+            ctx.columnas, ctx.filas = ctx.recursos.bd.leer(consultar)
+        else:
+            # El pool deshace lo que quede pendiente al devolver la conexión: se confirma aquí
+            with ctx.recursos.bd.conexion() as conn:
+                ctx.columnas, ctx.filas = consultar(conn)
+                conn.commit()
+    except psycopg2.Error as e:
+        ctx.cancelacion.comprobar()
+        logging.error(f"{ctx.pipeline.error_sql}: {e}")
+        ctx.error = f"{ctx.pipeline.error_sql}: {e}"
+
+
+def exportar(ctx: Contexto):
+    """"exportar <consulta>": extracto completo con COPY (valves EXPORT_*)."""
+    if not ctx.user_message.lower().startswith("exportar"):
+        return
+    sql_query = ctx.user_message[len("exportar"):].lstrip(" :")
+    v = ctx.valves
+    if v.EXPORT_FORMAT != "binary":
+        ctx.respuesta = export_csv_text(ctx.recursos.bd.conectar, sql_query, v.EXPORT_CHUNK_SIZE)
+        return
+    try:
+        ruta = os.path.join(v.EXPORT_DIR, f"export_{int(time.time() * 1000)}.bin")
+        export_to_file(ctx.recursos.bd.conectar, sql_query, ruta, "binary", v.EXPORT_CHUNK_SIZE)
+        ctx.respuesta = f"Exportación binaria guardada en {ruta}"
+    except (psycopg2.Error, OSError) as e:
+        logging.error(f"Export error: {e}")
+        ctx.error = f"Export error: {e}"
+
+
+def sin_resultados(mensaje: str) -> Callable:
+    def sin_resultados(ctx: Contexto):
+        if ctx.filas is not None and not ctx.filas:
+            ctx.respuesta = mensaje
+    return sin_resultados
+
+
+def guardar_aprendizaje(ctx: Contexto):
+    """Guarda el par pregunta→SQL validado y el resultado para los seguimientos de la conversación."""
+    if not ctx.filas:
+        return
+    if ctx.origen_sql in ("llm", "cache"):
+        ctx.recursos.cache_semantica(ctx.valves.SEMANTIC_CACHE_PATH).agregar(ctx.user_message, ctx.sql)
+    # El SQL combinado de varias fuentes no se puede reejecutar tal cual en un seguimiento
+    if ctx.origen_sql not in ("memoria", "fuentes") and ctx.messages:
+        clave = sesiones.clave_conversacion(ctx.body, ctx.messages)
+        ctx.recursos.sesiones.guardar(clave, ctx.sql, ctx.columnas, ctx.filas)
+
+
+# Etapas de resumen y respuesta
+
+def resumir_resultados(ctx: Contexto):
+    """Codifica el resultado como tabla con cabecera dentro del presupuesto de tokens."""
+    if ctx.filas is None:
+        return
+    ctx.resumen = codificar_resultados(ctx.columnas, ctx.filas, ctx.valves.RESULT_FORMAT,
+                                       ctx.valves.RESULT_TOKEN_BUDGET)
+    logging.info(f"Resultados codificados: {len(ctx.filas)} filas, ~{estimar_tokens(ctx.resumen)} tokens")
+
+
+def redactar_respuesta(construir_prompt: Callable, temperatura: float = 0.7) -> Callable:
+    """Convierte los resultados en una respuesta en lenguaje natural."""
+    def redactar_respuesta(ctx: Contexto):
+        prompt = construir_prompt_medido(ctx, construir_prompt)
+
+        def intentar(modelo):
+            eleccion = llamar_llm(ctx, prompt, temperatura, modelo=modelo, max_tokens=ctx.valves.ANSWER_MAX_TOKENS)
+            if eleccion is None:
+                return None
+            respuesta = (eleccion['message']['content'] or "").strip()
+            if modelo != ctx.pipeline.model:
+                if not respuesta:
+                    raise SalidaInvalida("respuesta vacía")
+                if eleccion.get("finish_reason") == "length":
+                    raise SalidaInvalida("la respuesta se cortó al llegar a max_tokens")
+            return respuesta
+
+        try:
+            respuesta = por_niveles(ctx, "respuesta", intentar)
+        except ErrorOllama as e:
+            logging.error(f"Error al generar la respuesta en lenguaje natural: {e}")
+            ctx.error = "Error al generar la respuesta."
+            return
+        if respuesta is None:
+            logging.error("La respuesta no contiene contenido válido.")
+            ctx.error = "Error: La respuesta no contiene contenido válido."
+            return
+        ctx.respuesta = respuesta
+    return redactar_respuesta
+
+
+def responder_lista_tablas(ctx: Contexto):
+    ctx.respuesta = formatear_tablas(ctx.filas)
+
+
+def responder_filas(ctx: Contexto):
+    # Decodificar los resultados para manejar posibles caracteres no válidos
+    ctx.respuesta = str([
+        tuple(val.decode('utf-8', errors='replace') if isinstance(val, bytes) else val for val in row)
+        for row in ctx.filas
+    ])
@@ -0,0 +1,119 @@
+"""Exportación masiva de resultados con COPY ... TO STDOUT, sin pasar por filas de psycopg2."""
+import codecs
+import logging
+import os
+import queue
+import threading
+from typing import Generator
+
+import psycopg2
+
+
+class EscrituraEnCola:
+    """Fichero de solo escritura que agrupa lo que recibe de COPY en bloques y los encola."""
+
+    def __init__(self, cola: queue.Queue, tamano_bloque: int, cancelado: threading.Event):
+        self.cola = cola
+        self.tamano_bloque = tamano_bloque
+        self.cancelado = cancelado
+        self.buffer = bytearray()
+
+    def write(self, datos):
+        self.buffer += datos.encode("utf-8") if isinstance(datos, str) else datos
+        if len(self.buffer) >= self.tamano_bloque:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        bloque, self.buffer = bytes(self.buffer), bytearray()
+        while True:
+            if self.cancelado.is_set():
+                # Al lanzar la excepción dentro de copy_expert se aborta el COPY
+                raise IOError("Exportación cancelada por el cliente")
+            try:
+                self.cola.put(bloque, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+def sentencia_copy(sql_query: str, formato: str) -> str:
+    opciones = "FORMAT binary" if formato == "binary" else "FORMAT csv, HEADER"
+    return f"COPY ({sql_query.strip().rstrip(';')}) TO STDOUT WITH ({opciones})"
+
+
+def export_stream(conectar, sql_query: str, formato: str = "csv", tamano_bloque: int = 1024 * 1024) -> Generator:
+    """Genera el resultado de la consulta en bloques de bytes usando COPY ... TO STDOUT.
+
+    COPY se ejecuta en un hilo aparte, con su propia conexión, que va llenando una cola
+    acotada, de modo que la memoria usada no depende del tamaño del extracto.
+    """
+    cola = queue.Queue(maxsize=8)
+    cancelado = threading.Event()
+    fin = object()
+    errores = []
+
+    def copiar():
+        conn = None
+        try:
+            conn = conectar()
+            cursor = conn.cursor()
+            salida = EscrituraEnCola(cola, tamano_bloque, cancelado)
+            cursor.copy_expert(sentencia_copy(sql_query, formato), salida)
+            salida.flush()
+            cursor.close()
+        except Exception as e:
+            errores.append(e)
+        finally:
+            if conn is not None:
+                conn.close()
+            if not cancelado.is_set():
+                cola.put(fin)
+
+    threading.Thread(target=copiar, daemon=True).start()
+    try:
+        while True:
+            bloque = cola.get()
+            if bloque is fin:
+                break
+            yield bloque
+    finally:
+        # Si el consumidor abandona el generador, se detiene el COPY en curso
+        cancelado.set()
+    if errores:
+        raise errores[0]
+
+
+def export_to_file(conectar, sql_query: str, ruta: str, formato: str = "csv", tamano_bloque: int = 1024 * 1024):
+    """Vuelca el resultado de la consulta directamente en ruta, sin copia intermedia.
+
+    COPY escribe en un fichero aparte que se renombra al terminar, así un fallo a medias no
+    deja un extracto incompleto con el nombre definitivo.
+    """
+    temporal = ruta + ".tmp"
+    conn = conectar()
+    try:
+        with open(temporal, "wb") as fichero:
+            cursor = conn.cursor()
+            cursor.copy_expert(sentencia_copy(sql_query, formato), fichero, size=tamano_bloque)
+            cursor.close()
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    finally:
+        conn.close()
+
+
+def export_csv_text(conectar, sql_query: str, tamano_bloque: int = 1024 * 1024) -> Generator:
+    """Texto CSV para el chat; se decodifica por bloques, no valor a valor."""
+    decodificador = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    try:
+        for bloque in export_stream(conectar, sql_query, "csv", tamano_bloque):
+            yield decodificador.decode(bloque)
+        yield decodificador.decode(b"", final=True)
+    except psycopg2.Error as e:
+        logging.error(f"Database error: {e}")
+        yield f"\nDatabase error: {e}"
@@ -0,0 +1,330 @@
+"""Asesor de índices a partir de las consultas que han ejecutado las pipelines.
+
+Lee el SQL y el tiempo de cada ejecución de las trazas (span sql_ejecucion), extrae los
+filtros y claves de JOIN por tabla, propone índices y estima cuánto se ahorraría con cada
+uno. Con la extensión hypopg se comparan los costes de EXPLAIN con índices hipotéticos;
+sin ella se estima a partir de los Seq Scan del plan actual. Solo informa: los CREATE INDEX
+se aplican a mano.
+
+    python -m nucleo.indices trazas.jsonl --top 10
+"""
+import argparse
+import json
+import logging
+import re
+
+import psycopg2
+
+from nucleo.bd import BaseDatos
+from nucleo.trazas import leer_trazas
+
+
+IDENTIFICADOR = r'"?([A-Za-z_]\w*)"?'
+COLUMNA = rf'(?:{IDENTIFICADOR}\s*\.\s*)?{IDENTIFICADOR}'
+TIPO = (r'(?:double\s+precision|character\s+varying|timestamp\s+with(?:out)?\s+time\s+zone|[A-Za-z_]\w*)'
+        r'(?:\s*\([^)]*\))?(?:\[\])?')
+# Una columna con conversión de tipo o dentro de una función de un solo argumento: lower(region),
+# "periodo"::text, lower("region"::text)
+EXPRESION = (rf'\b([A-Za-z_]\w*)\s*\(\s*(?:{IDENTIFICADOR}\s*\.\s*)?{IDENTIFICADOR}(?:\s*::\s*({TIPO}))?\s*\)'
+             rf'|(?:{IDENTIFICADOR}\s*\.\s*)?{IDENTIFICADOR}\s*::\s*({TIPO})')
+NO_FUNCIONES = {"in", "exists", "any", "all", "some", "values", "not", "and", "or"}
+PALABRAS_RESERVADAS = {
+    "where", "join", "on", "group", "order", "limit", "inner", "left", "right", "full", "cross", "natural",
+    "using", "and", "or", "not", "as", "select", "from", "having", "union", "offset", "lateral", "outer",
+    "null", "true", "false", "case", "when", "then", "else", "end", "is", "in", "between", "like", "ilike",
+}
+MAX_COLUMNAS_INDICE = 3
+MAX_CONSULTAS_POR_CANDIDATO = 20
+
+
+def consultas_de_trazas(trazas: list) -> dict:
+    """{sql: {"ejecuciones", "tiempo_ms"}} de las sentencias SELECT ejecutadas.
+
+    Incluye las de las plantillas y las resueltas en las instantáneas locales (servidor
+    "local"): sin instantánea irían a PostgreSQL con la misma forma.
+    """
+    consultas = {}
+    for traza in trazas:
+        for span in traza.get("spans", []):
+            if not span["nombre"].endswith("sql_ejecucion") or "error" in span:
+                continue
+            sql = (span.get("atributos") or {}).get("sql")
+            if not sql or not sql.lstrip().lower().startswith(("select", "with")):
+                continue
+            sql = sql.strip().rstrip(";")
+            datos = consultas.setdefault(sql, {"ejecuciones": 0, "tiempo_ms": 0.0})
+            datos["ejecuciones"] += 1
+            datos["tiempo_ms"] += span.get("duracion_ms", 0.0)
+    return consultas
+
+
+def predicados(sql: str, esquema: dict = None) -> list:
+    """Columnas filtradas o usadas para unir en la consulta: [(tabla, columna, tipo)].
+
+    tipo es "igualdad", "rango" o "join". Las columnas sin alias se asignan a la única
+    tabla de la consulta o, con el esquema, a la tabla que tiene esa columna. Una columna
+    convertida de tipo o dentro de una función (lower(region)) solo aprovecha un índice
+    sobre esa misma expresión: se devuelve la expresión en lugar de la columna.
+    """
+    # Los literales se sustituyen para que no se confundan con identificadores
+    # La conversión de un literal no cambia el índice que sirve: '2023'::int es un literal más
+    texto = re.sub(r"'(?:[^']|'')*'", " ?lit ", sql)
+    texto = re.sub(rf"\?lit\s*::\s*{TIPO}", "?lit", texto)
+
+    # Cada expresión se cambia por un identificador (__expr_N) que se resuelve al final
+    expresiones = []
+
+    def sustituir(m):
+        funcion, prefijo, columna, tipo = m.group(1), m.group(2), m.group(3), m.group(4)
+        if funcion is None:
+            prefijo, columna, tipo = m.group(5), m.group(6), m.group(7)
+        elif funcion.lower() in NO_FUNCIONES | PALABRAS_RESERVADAS:
+            return m.group(0)
+        expresion = f'"{columna}"'
+        if tipo:
+            expresion += "::" + " ".join(tipo.lower().split())
+        if funcion:
+            expresion = f"{funcion.lower()}({expresion})"
+        expresiones.append((prefijo, columna, expresion))
+        return f" __expr_{len(expresiones) - 1} "
+
+    texto = re.sub(EXPRESION, sustituir, texto)
+    texto = re.sub(r"(?<![\w.])\d+(?:\.\d+)?", " ?lit ", texto)
+    texto = re.sub(rf"\?lit\s*::\s*{TIPO}", "?lit", texto)
+
+    alias = {}
+    # La primera captura es el esquema (public.), que no interesa
+    for _, tabla, nombre in re.findall(rf'\b(?:from|join)\s+(?:{IDENTIFICADOR}\s*\.\s*)?{IDENTIFICADOR}'
+                                       rf'(?:\s+(?:as\s+)?{IDENTIFICADOR})?', texto, re.IGNORECASE):
+        if tabla.lower() in PALABRAS_RESERVADAS:
+            continue
+        alias[tabla] = tabla
+        if nombre and nombre.lower() not in PALABRAS_RESERVADAS:
+            alias[nombre] = tabla
+    tablas = set(alias.values())
+
+    def resolver(prefijo, columna):
+        if prefijo:
+            return alias.get(prefijo)
+        if len(tablas) == 1:
+            return next(iter(tablas))
+        candidatas = [t for t in tablas if esquema and columna in esquema.get(t, [])]
+        return candidatas[0] if len(candidatas) == 1 else None
+
+    encontrados = []
+
+    def agregar(prefijo, columna, tipo):
+        if columna.lower() in PALABRAS_RESERVADAS or columna == "lit":
+            return
+        indexado = columna
+        if columna.startswith("__expr_"):
+            prefijo, columna, indexado = expresiones[int(columna[len("__expr_"):])]
+        tabla = resolver(prefijo, columna)
+        if tabla and (tabla, indexado, tipo) not in encontrados:
+            encontrados.append((tabla, indexado, tipo))
+
+    for p1, c1, p2, c2 in re.findall(rf'{COLUMNA}\s*=\s*{COLUMNA}', texto):
+        if c1 != "lit" and c2 != "lit" and "lit" not in (p1, p2):
+            agregar(p1, c1, "join")
+            agregar(p2, c2, "join")
+    for p, c in re.findall(rf'{COLUMNA}\s*(?:=\s*\?lit|\bin\s*\(\s*\?lit)', texto, re.IGNORECASE):
+        agregar(p, c, "igualdad")
+    for p, c in re.findall(rf'{COLUMNA}\s*(?:<=|>=|<|>|\bbetween\b|\blike\s*\?lit)', texto, re.IGNORECASE):
+        agregar(p, c, "rango")
+    return encontrados
+
+
+def candidatos(consultas: dict, esquema: dict = None) -> dict:
+    """Índices propuestos por las consultas: {(tabla, columnas): {"ejecuciones", "tiempo_ms", "consultas"}}.
+
+    Por tabla y consulta se propone un índice compuesto con las columnas de igualdad
+    seguidas de una de rango, y uno por cada clave de JOIN.
+    """
+    resultado = {}
+    for sql, datos in consultas.items():
+        por_tabla = {}
+        for tabla, columna, tipo in predicados(sql, esquema):
+            por_tabla.setdefault(tabla, {"igualdad": [], "rango": [], "join": []})[tipo].append(columna)
+        propuestas = set()
+        for tabla, tipos in por_tabla.items():
+            compuesto = tipos["igualdad"] + [c for c in tipos["rango"] if c not in tipos["igualdad"]][:1]
+            if compuesto:
+                propuestas.add((tabla, tuple(compuesto[:MAX_COLUMNAS_INDICE])))
+            for columna in tipos["join"]:
+                propuestas.add((tabla, (columna,)))
+        for clave in propuestas:
+            candidato = resultado.setdefault(clave, {"ejecuciones": 0, "tiempo_ms": 0.0, "consultas": {}})
+            candidato["ejecuciones"] += datos["ejecuciones"]
+            candidato["tiempo_ms"] += datos["tiempo_ms"]
+            candidato["consultas"][sql] = datos
+    return resultado
+
+
+def indices_existentes(cursor) -> dict:
+    """{tabla: [columnas de cada índice]} de pg_indexes."""
+    cursor.execute("SELECT tablename, indexdef FROM pg_indexes WHERE schemaname = 'public';")
+    existentes = {}
+    for tabla, definicion in cursor.fetchall():
+        columnas = re.search(r"\((.*)\)", definicion)
+        if columnas:
+            existentes.setdefault(tabla, []).append(
+                tuple(c.strip().strip('"').split()[0] for c in columnas.group(1).split(",")))
+    return existentes
+
+
+def cubierto(columnas: tuple, existentes: list) -> bool:
+    """Algún índice existente empieza por esas mismas columnas."""
+    return any(indice[:len(columnas)] == columnas for indice in existentes)
+
+
+def sentencia_indice(tabla: str, columnas: tuple) -> str:
+    """CREATE INDEX de las columnas; las expresiones (lower("region")) van entre paréntesis."""
+    nombre = f"idx_{tabla}_" + "_".join(re.sub(r"\W+", "_", c).strip("_") for c in columnas)
+    nombre = nombre[:63]
+    lista = ", ".join(f"({c})" if "(" in c or "::" in c else f'"{c}"' for c in columnas)
+    return f'CREATE INDEX CONCURRENTLY {nombre} ON "{tabla}" ({lista});'
+
+
+def _coste(cursor, sql: str):
+    """Plan de EXPLAIN (sin ejecutar la consulta); None si PostgreSQL no puede planificarla."""
+    try:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+        return cursor.fetchone()[0][0]["Plan"]
+    except psycopg2.Error as e:
+        cursor.connection.rollback()
+        logging.debug(f"No se pudo planificar la consulta: {e}")
+        return None
+
+
+def _nodos(plan: dict) -> list:
+    return [plan] + [n for hijo in plan.get("Plans", []) for n in _nodos(hijo)]
+
+
+def _seq_scans(plan: dict, tabla: str) -> list:
+    return [n for n in _nodos(plan) if n.get("Node Type") == "Seq Scan" and n.get("Relation Name") == tabla]
+
+
+def evaluar(propuestos: dict, cursor) -> list:
+    """Ahorro estimado de cada índice propuesto que no esté ya cubierto por uno existente.
+
+    Con hypopg: ahorro = tiempo de cada consulta × (1 - coste con el índice / coste actual).
+    Sin hypopg: para las consultas que hoy hacen Seq Scan de la tabla, su tiempo por la
+    fracción de filas que el filtro descarta según el plan.
+    """
+    existentes = indices_existentes(cursor)
+    cursor.execute("SELECT count(*) FROM pg_extension WHERE extname = 'hypopg';")
+    hypopg = cursor.fetchone()[0] > 0
+    cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r';")
+    filas_tabla = dict(cursor.fetchall())
+
+    planes_actuales = {}  # {sql: plan sin índices hipotéticos}
+
+    def plan_actual(sql):
+        if sql not in planes_actuales:
+            planes_actuales[sql] = _coste(cursor, sql)
+        return planes_actuales[sql]
+
+    informe = []
+    for (tabla, columnas), datos in propuestos.items():
+        if cubierto(columnas, existentes.get(tabla, [])):
+            continue
+        consultas = sorted(datos["consultas"].items(), key=lambda x: -x[1]["tiempo_ms"])[:MAX_CONSULTAS_POR_CANDIDATO]
+        # Los planes actuales se calculan antes de crear el índice hipotético
+        actuales = [(sql, medidas, plan_actual(sql)) for sql, medidas in consultas]
+        actuales = [(sql, medidas, plan) for sql, medidas, plan in actuales if plan]
+        ahorro, coste_antes, coste_despues = 0.0, 0.0, 0.0
+        if hypopg:
+            try:
+                cursor.execute("SELECT * FROM hypopg_create_index(%s);",
+                               (sentencia_indice(tabla, columnas).replace(" CONCURRENTLY", ""),))
+            except psycopg2.Error as e:
+                cursor.connection.rollback()
+                logging.error(f"Error al crear el índice hipotético en {tabla}: {e}")
+                continue
+            try:
+                for sql, medidas, antes in actuales:
+                    despues = _coste(cursor, sql)
+                    if not despues:
+                        continue
+                    coste_antes += antes["Total Cost"]
+                    coste_despues += despues["Total Cost"]
+                    ahorro += medidas["tiempo_ms"] * max(0.0, 1 - despues["Total Cost"] / max(antes["Total Cost"], 1e-9))
+            finally:
+                cursor.execute("SELECT hypopg_reset();")
+        else:
+            for sql, medidas, antes in actuales:
+                coste_antes += antes["Total Cost"]
+                for nodo in _seq_scans(antes, tabla)[:1]:
+                    total = max(filas_tabla.get(tabla) or 0, 1)
+                    ahorro += medidas["tiempo_ms"] * max(0.0, 1 - nodo.get("Plan Rows", total) / total)
+        informe.append({
+            "tabla": tabla,
+            "columnas": list(columnas),
+            "sentencia": sentencia_indice(tabla, columnas),
+            "ejecuciones": datos["ejecuciones"],
+            "consultas": len(datos["consultas"]),
+            "tiempo_ms": round(datos["tiempo_ms"], 1),
+            "coste_antes": round(coste_antes, 1) if coste_antes else None,
+            "coste_despues": round(coste_despues, 1) if hypopg else None,
+            "ahorro_estimado_ms": round(ahorro, 1),
+            "metodo": "hypopg" if hypopg else "seq scan",
+        })
+    return sorted(informe, key=lambda r: -r["ahorro_estimado_ms"])
+
+
+def sin_bd(propuestos: dict) -> list:
+    """Sin conexión: se ordena por el tiempo total de las consultas que usarían cada índice."""
+    return sorted(({
+        "tabla": tabla,
+        "columnas": list(columnas),
+        "sentencia": sentencia_indice(tabla, columnas),
+        "ejecuciones": datos["ejecuciones"],
+        "consultas": len(datos["consultas"]),
+        "tiempo_ms": round(datos["tiempo_ms"], 1),
+        "ahorro_estimado_ms": None,
+        "metodo": "sin evaluar",
+    } for (tabla, columnas), datos in propuestos.items()), key=lambda r: -r["tiempo_ms"])
+
+
+def texto_informe(informe: list, consultas: dict, top: int) -> str:
+    lineas = [f"{sum(c['ejecuciones'] for c in consultas.values())} ejecuciones de {len(consultas)} consultas distintas; "
+              f"{len(informe)} índices propuestos", ""]
+    for i, r in enumerate(informe[:top], 1):
+        ahorro = f"{r['ahorro_estimado_ms']:.0f} ms" if r["ahorro_estimado_ms"] is not None else "-"
+        costes = ""
+        if r.get("coste_despues") is not None:
+            costes = f", coste {r['coste_antes']:.0f} → {r['coste_despues']:.0f}"
+        lineas.append(f"{i:>3}. ahorro estimado {ahorro} ({r['metodo']}{costes}); "
+                      f"{r['ejecuciones']} ejecuciones, {r['tiempo_ms']:.0f} ms en total")
+        lineas.append(f"     {r['sentencia']}")
+    lineas += ["", "Los índices no se crean automáticamente: revisa cada sentencia antes de aplicarla."]
+    return "\n".join(lineas)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Índices sugeridos a partir de las consultas ejecutadas")
+    parser.add_argument("fichero", nargs="?", default="trazas.jsonl")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--sin-bd", action="store_true", help="No conectar a PostgreSQL (PG_* del entorno)")
+    parser.add_argument("--json", help="Fichero donde guardar el informe completo")
+    args = parser.parse_args()
+
+    ejecutadas = consultas_de_trazas(leer_trazas(args.fichero))
+    if args.sin_bd:
+        resultado = sin_bd(candidatos(ejecutadas))
+    else:
+        bd = BaseDatos.desde_entorno(max_conexiones=1)
+        esquema_bd = bd.get_db_schema()
+        bd.cerrar()
+        conn = bd.conectar()
+        try:
+            cursor = conn.cursor()
+            resultado = evaluar(candidatos(ejecutadas, esquema_bd), cursor)
+            cursor.close()
+        finally:
+            conn.rollback()
+            conn.close()
+    print(texto_informe(resultado, ejecutadas, args.top))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,160 @@
+"""Instantáneas locales en Parquet de las tablas más consultadas, servidas con DuckDB.
+
+DuckDB se configura para dar lo mismo que PostgreSQL donde difieren por defecto: división
+entera truncada (5/2 = 2), NULL al final en orden ascendente y al principio en descendente,
+y numeric(p,s) como DECIMAL(p,s). Diferencias conocidas que quedan:
+
+- numeric sin precisión (o con más de 38 dígitos) se guarda como DOUBLE y pierde exactitud.
+- Las columnas integer y smallint pasan a BIGINT: donde PostgreSQL da error por desbordamiento,
+  DuckDB devuelve el resultado.
+- Los textos se comparan y ordenan por bytes, no con la collation de la base de datos.
+- timestamptz se muestra en la zona horaria de DuckDB, no en la de la sesión de PostgreSQL.
+- Las columnas calculadas sin alias se llaman distinto ("(anio // 2)" en vez de "?column?").
+"""
+import fnmatch
+import logging
+import os
+import re
+import threading
+from contextlib import nullcontext
+from typing import List
+
+import psycopg2
+
+from nucleo.cancelacion import Cancelacion
+from nucleo.trazas import Traza
+
+try:
+    import duckdb  # Opcional: motor local para las instantáneas en Parquet
+except ImportError:
+    duckdb = None
+
+
+# Equivalencia de tipos de PostgreSQL a DuckDB al volcar las tablas a Parquet
+TIPOS_DUCKDB = {
+    "smallint": "BIGINT", "integer": "BIGINT", "bigint": "BIGINT",
+    "numeric": "DOUBLE", "real": "FLOAT", "double precision": "DOUBLE",
+    "boolean": "BOOLEAN", "date": "DATE",
+    "timestamp without time zone": "TIMESTAMP", "timestamp with time zone": "TIMESTAMPTZ",
+}
+# Ajustes de DuckDB para que las consultas den lo mismo que en PostgreSQL. GLOBAL porque cada
+# cursor de DuckDB abre su propia sesión
+AJUSTES_DUCKDB = [
+    "SET GLOBAL integer_division = true",
+    "SET GLOBAL default_null_order = 'nulls_last_on_asc_first_on_desc'",
+]
+
+
+def tipo_duckdb(tipo: str, precision: int = None, escala: int = None) -> str:
+    """Tipo de DuckDB para una columna de PostgreSQL; numeric(p,s) se conserva exacto como DECIMAL(p,s)."""
+    if tipo == "numeric" and precision and precision <= 38:
+        return f"DECIMAL({precision},{escala or 0})"
+    return TIPOS_DUCKDB.get(tipo, "VARCHAR")
+
+
+class MotorInstantaneas:
+    """Ejecuta SELECTs en local sobre instantáneas Parquet de las tablas más consultadas.
+
+    Las tablas se vuelcan desde PostgreSQL con COPY y se consultan con DuckDB, que lee
+    los ficheros Parquet por columnas sin cargarlos enteros en memoria. Una tabla solo se
+    vuelve a volcar cuando sus contadores en pg_stat_user_tables han cambiado.
+    """
+
+    def __init__(self, directorio: str, patrones: List[str], connect):
+        self.directorio = directorio
+        self.patrones = patrones
+        self.connect = connect
+        self.tablas = {}  # {tabla: firma de cambios en el momento del volcado}
+        self.duck = duckdb.connect(database=":memory:")
+        for ajuste in AJUSTES_DUCKDB:
+            self.duck.execute(ajuste)
+        self.lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+
+    def ruta(self, tabla: str) -> str:
+        return os.path.join(self.directorio, f"{tabla}.parquet")
+
+    def refrescar(self):
+        """Vuelca las tablas seleccionadas que hayan cambiado desde el último volcado."""
+        try:
+            conn = self.connect()
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT relname, n_tup_ins, n_tup_upd, n_tup_del
+                FROM pg_stat_user_tables
+                WHERE schemaname = 'public';
+            """)
+            firmas = {tabla: tuple(contadores) for tabla, *contadores in cursor.fetchall()
+                      if any(fnmatch.fnmatch(tabla, p) for p in self.patrones)}
+
+            for tabla, firma in firmas.items():
+                if self.tablas.get(tabla) == firma and os.path.exists(self.ruta(tabla)):
+                    continue
+                self.volcar(cursor, tabla)
+                self.tablas[tabla] = firma
+
+            for tabla in set(self.tablas) - set(firmas):
+                self.tablas.pop(tabla)
+                with self.lock:
+                    self.duck.execute(f'DROP VIEW IF EXISTS "{tabla}"')
+
+            cursor.close()
+            conn.close()
+        except (psycopg2.Error, duckdb.Error, OSError) as e:
+            logging.error(f"Error al refrescar las instantáneas: {e}")
+
+    def volcar(self, cursor, tabla: str):
+        cursor.execute("""
+            SELECT column_name, data_type, numeric_precision, numeric_scale
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s
+            ORDER BY ordinal_position;
+        """, (tabla,))
+        columnas = {col: tipo_duckdb(tipo, precision, escala) for col, tipo, precision, escala in cursor.fetchall()}
+
+        csv_temporal = self.ruta(tabla) + ".csv"
+        parquet_temporal = self.ruta(tabla) + ".tmp"
+        with open(csv_temporal, "w", encoding="utf-8") as f:
+            cursor.copy_expert(f'COPY "{tabla}" TO STDOUT WITH CSV HEADER', f)
+
+        with self.lock:
+            self.duck.execute(
+                f"COPY (SELECT * FROM read_csv(?, header = true, columns = ?)) "
+                f"TO '{parquet_temporal}' (FORMAT PARQUET)",
+                [csv_temporal, columnas],
+            )
+            os.replace(parquet_temporal, self.ruta(tabla))
+            self.duck.execute(
+                f"""CREATE OR REPLACE VIEW "{tabla}" AS SELECT * FROM read_parquet('{self.ruta(tabla)}')"""
+            )
+        os.remove(csv_temporal)
+        logging.info(f"Instantánea actualizada: {tabla}")
+
+    def ejecutar(self, sql_query: str, cancelacion: Cancelacion = None, traza: Traza = None, origen: str = None):
+        """Devuelve (columnas, filas) si la consulta se puede resolver en local; si no, None.
+
+        Si se cancela la petición se interrumpe la consulta de DuckDB y se lanza Cancelado.
+        """
+        if not sql_query.lstrip().lower().startswith(("select", "with")):
+            return None
+        referenciadas = {
+            nombre.split(".")[-1].strip('"').lower()
+            for nombre in re.findall(r'\b(?:from|join)\s+((?:"?\w+"?\.)?"?\w+"?)', sql_query, re.IGNORECASE)
+        }
+        if not referenciadas or not referenciadas <= set(self.tablas):
+            return None
+        try:
+            cursor = self.duck.cursor()
+            with cancelacion.propagar(cursor.interrupt) if cancelacion else nullcontext():
+                with traza.ejecucion_sql(sql_query, origen, "local") if traza else nullcontext():
+                    cursor.execute(sql_query)
+                filas = cursor.fetchall()
+            columnas = [d[0] for d in cursor.description] if cursor.description else []
+            cursor.close()
+            return columnas, filas
+        except duckdb.Error as e:
+            if cancelacion:
+                cancelacion.comprobar()
+            # Diferencias de dialecto: la consulta se envía a PostgreSQL
+            logging.info(f"La consulta no se pudo resolver en local, se usa PostgreSQL: {e}")
+            return None
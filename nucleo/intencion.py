@@ -0,0 +1,108 @@
+"""Clasificador local de intención y constantes asociadas."""
+import math
+import re
+
+from nucleo.texto import normalizar_texto
+
+
+INTENCION_TABLAS = "listado_tablas"
+INTENCION_COLUMNAS = "listado_columnas"
+INTENCION_DATOS = "pregunta_datos"
+
+# Frases de ejemplo con las que se entrena el clasificador bayesiano al arrancar
+EJEMPLOS_INTENCION = [
+    ("busca las tablas relacionadas con nacimientos", INTENCION_TABLAS),
+    ("quiero las tablas relacionadas con platanos", INTENCION_TABLAS),
+    ("las tablas sobre parados", INTENCION_TABLAS),
+    ("mostrar tablas que contengan defunciones", INTENCION_TABLAS),
+    ("que tablas hay de turismo", INTENCION_TABLAS),
+    ("dime que tablas tienes del istac", INTENCION_TABLAS),
+    ("listado de tablas del ine", INTENCION_TABLAS),
+    ("en que tabla estan los datos de poblacion", INTENCION_TABLAS),
+    ("donde estan los datos de turismo", INTENCION_TABLAS),
+    ("que columnas tiene la tabla ine_1_3_nacimientos", INTENCION_COLUMNAS),
+    ("muestra los campos de la tabla de defunciones", INTENCION_COLUMNAS),
+    ("columnas de istac_paro", INTENCION_COLUMNAS),
+    ("que variables tiene la tabla de nacimientos", INTENCION_COLUMNAS),
+    ("estructura de la tabla de turistas", INTENCION_COLUMNAS),
+    ("cuantos nacimientos hubieron en aragon en 2023 segun el ine", INTENCION_DATOS),
+    ("cuantos nacimientos de hombres hubieron en 2023 segun el ine", INTENCION_DATOS),
+    ("cual fue la tasa de paro en canarias el ultimo trimestre", INTENCION_DATOS),
+    ("numero de defunciones de mujeres en 2022", INTENCION_DATOS),
+    ("evolucion de la poblacion de tenerife desde 2015", INTENCION_DATOS),
+    ("media de turistas por mes en 2023 segun el istac", INTENCION_DATOS),
+    ("que municipio tuvo mas nacimientos en 2021", INTENCION_DATOS),
+]
+
+# Palabras que sirven para reconocer la intención pero no para buscar tablas
+PALABRAS_CATALOGO = {
+    "a", "al", "base", "busca", "buscar", "campos", "columna", "columnas", "con", "contengan",
+    "contenga", "contiene", "cual", "cuales", "cuantas", "cuantos", "dame", "datos", "de", "del", "dime",
+    "donde", "el", "en", "esta", "estan", "estructura", "hay", "la", "las", "lista", "listado", "listar", "los",
+    "mostrar", "muestra", "muestrame", "para", "por", "que", "quiero", "relacionada",
+    "relacionadas", "relacionados", "sobre", "tabla", "tablas", "tiene", "tienes", "un",
+    "una", "variables", "ver", "y",
+}
+
+
+class ClasificadorIntencion:
+    """Clasifica la petición en listado de tablas, listado de columnas o pregunta de datos.
+
+    Primero se aplican reglas y, si no deciden, un Naive Bayes multinomial entrenado con
+    EJEMPLOS_INTENCION. Todo es local y tarda microsegundos.
+    """
+
+    def __init__(self, ejemplos: list = EJEMPLOS_INTENCION, umbral: float = 0.8):
+        self.umbral = umbral
+        self.clases = sorted({clase for _, clase in ejemplos})
+        self.conteos = {clase: {} for clase in self.clases}
+        self.totales = {clase: 0 for clase in self.clases}
+        self.previas = {}
+        for frase, clase in ejemplos:
+            for palabra in normalizar_texto(frase).split():
+                self.conteos[clase][palabra] = self.conteos[clase].get(palabra, 0) + 1
+                self.totales[clase] += 1
+        self.vocabulario = {p for conteo in self.conteos.values() for p in conteo}
+        for clase in self.clases:
+            self.previas[clase] = math.log(sum(1 for _, c in ejemplos if c == clase) / len(ejemplos))
+
+    def probabilidades(self, palabras: list) -> dict:
+        puntuaciones = {}
+        for clase in self.clases:
+            denominador = self.totales[clase] + len(self.vocabulario)
+            puntuaciones[clase] = self.previas[clase] + sum(
+                math.log((self.conteos[clase].get(p, 0) + 1) / denominador)
+                for p in palabras if p in self.vocabulario
+            )
+        maximo = max(puntuaciones.values())
+        exponenciales = {c: math.exp(v - maximo) for c, v in puntuaciones.items()}
+        total = sum(exponenciales.values())
+        return {c: v / total for c, v in exponenciales.items()}
+
+    def clasificar(self, mensaje: str) -> tuple:
+        """Devuelve (intención, confianza, términos de búsqueda)."""
+        texto = normalizar_texto(mensaje)
+        palabras = texto.split()
+        # Los años describen el periodo de los datos, no el nombre de la tabla
+        terminos = [p for p in palabras if p not in PALABRAS_CATALOGO and len(p) > 1
+                    and not re.fullmatch(r"(19|20)\d{2}", p)]
+        if re.search(r"\b(datos|registros|filas|contenido)\b.*\btabla\s+\w+_\w+", texto):
+            return INTENCION_DATOS, 1.0, terminos
+        # Las reglas de catálogo van antes que la de datos ("cuántas tablas hay del ine"), pero
+        # solo si nada pide datos o se nombra una tabla: "dame los campos y valores de paro en
+        # 2023" es una pregunta de datos
+        pide_datos = re.search(r"\b((19|20)\d{2}|media|promedio|suma|(?<!en )total|evolucion|tasa|numero|valor|valores)\b",
+                               texto)
+        if not pide_datos or re.search(r"\b[a-z]+_\w+", texto):
+            if re.search(r"\b(columnas?|campos|variables|estructura)\b", texto):
+                return INTENCION_COLUMNAS, 1.0, terminos
+            if re.search(r"\btablas\b", texto):
+                return INTENCION_TABLAS, 1.0, terminos
+        if re.search(r"\b(cuant[oa]s?|(19|20)\d{2}|media|total|evolucion|tasa|numero)\b", texto):
+            return INTENCION_DATOS, 1.0, terminos
+
+        probabilidades = self.probabilidades(palabras)
+        intencion = max(probabilidades, key=probabilidades.get)
+        if intencion != INTENCION_DATOS and probabilidades[intencion] < self.umbral:
+            intencion = INTENCION_DATOS
+        return intencion, probabilidades[intencion], terminos
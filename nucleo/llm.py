@@ -0,0 +1,377 @@
+"""Cliente de Ollama compartido: enrutado entre instancias, reintentos, cobertura y cortacircuitos."""
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, ContextManager, List
+
+import aiohttp
+
+from nucleo.cancelacion import Cancelacion
+
+
+class BackendOllama:
+    """Estado de una instancia de Ollama vista por el enrutador."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.en_curso = 0
+        self.latencia = None  # Media móvil exponencial en segundos
+        self.fallos_seguidos = 0
+        self.excluido_hasta = 0.0
+        self.modelos = set()  # Modelos cargados en memoria según /api/ps
+        self.modelos_actualizados = 0.0
+
+    @property
+    def url_chat(self) -> str:
+        return f"{self.base_url}/v1/chat/completions"
+
+    def tiene_modelo(self, modelo: str) -> bool:
+        return any(m == modelo or m.split(":")[0] == modelo for m in self.modelos)
+
+
+class EnrutadorOllama:
+    """Reparte las peticiones entre varias instancias de Ollama.
+
+    Elige la instancia sana con menos peticiones en curso (y, a igualdad, menor latencia
+    reciente), prefiriendo las que ya tienen el modelo cargado. Las que fallan varias veces
+    seguidas quedan excluidas un tiempo sin necesidad de sondearlas.
+    """
+
+    def __init__(self, urls: List[str], max_fallos: int = 3, exclusion: float = 30.0,
+                 refresco_modelos: float = 30.0, max_desequilibrio: int = 4):
+        self.backends = [BackendOllama(url) for url in urls]
+        self.max_fallos = max_fallos
+        self.max_desequilibrio = max_desequilibrio
+        self.exclusion = exclusion
+        self.refresco_modelos = refresco_modelos
+
+    def elegir(self, modelo: str) -> BackendOllama:
+        ahora = time.monotonic()
+        sanos = [b for b in self.backends if b.excluido_hasta <= ahora] or self.backends
+        candidatos = [b for b in sanos if b.tiene_modelo(modelo)] or sanos
+        # Si las instancias con el modelo cargado están muy saturadas, compensa cargarlo en otra
+        if min(b.en_curso for b in candidatos) - min(b.en_curso for b in sanos) > self.max_desequilibrio:
+            candidatos = sanos
+        return min(candidatos, key=lambda b: (b.en_curso, b.latencia or 0.0))
+
+    def registrar(self, backend: BackendOllama, exito: bool, latencia: float = None):
+        if exito:
+            backend.fallos_seguidos = 0
+            backend.latencia = latencia if backend.latencia is None else 0.8 * backend.latencia + 0.2 * latencia
+            return
+        backend.fallos_seguidos += 1
+        if backend.fallos_seguidos >= self.max_fallos:
+            backend.excluido_hasta = time.monotonic() + self.exclusion
+            logging.error(f"Backend de Ollama {backend.base_url} excluido durante {self.exclusion} s")
+
+    async def actualizar_modelos(self, session):
+        """Consulta qué modelos tiene cargados cada instancia que no se haya revisado hace poco."""
+        ahora = time.monotonic()
+        for backend in self.backends:
+            if ahora - backend.modelos_actualizados < self.refresco_modelos:
+                continue
+            backend.modelos_actualizados = ahora
+            try:
+                async with session.get(f"{backend.base_url}/api/ps", timeout=aiohttp.ClientTimeout(total=2)) as response:
+                    response.raise_for_status()
+                    datos = await response.json(content_type=None)
+                backend.modelos = {m.get("name", "") for m in datos.get("models", [])}
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logging.debug(f"No se pudieron consultar los modelos de {backend.base_url}: {e!r}")
+
+    def estadisticas(self) -> list:
+        return [
+            {"url": b.base_url, "en_curso": b.en_curso, "latencia": b.latencia,
+             "excluido": b.excluido_hasta > time.monotonic(), "modelos": sorted(b.modelos)}
+            for b in self.backends
+        ]
+
+
+class ErrorOllama(Exception):
+    """Fallo definitivo de una llamada al LLM tras agotar reintentos o plazo."""
+
+
+class CircuitoAbierto(ErrorOllama):
+    """Ollama ha fallado demasiadas veces seguidas y las llamadas se rechazan sin intentarlo."""
+
+
+class ClienteOllama:
+    """Cliente de la API de chat de Ollama con plazo por llamada, reintentos y cortacircuitos.
+
+    Las peticiones se hacen con aiohttp en un bucle de eventos propio que corre en un hilo,
+    con una única ClientSession reutilizada. Así los métodos síncronos de la pipeline pueden
+    llamarlo y las peticiones duplicadas (cobertura) se pueden cancelar de verdad. Cada
+    intento se envía a la instancia de Ollama que elija el enrutador.
+    """
+
+    def __init__(self, urls: List[str], headers: dict, timeout: float, retries: int, hedge: bool,
+                 breaker_failures: int, breaker_reset: float):
+        self.enrutador = EnrutadorOllama(urls)
+        self.headers = headers
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+
+        self.latencias = deque(maxlen=200)
+        self.fallos_seguidos = 0
+        self.abierto_hasta = 0.0
+        self.probando = False
+        self.coberturas_lanzadas = 0
+        self.coberturas_ganadas = 0
+        self.lock = threading.Lock()
+
+        # Peticiones idénticas en curso: {hash del payload: {"tarea", "esperando"}}
+        self.en_vuelo = {}
+        self.llamadas = 0
+        self.llamadas_ahorradas = 0
+
+        self.session = None
+        self.refresco_modelos = None
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def chat(self, payload: dict, timeout: float = None, cancelacion: Cancelacion = None,
+             turno: Callable[[], ContextManager] = None) -> dict:
+        """Envía el payload y devuelve el JSON de la respuesta. Lanza ErrorOllama si falla.
+
+        Si se cancela la petición se cancela la tarea, lo que cierra la conexión con Ollama
+        (que deja de generar) y lanza Cancelado.
+
+        turno() es el hueco del planificador. Solo lo pide la llamada que va a Ollama: una
+        idéntica a otra en curso espera su respuesta sin ocupar hueco.
+        """
+        timeout = timeout or self.timeout
+        if turno is None:
+            return self._esperar(self._compartida(payload, timeout), cancelacion)
+        while True:
+            datos = self._esperar(self._compartida(payload, timeout, crear=False), cancelacion)
+            if datos is not None:
+                return datos
+            with turno():
+                datos = self._esperar(self._compartida(payload, timeout, unirse=False), cancelacion)
+            if datos is not None:
+                return datos
+            # Mientras esperaba turno salió otra idéntica: devuelve el hueco y espera a esa
+
+
+    def _esperar(self, corrutina, cancelacion: Cancelacion = None):
+        futuro = asyncio.run_coroutine_threadsafe(corrutina, self.loop)
+        try:
+            if cancelacion is None:
+                return futuro.result()
+            with cancelacion.propagar(futuro.cancel):
+                try:
+                    return futuro.result()
+                except concurrent.futures.CancelledError:
+                    cancelacion.comprobar()
+                    raise
+        except BaseException:
+            futuro.cancel()
+            raise
+
+    def close(self):
+        async def cerrar():
+            if self.session is not None:
+                await self.session.close()
+        asyncio.run_coroutine_threadsafe(cerrar(), self.loop).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def estadisticas(self) -> dict:
+        return {
+            "llamadas": self.llamadas,
+            "llamadas_ahorradas": self.llamadas_ahorradas,
+            "en_vuelo": len(self.en_vuelo),
+            "coberturas_lanzadas": self.coberturas_lanzadas,
+            "coberturas_ganadas": self.coberturas_ganadas,
+            "backends": self.enrutador.estadisticas(),
+        }
+
+    def retardo_cobertura(self) -> float:
+        """p95 de las latencias recientes; hasta tener muestras suficientes, medio plazo."""
+        if len(self.latencias) < 20:
+            return self.timeout / 2
+        ordenadas = sorted(self.latencias)
+        return ordenadas[int(len(ordenadas) * 0.95) - 1]
+
+    def _comprobar_circuito(self) -> bool:
+        """Lanza CircuitoAbierto si no se puede llamar; devuelve True si es la llamada de prueba."""
+        with self.lock:
+            if self.fallos_seguidos < self.breaker_failures:
+                return False
+            if time.monotonic() < self.abierto_hasta or self.probando:
+                raise CircuitoAbierto("Ollama no está disponible; se reintentará más tarde.")
+            # Semiabierto: se deja pasar una sola llamada de prueba
+            self.probando = True
+            return True
+
+    def _registrar(self, exito: bool):
+        with self.lock:
+            self.probando = False
+            if exito:
+                self.fallos_seguidos = 0
+                return
+            self.fallos_seguidos += 1
+            if self.fallos_seguidos >= self.breaker_failures:
+                self.abierto_hasta = time.monotonic() + self.breaker_reset
+                logging.error(f"Cortacircuitos de Ollama abierto durante {self.breaker_reset} s")
+
+    @staticmethod
+    def _reintentable(e: BaseException) -> bool:
+        if isinstance(e, aiohttp.ClientResponseError):
+            return e.status >= 500 or e.status == 429
+        return isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+    async def _intento(self, payload: dict) -> dict:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(headers=self.headers)
+        if self.refresco_modelos is None or self.refresco_modelos.done():
+            # Se consulta en segundo plano para no retrasar la petición
+            self.refresco_modelos = asyncio.ensure_future(self.enrutador.actualizar_modelos(self.session))
+
+        backend = self.enrutador.elegir(payload.get("model"))
+        backend.en_curso += 1
+        inicio = time.monotonic()
+        try:
+            cuerpo = dict(payload, stream=True, stream_options={"include_usage": True})
+            async with self.session.post(backend.url_chat, json=cuerpo) as response:
+                response.raise_for_status()
+                datos = await self._leer_respuesta(response, inicio)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.enrutador.registrar(backend, False)
+            raise
+        finally:
+            backend.en_curso -= 1
+
+        latencia = time.monotonic() - inicio
+        self.enrutador.registrar(backend, True, latencia)
+        self.latencias.append(latencia)
+        datos["metricas"] = dict(datos.get("metricas", {}), backend=backend.base_url, total=latencia)
+        return datos
+
+    @staticmethod
+    async def _leer_respuesta(response, inicio: float) -> dict:
+        """Reúne la respuesta en streaming (SSE) en el mismo formato que la respuesta completa.
+
+        Leer en streaming permite medir el tiempo hasta el primer token; si la instancia
+        ignora stream y devuelve el JSON de una vez, se usa tal cual.
+        """
+        if "text/event-stream" not in response.headers.get("Content-Type", ""):
+            datos = await response.json(content_type=None)
+            datos["metricas"] = {"primer_token": time.monotonic() - inicio}
+            return datos
+
+        partes, primer_token, ultimo, fin, uso = [], None, {}, None, None
+        async for linea in response.content:
+            linea = linea.decode("utf-8").strip()
+            if not linea.startswith("data:"):
+                continue
+            dato = linea[len("data:"):].strip()
+            if dato == "[DONE]":
+                break
+            ultimo = json.loads(dato)
+            uso = ultimo.get("usage") or uso
+            for eleccion in ultimo.get("choices", []):
+                texto = (eleccion.get("delta") or {}).get("content")
+                if texto:
+                    if primer_token is None:
+                        primer_token = time.monotonic() - inicio
+                    partes.append(texto)
+                fin = eleccion.get("finish_reason") or fin
+        return {
+            "id": ultimo.get("id"),
+            "model": ultimo.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(partes)},
+                         "finish_reason": fin}],
+            "usage": uso,
+            "metricas": {"primer_token": primer_token},
+        }
+
+    async def _con_cobertura(self, payload: dict) -> dict:
+        """Lanza la petición y, si tarda más que el p95, una copia; gana la primera que acaba."""
+        tareas = [asyncio.ensure_future(self._intento(payload))]
+        try:
+            if not self.hedge:
+                return await tareas[0]
+            hechas, _ = await asyncio.wait(tareas, timeout=self.retardo_cobertura())
+            if not hechas:
+                self.coberturas_lanzadas += 1
+                tareas.append(asyncio.ensure_future(self._intento(payload)))
+            pendientes = set(tareas)
+            while pendientes:
+                hechas, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+                for tarea in hechas:
+                    if tarea.exception() is None:
+                        if tarea is not tareas[0]:
+                            self.coberturas_ganadas += 1
+                        return tarea.result()
+            return tareas[0].result()  # Fallaron todas: se propaga el error de la primera
+        finally:
+            for tarea in tareas:
+                if not tarea.done():
+                    tarea.cancel()
+
+    async def _compartida(self, payload: dict, timeout: float, unirse: bool = True, crear: bool = True) -> dict:
+        """Agrupa las peticiones idénticas simultáneas en una sola llamada a Ollama.
+
+        La clave es el hash del payload completo (modelo, mensajes, temperatura y demás
+        parámetros). Solo se cancela la llamada compartida cuando ya no la espera nadie.
+        Sin unirse devuelve None si ya hay una idéntica en curso, y sin crear si no la hay.
+        """
+        clave = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        entrada = self.en_vuelo.get(clave)
+        if (entrada is None and not crear) or (entrada is not None and not unirse):
+            return None
+        self.llamadas += 1
+        if entrada is None:
+            entrada = {"tarea": asyncio.ensure_future(self._chat(payload, timeout)), "esperando": 0}
+            self.en_vuelo[clave] = entrada
+            entrada["tarea"].add_done_callback(
+                lambda _: self.en_vuelo.pop(clave) if self.en_vuelo.get(clave) is entrada else None)
+        else:
+            self.llamadas_ahorradas += 1
+            logging.info(f"Petición al LLM agrupada con otra idéntica en curso ({self.llamadas_ahorradas} ahorradas)")
+
+        entrada["esperando"] += 1
+        try:
+            return await asyncio.shield(entrada["tarea"])
+        finally:
+            entrada["esperando"] -= 1
+            if entrada["esperando"] == 0 and not entrada["tarea"].done():
+                # Fuera del mapa ya al cancelar: una petición idéntica que llegue mientras la
+                # tarea termina de cancelarse lanza su propia llamada en vez de recibir CancelledError
+                if self.en_vuelo.get(clave) is entrada:
+                    del self.en_vuelo[clave]
+                entrada["tarea"].cancel()
+
+    async def _chat(self, payload: dict, timeout: float) -> dict:
+        limite = time.monotonic() + timeout
+        for intento in range(self.retries + 1):
+            prueba = self._comprobar_circuito()
+            restante = limite - time.monotonic()
+            try:
+                datos = await asyncio.wait_for(self._con_cobertura(payload), restante)
+                self._registrar(True)
+                return datos
+            except asyncio.CancelledError:
+                # La cancelación no dice nada de Ollama, pero la llamada de prueba queda libre
+                if prueba:
+                    with self.lock:
+                        self.probando = False
+                raise
+            except Exception as e:
+                self._registrar(False)
+                logging.error(f"Intento {intento + 1} de llamada a Ollama fallido: {e!r}")
+                espera = min(2 ** intento, 30) * random.uniform(0.5, 1.5)
+                if not self._reintentable(e) or intento == self.retries or time.monotonic() + espera >= limite:
+                    raise ErrorOllama(f"{type(e).__name__}: {e}") from e
+                await asyncio.sleep(espera)
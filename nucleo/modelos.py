@@ -0,0 +1,97 @@
+"""Política de modelos por niveles: primero el modelo pequeño y el grande solo si hace falta."""
+import logging
+import re
+import threading
+
+from nucleo.texto import normalizar_texto
+
+
+# Palabras que suelen pedir agregaciones, comparaciones o varias tablas
+MARCAS_COMPLEJIDAD = {
+    "compara", "comparar", "comparacion", "frente", "versus", "evolucion", "tendencia", "variacion",
+    "media", "promedio", "porcentaje", "proporcion", "tasa", "ranking", "mayor", "menor", "maximo",
+    "minimo", "cada", "entre", "respecto", "acumulado", "diferencia", "crecimiento", "correlacion",
+}
+
+
+def puntuar_complejidad(mensaje: str) -> float:
+    """Estimación barata de lo difícil que es la pregunta para el modelo pequeño.
+
+    Suma un punto por cada marca de agregación o comparación, uno por cada año a partir
+    del segundo y uno por cada 15 palabras.
+    """
+    palabras = normalizar_texto(mensaje).split()
+    anios = set(re.findall(r"\b(?:19|20)\d{2}\b", mensaje))
+    return (sum(1 for p in palabras if p in MARCAS_COMPLEJIDAD)
+            + max(0, len(anios) - 1)
+            + len(palabras) / 15)
+
+
+class EstadisticasNiveles:
+    """Aciertos del modelo pequeño y latencias por tarea y nivel.
+
+    Cada decisión queda en uno de estos resultados: "pequeno" (el modelo pequeño valió),
+    "escalado" (se intentó con el pequeño y se repitió con el grande) o "grande"
+    (la pregunta era demasiado compleja o no hay modelo pequeño).
+    """
+
+    def __init__(self, cada: int = 50):
+        self.cada = cada  # Cada cuántas decisiones se deja el resumen en el log
+        self.tareas = {}  # {tarea: {"pequeno": [n, ms], "escalado": [n, ms], "grande": [n, ms], "motivos": {}}}
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def registrar(self, tarea: str, resultado: str, ms_pequeno: float = 0.0, ms_grande: float = 0.0,
+                  motivo: str = None):
+        with self.lock:
+            datos = self.tareas.setdefault(tarea, {
+                "pequeno": [0, 0.0], "escalado": [0, 0.0, 0.0], "grande": [0, 0.0], "motivos": {},
+            })
+            if resultado == "pequeno":
+                datos["pequeno"][0] += 1
+                datos["pequeno"][1] += ms_pequeno
+            elif resultado == "escalado":
+                datos["escalado"][0] += 1
+                datos["escalado"][1] += ms_pequeno
+                datos["escalado"][2] += ms_grande
+                clave = (motivo or "").split(":")[0]
+                datos["motivos"][clave] = datos["motivos"].get(clave, 0) + 1
+            else:
+                datos["grande"][0] += 1
+                datos["grande"][1] += ms_grande
+            self.total += 1
+            resumir = self.cada and self.total % self.cada == 0
+        if resumir:
+            logging.info(f"Modelos por niveles: {self.informe()}")
+
+    def informe(self) -> dict:
+        """Por tarea: tasa de acierto del modelo pequeño, latencias medias y ahorro estimado.
+
+        El ahorro compara cada respuesta del modelo pequeño con la latencia media del
+        grande en la misma tarea, y le resta el tiempo perdido en los escalados.
+        """
+        resultado = {}
+        with self.lock:
+            for tarea, datos in self.tareas.items():
+                n_pequeno, ms_pequeno = datos["pequeno"]
+                n_escalado, ms_escalado_pequeno, ms_escalado_grande = datos["escalado"]
+                n_grande, ms_grande = datos["grande"]
+                intentos = n_pequeno + n_escalado
+                llamadas_grande = n_escalado + n_grande
+                media_grande = (ms_escalado_grande + ms_grande) / llamadas_grande if llamadas_grande else None
+                media_pequeno = ms_pequeno / n_pequeno if n_pequeno else None
+                ahorro = None
+                if media_grande is not None:
+                    ahorro = media_grande * n_pequeno - ms_pequeno - ms_escalado_pequeno
+                resultado[tarea] = {
+                    "decisiones": intentos + n_grande,
+                    "intentos_pequeno": intentos,
+                    "acierto_pequeno": round(n_pequeno / intentos, 3) if intentos else None,
+                    "escalados": n_escalado,
+                    "directo_grande": n_grande,
+                    "motivos_escalado": dict(datos["motivos"]),
+                    "media_pequeno_ms": round(media_pequeno, 1) if media_pequeno is not None else None,
+                    "media_grande_ms": round(media_grande, 1) if media_grande is not None else None,
+                    "ahorro_estimado_ms": round(ahorro, 1) if ahorro is not None else None,
+                }
+        return resultado
@@ -0,0 +1,190 @@
+"""Perfiles de valores por columna para que el LLM escriba los literales tal como están en las tablas."""
+import json
+import logging
+import os
+import re
+import threading
+
+import psycopg2
+
+from nucleo.plantillas import COLUMNAS_ANIO
+from nucleo.texto import formatear_valor, normalizar_texto
+
+
+TIPOS_RANGO = {
+    "smallint", "integer", "bigint", "numeric", "real", "double precision",
+    "date", "timestamp without time zone", "timestamp with time zone",
+}
+# Tipos sin igualdad o sin interés para escribir filtros
+TIPOS_OMITIDOS = {"json", "bytea", "xml"}
+
+
+class PerfiladorColumnas:
+    """Perfil compacto de cada tabla: tipo de cada columna, valores distintos de las de
+    baja cardinalidad y mínimo/máximo de las numéricas, fechas y periodos.
+
+    Igual que las instantáneas, una tabla solo se vuelve a perfilar cuando cambian sus
+    contadores en pg_stat_user_tables (tras una carga). Los perfiles se guardan en un JSON
+    para no recalcularlos al reiniciar.
+    """
+
+    def __init__(self, ruta: str, connect, max_distintos: int = 25):
+        self.ruta = ruta
+        self.connect = connect
+        self.max_distintos = max_distintos
+        self.perfiles = {}  # {tabla: {"firma", "filas", "columnas": {columna: perfil}}}
+        # Ya normalizados para relevantes(): {tabla: valores perfilados} y {tabla: (columnas, palabras del nombre)}
+        self.valores = {}
+        self.nombres = {}
+        self.lock = threading.Lock()
+        self.cargar()
+
+    def cargar(self):
+        if not os.path.exists(self.ruta):
+            return
+        try:
+            with open(self.ruta, "r", encoding="utf-8") as f:
+                self.perfiles = json.load(f)
+            self.valores = {tabla: self._valores(perfil) for tabla, perfil in self.perfiles.items()}
+        except (OSError, ValueError) as e:
+            logging.error(f"Error al cargar los perfiles de columnas: {e}")
+
+    def guardar(self):
+        try:
+            temporal = self.ruta + ".tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(self.perfiles, f, ensure_ascii=False)
+            os.replace(temporal, self.ruta)
+        except OSError as e:
+            logging.error(f"Error al guardar los perfiles de columnas: {e}")
+
+    def refrescar(self):
+        """Perfila las tablas nuevas o cambiadas desde la última vez y olvida las borradas."""
+        try:
+            conn = self.connect()
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT relname, n_tup_ins, n_tup_upd, n_tup_del
+                FROM pg_stat_user_tables
+                WHERE schemaname = 'public';
+            """)
+            firmas = {tabla: list(contadores) for tabla, *contadores in cursor.fetchall()}
+
+            cambios = 0
+            for tabla, firma in firmas.items():
+                if (self.perfiles.get(tabla) or {}).get("firma") == firma:
+                    continue
+                try:
+                    perfil = self.perfilar(cursor, tabla)
+                except psycopg2.Error as e:
+                    logging.error(f"No se pudo perfilar la tabla {tabla}: {e}")
+                    continue
+                valores = self._valores(perfil)
+                with self.lock:
+                    self.perfiles[tabla] = dict(perfil, firma=firma)
+                    self.valores[tabla] = valores
+                cambios += 1
+
+            with self.lock:
+                for tabla in set(self.perfiles) - set(firmas):
+                    self.perfiles.pop(tabla)
+                    self.valores.pop(tabla, None)
+                    self.nombres.pop(tabla, None)
+                    cambios += 1
+
+            cursor.close()
+            conn.close()
+            if cambios:
+                self.guardar()
+                logging.info(f"Perfiles de columnas actualizados: {cambios} tablas")
+        except psycopg2.Error as e:
+            logging.error(f"Error al refrescar los perfiles de columnas: {e}")
+
+    def perfilar(self, cursor, tabla: str) -> dict:
+        cursor.execute("""
+            SELECT column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s
+            ORDER BY ordinal_position;
+        """, (tabla,))
+        tipos = {c: t for c, t in cursor.fetchall() if t not in TIPOS_OMITIDOS}
+        rango = [c for c, t in tipos.items() if t in TIPOS_RANGO or c in COLUMNAS_ANIO]
+        discretas = [c for c, t in tipos.items() if t not in TIPOS_RANGO]
+
+        # Una sola pasada para el número de filas, los rangos y la cardinalidad
+        expresiones = ["count(*)"]
+        expresiones += [f'min("{c}"), max("{c}")' for c in rango]
+        expresiones += [f'count(DISTINCT "{c}")' for c in discretas]
+        cursor.execute(f'SELECT {", ".join(expresiones)} FROM "{tabla}"')
+        fila = list(cursor.fetchone())
+
+        filas = fila.pop(0)
+        columnas = {c: {"tipo": t} for c, t in tipos.items()}
+        for c in rango:
+            minimo, maximo = fila.pop(0), fila.pop(0)
+            if minimo is not None:
+                columnas[c].update(min=formatear_valor(minimo), max=formatear_valor(maximo))
+        for c in discretas:
+            distintos = fila.pop(0)
+            columnas[c]["distintos"] = distintos
+            if distintos <= self.max_distintos:
+                cursor.execute(f'SELECT DISTINCT "{c}" FROM "{tabla}" WHERE "{c}" IS NOT NULL ORDER BY 1')
+                columnas[c]["valores"] = [formatear_valor(v) for v, in cursor.fetchall()]
+        return {"filas": filas, "columnas": columnas}
+
+    @staticmethod
+    def _valores(perfil: dict) -> frozenset:
+        return frozenset(normalizar_texto(v) for datos in (perfil.get("columnas") or {}).values()
+                         for v in datos.get("valores", []))
+
+    def _nombres(self, tabla: str, columnas: list) -> set:
+        """Palabras del nombre de la tabla y de sus columnas; se recalculan solo si cambian las columnas."""
+        columnas = tuple(columnas)
+        guardado = self.nombres.get(tabla)
+        if guardado is not None and guardado[0] == columnas:
+            return guardado[1]
+        nombres = set(re.split(r"[_\W]+", normalizar_texto(tabla)))
+        for columna in columnas:
+            nombres.update(re.split(r"[_\W]+", normalizar_texto(columna)))
+        self.nombres[tabla] = (columnas, nombres)
+        return nombres
+
+    def relevantes(self, mensaje: str, esquema: dict, max_tablas: int = 3) -> list:
+        """Tablas del esquema que más tienen que ver con la pregunta.
+
+        Puntúa cada tabla por las palabras de la pregunta que aparecen en su nombre, en el
+        de sus columnas o entre sus valores perfilados.
+        """
+        palabras = {p for p in normalizar_texto(mensaje).split() if len(p) > 2}
+        if not palabras:
+            return []
+        puntuaciones = {}
+        with self.lock:
+            for tabla, columnas in esquema.items():
+                puntos = (2 * len(palabras & self._nombres(tabla, columnas))
+                          + len(palabras & self.valores.get(tabla, frozenset())))
+                if puntos:
+                    puntuaciones[tabla] = puntos
+        return sorted(puntuaciones, key=lambda t: (-puntuaciones[t], t))[:max_tablas]
+
+    def compacto(self, tablas: list) -> str:
+        """Una línea por tabla: tipo, valores admitidos o rango de cada columna."""
+        lineas = []
+        with self.lock:
+            for tabla in tablas:
+                perfil = self.perfiles.get(tabla)
+                if not perfil:
+                    continue
+                partes = []
+                for columna, datos in perfil["columnas"].items():
+                    texto = f"{columna} {datos['tipo']}"
+                    if "valores" in datos:
+                        texto += " = " + "|".join(f"'{v}'" for v in datos["valores"])
+                    elif "min" in datos:
+                        texto += f" {datos['min']}..{datos['max']}"
+                    elif "distintos" in datos:
+                        texto += f" ({datos['distintos']} valores)"
+                    partes.append(texto)
+                lineas.append(f"{tabla} ({perfil['filas']} filas): " + "; ".join(partes))
+        return "\n".join(lineas)
@@ -0,0 +1,131 @@
+"""Reparto de la capacidad del LLM entre usuarios: límite global y colas justas por usuario."""
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from nucleo.cancelacion import Cancelacion, Cancelado
+
+
+INTERACTIVA = 0
+LOTE = 1
+
+
+class Turno:
+    def __init__(self, usuario: str, prioridad: int):
+        self.usuario = usuario
+        self.prioridad = prioridad
+        self.evento = threading.Event()
+        self.admitido = False
+        self.cancelado = False
+
+
+class Planificador:
+    """Como mucho `limite` llamadas al LLM a la vez en todo el proceso.
+
+    Las llamadas que esperan se atienden primero las interactivas y luego las de lote
+    (pipe_batch). Dentro de cada prioridad, por turnos entre usuarios: cada usuario con
+    llamadas pendientes pasa una y vuelve al final, así un lote largo de un usuario no deja
+    sin servicio a los demás. Una llamada cuyo cliente se ha ido sale de la cola sin
+    llegar a enviarse.
+    """
+
+    planificadores = {}
+    lock_planificadores = threading.Lock()
+
+    @classmethod
+    def para(cls, clave: str, limite: int) -> "Planificador":
+        """Un planificador por instancia de Ollama (clave), compartido por todas las pipelines.
+
+        El límite solo se toma al crearlo: si cada pipeline lo fijara al pedirlo, dos con
+        valores distintos se lo irían cambiando en cada llamada. Para cambiarlo, ajustar().
+        """
+        with cls.lock_planificadores:
+            if clave not in cls.planificadores:
+                cls.planificadores[clave] = cls(limite)
+            return cls.planificadores[clave]
+
+    def __init__(self, limite: int):
+        self.limite = limite
+        self.en_curso = 0
+        self.colas = {INTERACTIVA: OrderedDict(), LOTE: OrderedDict()}  # {prioridad: {usuario: deque[Turno]}}
+        self.lock = threading.Lock()
+
+    def ajustar(self, limite: int):
+        with self.lock:
+            if limite == self.limite:
+                return
+            self.limite = limite
+            self._despachar()
+
+    @contextmanager
+    def turno(self, usuario: str, prioridad: int = INTERACTIVA, cancelacion: Cancelacion = None):
+        """Espera a que le toque a la llamada; devuelve un diccionario con la espera en ms."""
+        turno = Turno(usuario, prioridad)
+        medida = {"espera_ms": 0.0, "en_cola": 0}
+        inicio = time.perf_counter()
+        with self.lock:
+            medida["en_cola"] = sum(len(c) for cola in self.colas.values() for c in cola.values())
+            self.colas[prioridad].setdefault(usuario, deque()).append(turno)
+            self._despachar()
+
+        if not turno.admitido:
+            cancelacion = cancelacion or Cancelacion()
+            with cancelacion.propagar(lambda: self._abandonar(turno)):
+                turno.evento.wait()
+        medida["espera_ms"] = (time.perf_counter() - inicio) * 1000
+        if turno.cancelado:
+            raise Cancelado("Petición cancelada mientras esperaba turno para el LLM")
+
+        try:
+            yield medida
+        finally:
+            with self.lock:
+                self.en_curso -= 1
+                self._despachar()
+
+    def _abandonar(self, turno: Turno):
+        """El cliente se ha ido: se quita de la cola si aún no había entrado."""
+        with self.lock:
+            if turno.admitido:
+                return
+            cola = self.colas[turno.prioridad].get(turno.usuario)
+            if cola is not None and turno in cola:
+                cola.remove(turno)
+                if not cola:
+                    del self.colas[turno.prioridad][turno.usuario]
+            turno.cancelado = True
+        turno.evento.set()
+
+    def _despachar(self):
+        """Admite llamadas mientras quede capacidad. Se llama con el lock tomado."""
+        while self.limite <= 0 or self.en_curso < self.limite:
+            turno = self._siguiente()
+            if turno is None:
+                return
+            self.en_curso += 1
+            turno.admitido = True
+            turno.evento.set()
+
+    def _siguiente(self):
+        for prioridad in (INTERACTIVA, LOTE):
+            usuarios = self.colas[prioridad]
+            if not usuarios:
+                continue
+            usuario, cola = next(iter(usuarios.items()))
+            turno = cola.popleft()
+            # El usuario pasa al final para que los demás vayan antes que su siguiente llamada
+            del usuarios[usuario]
+            if cola:
+                usuarios[usuario] = cola
+            return turno
+        return None
+
+    def estado(self) -> dict:
+        with self.lock:
+            return {
+                "limite": self.limite,
+                "en_curso": self.en_curso,
+                "en_cola": {("interactiva" if p == INTERACTIVA else "lote"): {u: len(c) for u, c in cola.items()}
+                            for p, cola in self.colas.items()},
+            }
@@ -0,0 +1,193 @@
+"""Plantillas SQL parametrizadas para las preguntas con forma conocida."""
+import hashlib
+import logging
+import re
+import threading
+import weakref
+from contextlib import nullcontext
+from typing import List
+
+import psycopg2
+import psycopg2.extensions
+
+from nucleo.cancelacion import Cancelacion
+from nucleo.texto import normalizar_texto
+from nucleo.trazas import Traza
+
+
+SINONIMOS_SEXO = {
+    "hombres": "hombres", "hombre": "hombres", "varones": "hombres", "varon": "hombres", "masculino": "hombres",
+    "mujeres": "mujeres", "mujer": "mujeres", "femenino": "mujeres",
+}
+# Nombre normalizado → valor tal como suele aparecer en las tablas
+REGIONES = {
+    "andalucia": "Andalucía", "aragon": "Aragón", "asturias": "Asturias", "baleares": "Balears",
+    "canarias": "Canarias", "cantabria": "Cantabria", "castilla y leon": "Castilla y León",
+    "castilla la mancha": "Castilla - La Mancha", "cataluna": "Cataluña", "catalunya": "Cataluña",
+    "comunitat valenciana": "Valenciana", "comunidad valenciana": "Valenciana", "extremadura": "Extremadura",
+    "galicia": "Galicia", "madrid": "Madrid", "murcia": "Murcia", "navarra": "Navarra",
+    "pais vasco": "País Vasco", "euskadi": "País Vasco", "rioja": "Rioja", "ceuta": "Ceuta", "melilla": "Melilla",
+    "tenerife": "Tenerife", "gran canaria": "Gran Canaria", "lanzarote": "Lanzarote",
+    "fuerteventura": "Fuerteventura", "la palma": "La Palma", "la gomera": "La Gomera", "el hierro": "El Hierro",
+}
+COLUMNAS_ANIO = ("periodo", "anio", "ano", "year")
+COLUMNAS_SEXO = ("sexo",)
+COLUMNAS_REGION = ("region", "comunidad_autonoma", "comunidad", "ccaa", "provincia", "isla", "territorio", "municipio")
+# Palabras que no describen la medida pedida
+PALABRAS_PREGUNTA = {
+    "a", "al", "ambos", "ano", "anos", "cual", "cuales", "cuantas", "cuantos", "dame", "dato", "datos", "de",
+    "del", "dime", "el", "en", "fue", "fueron", "habia", "hay", "hubieron", "hubo", "la", "las", "los",
+    "numero", "por", "que", "quiero", "saber", "se", "segun", "sexos", "y",
+}
+
+
+class MotorPlantillas:
+    """Resuelve sin LLM las preguntas con forma conocida: una medida de una tabla filtrada
+    por año, sexo y/o región, opcionalmente restringida a la fuente (ine, istac).
+
+    Solo se usa una plantilla si todas las palabras de la pregunta se explican por los
+    huecos reconocidos y una única tabla del esquema. Las consultas van por el pool
+    compartido (réplicas incluidas) y se preparan en el servidor (PREPARE) la primera vez
+    que cada conexión las usa; después se reutilizan con EXECUTE.
+    """
+
+    def __init__(self, bd):
+        self.bd = bd
+        # {conexión: nombres ya preparados en ella}; se olvida sola al cerrarse la conexión
+        self.preparadas = weakref.WeakKeyDictionary()
+        self.invalidas = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _columna(columnas: List[str], candidatas: tuple):
+        return next((c for c in candidatas if c in columnas), None)
+
+    def reconocer(self, mensaje: str, esquema: dict):
+        """Devuelve el plan {"tabla", "filtros"} o None si la pregunta no encaja con confianza."""
+        texto = normalizar_texto(mensaje)
+
+        huecos = {}
+        region = next((r for r in sorted(REGIONES, key=len, reverse=True)
+                       if re.search(rf"\b{r}\b", texto)), None)
+        if region:
+            huecos["region"] = REGIONES[region]
+            texto = re.sub(rf"\b{region}\b", " ", texto)
+
+        palabras = texto.split()
+        anios = [p for p in palabras if re.fullmatch(r"(19|20)\d{2}", p)]
+        sexos = {SINONIMOS_SEXO[p] for p in palabras if p in SINONIMOS_SEXO}
+        fuentes = {p for p in palabras if p in ("ine", "istac")}
+        if len(anios) > 1 or len(sexos) > 1 or len(fuentes) > 1:
+            return None
+        if anios:
+            huecos["anio"] = anios[0]
+        if sexos:
+            huecos["sexo"] = sexos.pop()
+        if not huecos:
+            return None
+
+        medida = [p for p in palabras if p not in PALABRAS_PREGUNTA and p not in SINONIMOS_SEXO
+                  and p not in fuentes and p not in anios]
+        if not medida:
+            return None
+
+        candidatas = [
+            tabla for tabla in esquema
+            if (not fuentes or tabla.startswith(f"{next(iter(fuentes))}_"))
+            and all(p in tabla.split("_") for p in medida)
+        ]
+        if len(candidatas) != 1:
+            return None
+        tabla = candidatas[0]
+
+        filtros = []
+        for hueco, candidatas_columna in (("anio", COLUMNAS_ANIO), ("sexo", COLUMNAS_SEXO), ("region", COLUMNAS_REGION)):
+            if hueco not in huecos:
+                continue
+            columna = self._columna(esquema[tabla], candidatas_columna)
+            if columna is None:
+                return None
+            filtros.append((hueco, columna, huecos[hueco]))
+        return {"tabla": tabla, "filtros": filtros}
+
+    @staticmethod
+    def _condicion(hueco: str, columna: str, posicion: int) -> str:
+        if hueco == "anio":
+            return f'"{columna}"::text LIKE ${posicion}'
+        if hueco == "sexo":
+            return f'lower("{columna}"::text) = ${posicion}'
+        return f'lower("{columna}"::text) LIKE ${posicion}'
+
+    @staticmethod
+    def _parametro(hueco: str, valor: str) -> str:
+        if hueco == "anio":
+            return f"{valor}%"
+        if hueco == "sexo":
+            return valor
+        return f"%{valor.lower()}%"
+
+    def _preparada(self, conn, nombre: str) -> bool:
+        with self.lock:
+            return nombre in self.preparadas.get(conn, ())
+
+    def _marcar_preparada(self, conn, nombre: str):
+        with self.lock:
+            self.preparadas.setdefault(conn, set()).add(nombre)
+
+    def ejecutar(self, plan: dict, cancelacion: Cancelacion = None, traza: Traza = None):
+        """Ejecuta el plan con una sentencia preparada. Devuelve (sql, columnas, filas) o None.
+
+        Solo se descarta para siempre una plantilla cuyo PREPARE falla (no encaja con la
+        tabla). Un corte de conexión o un error al ejecutarla no la invalida. Si se cancela
+        la petición se cancela la sentencia en el servidor y se lanza Cancelado.
+        """
+        tabla, filtros = plan["tabla"], plan["filtros"]
+        forma = (tabla, tuple((hueco, columna) for hueco, columna, _ in filtros))
+        nombre = "plantilla_" + hashlib.md5(repr(forma).encode("utf-8")).hexdigest()[:16]
+        if nombre in self.invalidas:
+            return None
+
+        condiciones = " AND ".join(self._condicion(h, c, i + 1) for i, (h, c, _) in enumerate(filtros))
+        sql_plantilla = f'SELECT * FROM "{tabla}" WHERE {condiciones}'
+        parametros = [self._parametro(h, v) for h, _, v in filtros]
+        sql_query = re.sub(r"\$(\d+)", lambda m: "'" + parametros[int(m.group(1)) - 1].replace("'", "''") + "'", sql_plantilla)
+
+        cancelacion = cancelacion or Cancelacion()
+
+        def consultar(conn):
+            cursor = conn.cursor()
+            with cancelacion.propagar(conn.cancel):
+                if not self._preparada(conn, nombre):
+                    # PREPARE valida la plantilla contra la tabla real antes de usarla. Las
+                    # sentencias preparadas duran lo que la sesión, aunque el pool haga rollback
+                    tipos = ", ".join("text" for _ in filtros)
+                    try:
+                        cursor.execute(f"PREPARE {nombre} ({tipos}) AS {sql_plantilla}")
+                    except (psycopg2.ProgrammingError, psycopg2.DataError) as e:
+                        logging.error(f"La plantilla {nombre} no es válida para {tabla}: {e}")
+                        with self.lock:
+                            self.invalidas.add(nombre)
+                        return None
+                    self._marcar_preparada(conn, nombre)
+                marcadores = ", ".join("%s" for _ in filtros)
+                # En la traza va el SQL con los valores, como si se hubiera ejecutado tal cual
+                medida = (traza.ejecucion_sql(sql_query, "plantilla", conn.get_dsn_parameters().get("host"))
+                          if traza else nullcontext())
+                with medida:
+                    cursor.execute(f"EXECUTE {nombre} ({marcadores})", parametros)
+                filas = cursor.fetchall()
+            columnas = [d[0] for d in cursor.description] if cursor.description else []
+            cursor.close()
+            return sql_query, columnas, filas
+
+        try:
+            return self.bd.leer(consultar)
+        except psycopg2.extensions.QueryCanceledError:
+            cancelacion.comprobar()
+            logging.error(f"La plantilla {nombre} superó el tiempo máximo en {tabla}")
+        except psycopg2.OperationalError as e:
+            # El pool descarta la conexión rota; en otra conexión se vuelve a preparar
+            logging.error(f"Conexión perdida al ejecutar la plantilla {nombre}: {e}")
+        except psycopg2.Error as e:
+            logging.error(f"Error al ejecutar la plantilla {nombre} en {tabla}: {e}")
+        return None
@@ -0,0 +1,220 @@
+"""Configuración común de las pipelines y recursos compartidos por proceso."""
+import json
+import logging
+import os
+import threading
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from nucleo.bd import BaseDatos
+from nucleo.cache import CacheSemantica
+from nucleo.instantaneas import MotorInstantaneas, duckdb
+from nucleo.intencion import ClasificadorIntencion
+from nucleo.llm import ClienteOllama
+from nucleo.modelos import EstadisticasNiveles
+from nucleo.perfiles import PerfiladorColumnas
+from nucleo.planificador import Planificador
+from nucleo.plantillas import MotorPlantillas
+from nucleo.sesiones import AlmacenSesiones
+
+
+def _entorno(nombre: str, defecto, tipo=str):
+    """Valor por defecto de una valve leído de la variable de entorno al crear la pipeline."""
+    return Field(default_factory=lambda: tipo(os.getenv(nombre, defecto)))
+
+
+def _booleano(valor) -> bool:
+    return str(valor).strip().lower() in ("1", "true", "si", "sí", "yes")
+
+
+def _lista(valor) -> List[str]:
+    return [v.strip() for v in str(valor).split(",") if v.strip()]
+
+
+class ValvesBase(BaseModel):
+    """Valves comunes; cada pipeline las amplía con las suyas."""
+    DB_HOST: str
+    DB_PORT: str
+    DB_USER: str
+    DB_PASSWORD: str
+    DB_DATABASE: str
+    DB_POOL_MAX: int = _entorno("DB_POOL_MAX", 8, int)  # Conexiones máximas del pool compartido
+    DB_POOL_TIMEOUT: float = _entorno("DB_POOL_TIMEOUT", 30, float)  # Espera máxima por una conexión libre
+    DB_REPLICAS: List[str] = _entorno("DB_REPLICAS", "", _lista)  # Réplicas de lectura host[:puerto]; mismo usuario y base de datos
+    DB_REPLICA_MAX_LAG_SECONDS: float = _entorno("DB_REPLICA_MAX_LAG_SECONDS", 30, float)  # Retraso máximo para leer de una réplica
+    DB_REPLICA_CHECK_SECONDS: float = _entorno("DB_REPLICA_CHECK_SECONDS", 10, float)  # Cada cuánto se comprueban las réplicas
+    SCHEMA_CACHE_SECONDS: int = _entorno("SCHEMA_CACHE_SECONDS", 300, int)  # Vigencia del esquema en memoria
+    BATCH_CONCURRENCY: int = _entorno("BATCH_CONCURRENCY", 4, int)  # Preguntas de un lote que se resuelven a la vez
+    RESULT_FORMAT: str = _entorno("RESULT_FORMAT", "csv")  # csv o markdown
+    RESULT_TOKEN_BUDGET: int = _entorno("RESULT_TOKEN_BUDGET", 1500, int)  # Tokens máximos de resultados que se pasan al LLM
+    OLLAMA_URLS: List[str] = _entorno("OLLAMA_URLS", "http://host.docker.internal:11434", _lista)
+    LLM_TIMEOUT: float = _entorno("LLM_TIMEOUT", 120, float)  # Plazo total de cada llamada al LLM, reintentos incluidos
+    LLM_RETRIES: int = _entorno("LLM_RETRIES", 2, int)
+    LLM_HEDGE: bool = _entorno("LLM_HEDGE", "false", _booleano)  # Petición duplicada si la primera supera el p95
+    LLM_BREAKER_FAILURES: int = _entorno("LLM_BREAKER_FAILURES", 5, int)  # Fallos seguidos que abren el cortacircuitos
+    LLM_BREAKER_RESET_SECONDS: float = _entorno("LLM_BREAKER_RESET_SECONDS", 30, float)
+    LLM_MAX_CONCURRENCY: int = _entorno("LLM_MAX_CONCURRENCY", 4, int)  # Llamadas al LLM a la vez en el proceso; 0 sin límite
+    SQL_MAX_TOKENS: int = _entorno("SQL_MAX_TOKENS", 300, int)  # Tokens máximos al generar el SQL
+    ANSWER_MAX_TOKENS: int = _entorno("ANSWER_MAX_TOKENS", 600, int)  # Tokens máximos de la respuesta redactada
+    LLM_SMALL_MODEL: str = _entorno("LLM_SMALL_MODEL", "")  # Modelo pequeño que se prueba antes que el de la pipeline; vacío: solo el grande
+    LLM_COMPLEXITY_THRESHOLD: float = _entorno("LLM_COMPLEXITY_THRESHOLD", 2.5, float)  # Por encima se va directo al modelo grande
+    TRACE_PATH: str = _entorno("TRACE_PATH", "trazas.jsonl")  # Fichero JSONL de trazas por petición; vacío para desactivarlas
+    TRACE_MAX_BYTES: int = _entorno("TRACE_MAX_BYTES", 10 * 1024 * 1024, int)  # Tamaño al que rota el fichero de trazas
+    TRACE_BACKUPS: int = _entorno("TRACE_BACKUPS", 5, int)
+    CANCEL_CHECK_SECONDS: float = _entorno("CANCEL_CHECK_SECONDS", 1, float)  # Cada cuánto se comprueba si el cliente sigue conectado
+
+
+# Valves que determinan qué recursos se pueden compartir entre pipelines
+CAMPOS_COMPARTIDOS = (
+    "DB_HOST", "DB_PORT", "DB_USER", "DB_PASSWORD", "DB_DATABASE", "DB_POOL_MAX", "DB_POOL_TIMEOUT",
+    "SCHEMA_CACHE_SECONDS",
+    "DB_REPLICAS", "DB_REPLICA_MAX_LAG_SECONDS", "DB_REPLICA_CHECK_SECONDS",
+    "OLLAMA_URLS", "LLM_TIMEOUT", "LLM_RETRIES", "LLM_HEDGE", "LLM_BREAKER_FAILURES", "LLM_BREAKER_RESET_SECONDS",
+)
+
+
+class Recursos:
+    """Recursos costosos que se crean una sola vez por proceso.
+
+    Las pipelines con la misma configuración de base de datos y de Ollama reciben la misma
+    instancia, así que comparten pool de conexiones, cliente del LLM, catálogo y cachés.
+    Todo se crea en el primer uso.
+    """
+
+    instancias = {}
+    lock_instancias = threading.Lock()
+
+    @classmethod
+    def para(cls, valves: ValvesBase) -> "Recursos":
+        clave = json.dumps({campo: getattr(valves, campo) for campo in CAMPOS_COMPARTIDOS}, sort_keys=True)
+        with cls.lock_instancias:
+            if clave not in cls.instancias:
+                cls.instancias[clave] = cls(valves, clave)
+            return cls.instancias[clave]
+
+    def __init__(self, valves: ValvesBase, clave: str):
+        self.valves = valves
+        self.clave = clave
+        self.bd = BaseDatos(
+            {
+                "database": valves.DB_DATABASE,
+                "user": valves.DB_USER,
+                "password": valves.DB_PASSWORD,
+                "host": valves.DB_HOST.split('//')[-1],  # Remove the http:// or https:// prefix if present
+                "port": valves.DB_PORT,
+            },
+            max_conexiones=valves.DB_POOL_MAX,
+            espera_conexion=valves.DB_POOL_TIMEOUT,
+            ttl_esquema=valves.SCHEMA_CACHE_SECONDS,
+            replicas=valves.DB_REPLICAS,
+            max_retraso=valves.DB_REPLICA_MAX_LAG_SECONDS,
+        )
+        self.clasificador = ClasificadorIntencion()
+        self.plantillas = MotorPlantillas(self.bd)
+        self.sesiones = AlmacenSesiones()
+        self.niveles = EstadisticasNiveles()
+        self.caches = {}
+        self.instantaneas = None
+        self.perfiles = None
+        self.parar_hilos = threading.Event()
+        self.llm_cliente = None
+        self.usuarios = 0
+        self.lock = threading.Lock()
+
+    @property
+    def llm(self) -> ClienteOllama:
+        with self.lock:
+            if self.llm_cliente is None:
+                self.llm_cliente = ClienteOllama(
+                    self.valves.OLLAMA_URLS, {"Content-Type": "application/json"},
+                    timeout=self.valves.LLM_TIMEOUT,
+                    retries=self.valves.LLM_RETRIES,
+                    hedge=self.valves.LLM_HEDGE,
+                    breaker_failures=self.valves.LLM_BREAKER_FAILURES,
+                    breaker_reset=self.valves.LLM_BREAKER_RESET_SECONDS,
+                )
+            return self.llm_cliente
+
+    @property
+    def planificador(self) -> Planificador:
+        # Uno por conjunto de instancias de Ollama, aunque las pipelines usen bases de datos distintas
+        return Planificador.para(json.dumps(self.valves.OLLAMA_URLS), self.valves.LLM_MAX_CONCURRENCY)
+
+    def cache_semantica(self, ruta: str) -> CacheSemantica:
+        with self.lock:
+            if ruta not in self.caches:
+                self.caches[ruta] = CacheSemantica(ruta)
+            return self.caches[ruta]
+
+    def iniciar(self):
+        """Registra una pipeline usuaria; la primera lee el catálogo una sola vez para todas."""
+        with self.lock:
+            self.usuarios += 1
+            primera = self.usuarios == 1
+        if primera:
+            self.iniciar_replicas()
+            esquema = self.bd.cached_schema()
+            logging.info(f"Catálogo cargado: {len(esquema)} tablas")
+
+    def iniciar_replicas(self):
+        """Comprueba las réplicas ya y después en segundo plano cada DB_REPLICA_CHECK_SECONDS."""
+        if not self.bd.replicas:
+            return
+        self.bd.comprobar_replicas()
+
+        def comprobar():
+            # Una réplica caída o retrasada deja de recibir lecturas hasta que se recupera
+            while not self.parar_hilos.wait(self.valves.DB_REPLICA_CHECK_SECONDS):
+                self.bd.comprobar_replicas()
+
+        threading.Thread(target=comprobar, daemon=True).start()
+
+    def iniciar_instantaneas(self, directorio: str, patrones: List[str], intervalo: int):
+        """Arranca, si no lo está ya, el refresco periódico de las instantáneas locales."""
+        if not patrones:
+            return
+        if duckdb is None:
+            logging.warning("SNAPSHOT_TABLES está configurado pero duckdb no está instalado.")
+            return
+        with self.lock:
+            if self.instantaneas is not None:
+                return
+            self.instantaneas = MotorInstantaneas(directorio, patrones, self.bd.conectar)
+
+        def refrescar():
+            # Revisa periódicamente si las cargas nocturnas han cambiado alguna tabla
+            while not self.parar_hilos.is_set():
+                self.instantaneas.refrescar()
+                self.parar_hilos.wait(intervalo)
+
+        threading.Thread(target=refrescar, daemon=True).start()
+
+    def iniciar_perfiles(self, ruta: str, intervalo: int, max_distintos: int):
+        """Arranca, si no lo está ya, el perfilado periódico de columnas en segundo plano."""
+        with self.lock:
+            if self.perfiles is not None:
+                return
+            self.perfiles = PerfiladorColumnas(ruta, self.bd.conectar, max_distintos)
+
+        def refrescar():
+            # Solo se vuelven a perfilar las tablas que han cambiado desde la última pasada
+            while not self.parar_hilos.is_set():
+                self.perfiles.refrescar()
+                self.parar_hilos.wait(intervalo)
+
+        threading.Thread(target=refrescar, daemon=True).start()
+
+    def liberar(self):
+        """Da de baja una pipeline; con la última se cierran conexiones y cliente del LLM."""
+        with self.lock:
+            self.usuarios = max(0, self.usuarios - 1)
+            if self.usuarios:
+                return
+            cliente, self.llm_cliente = self.llm_cliente, None
+        self.parar_hilos.set()
+        if cliente is not None:
+            cliente.close()
+        self.bd.cerrar()
+        with Recursos.lock_instancias:
+            Recursos.instancias.pop(self.clave, None)
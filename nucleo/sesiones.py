@@ -0,0 +1,185 @@
+"""Estado por conversación para responder preguntas de seguimiento sin volver a consultar."""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from typing import List
+
+from nucleo.texto import normalizar_texto
+
+
+# Palabras con las que suele empezar una pregunta de seguimiento ("¿y en 2022?", "ahora solo mujeres")
+MARCADORES_SEGUIMIENTO = ("y", "ahora", "pero", "entonces")
+AGREGACIONES = {
+    "suma": "suma", "total": "suma", "media": "media", "promedio": "media",
+    "maximo": "maximo", "minimo": "minimo", "cuantos": "recuento", "cuantas": "recuento",
+}
+# Palabras que puede llevar un seguimiento sin hablar de otra cosa; el resto tiene que ser
+# una columna o un valor del resultado anterior, o un año
+VOCABULARIO_SEGUIMIENTO = set(MARCADORES_SEGUIMIENTO) | set(AGREGACIONES) | {
+    "el", "la", "los", "las", "lo", "un", "una", "de", "del", "en", "por", "para", "con", "a", "al", "e", "o",
+    "que", "cual", "cuales", "es", "son", "fue", "fueron", "hay", "hubo", "solo", "solamente", "sólo", "tambien",
+    "dime", "muestra", "muestrame", "ensename", "ordena", "ordenalo", "ordenala", "ordenalos", "ordenalas",
+    "ordenado", "ordenados", "ascendente", "descendente", "mayor", "menor", "mas", "menos", "año", "ano",
+    "valor", "valores", "resultado", "resultados", "eso", "esos", "esas", "ese", "esa", "ello", "ellos",
+}
+
+
+class AlmacenSesiones:
+    """Guarda por conversación el último SQL y su resultado en forma columnar."""
+
+    def __init__(self, max_sesiones: int = 500, ttl: int = 3600):
+        self.max_sesiones = max_sesiones
+        self.ttl = ttl
+        self.sesiones = OrderedDict()
+        self.lock = threading.Lock()
+
+    def guardar(self, clave: str, sql_query: str, columnas: list, filas: list):
+        sesion = {
+            "sql": sql_query,
+            "columnas": list(columnas),
+            "datos": list(zip(*filas)),  # Una tupla por columna
+            "instante": time.time(),
+        }
+        with self.lock:
+            self.sesiones[clave] = sesion
+            self.sesiones.move_to_end(clave)
+            while len(self.sesiones) > self.max_sesiones:
+                self.sesiones.popitem(last=False)
+
+    def obtener(self, clave: str):
+        with self.lock:
+            sesion = self.sesiones.get(clave)
+            if sesion and time.time() - sesion["instante"] > self.ttl:
+                del self.sesiones[clave]
+                return None
+            return sesion
+
+
+def clave_conversacion(body: dict, messages: List[dict]) -> str:
+    """Identifica la conversación por su chat_id o, si no llega, por su primer mensaje."""
+    body = body or {}
+    chat_id = body.get("chat_id") or (body.get("metadata") or {}).get("chat_id")
+    if chat_id:
+        return str(chat_id)
+    primero = next((m.get("content", "") for m in messages or [] if m.get("role") == "user"), "")
+    usuario = body.get("user") or {}
+    # Open WebUI manda un diccionario, pero algunos clientes mandan solo el identificador
+    usuario = usuario.get("id", "") if isinstance(usuario, dict) else str(usuario)
+    return hashlib.sha1(f"{usuario}|{primero}".encode("utf-8")).hexdigest()
+
+
+def _es_numero(valor) -> bool:
+    return isinstance(valor, (int, float, Decimal)) and not isinstance(valor, bool)
+
+
+def _columna_mencionada(texto: str, columnas: list):
+    for i, columna in enumerate(columnas):
+        nombre = normalizar_texto(columna.replace("_", " "))
+        if nombre and re.search(rf"\b{re.escape(nombre)}\b", texto):
+            return i
+    return None
+
+
+def explicado_por_resultado(palabras: list, columnas: list, datos: list) -> bool:
+    """Todas las palabras con contenido son del vocabulario de seguimiento, un año, o una
+    columna o un valor del resultado anterior.
+
+    Así "¿y en 2022?" o "ahora solo mujeres" se resuelven con el resultado anterior, pero
+    "¿y cuántos turistas llegaron a Lanzarote?" va a la generación de SQL normal.
+    """
+    conocidas = set()
+    for columna in columnas:
+        conocidas.update(normalizar_texto(columna.replace("_", " ")).split())
+    for columna in datos:
+        for valor in columna:
+            if isinstance(valor, str):
+                conocidas.update(normalizar_texto(valor).split())
+    return all(
+        p in VOCABULARIO_SEGUIMIENTO or p in conocidas or re.fullmatch(r"(19|20)\d{2}", p)
+        for p in palabras
+    )
+
+
+def resolver_seguimiento(mensaje: str, sesion: dict):
+    """Intenta responder una pregunta de seguimiento con el resultado anterior.
+
+    Devuelve {"columnas", "filas"} si basta con filtrar, ordenar o agregar en memoria,
+    {"sql"} si solo hay que cambiar el año de la consulta anterior, o None si no es
+    un seguimiento reconocible.
+    """
+    texto = normalizar_texto(mensaje)
+    palabras = texto.split()
+    if not palabras or len(palabras) > 10:
+        return None
+
+    columnas = sesion["columnas"]
+    datos = sesion["datos"]
+    if not explicado_por_resultado(palabras, columnas, datos):
+        return None
+    filas = list(zip(*datos))
+    mencionada = _columna_mencionada(texto, columnas)
+    numericas = [i for i, col in enumerate(datos) if any(_es_numero(v) for v in col)]
+
+    # Ordenar: "ordénalo por valor", "ordena de mayor a menor"
+    if palabras[0].startswith(("ordena", "ordenal", "ordenad")):
+        indice = mencionada if mencionada is not None else (numericas[-1] if numericas else len(columnas) - 1)
+        descendente = any(k in texto for k in ("descendente", "mayor a menor", "mas a menos"))
+        filas.sort(key=lambda fila: (fila[indice] is None, fila[indice]), reverse=descendente)
+        return {"columnas": columnas, "filas": filas}
+
+    if palabras[0] not in MARCADORES_SEGUIMIENTO:
+        return None
+
+    # Agregar: "¿y el total?", "y la media de valor"
+    operacion = next((AGREGACIONES[p] for p in palabras if p in AGREGACIONES), None)
+    if operacion:
+        if operacion == "recuento":
+            return {"columnas": ["recuento"], "filas": [(len(filas),)]}
+        indice = mencionada if mencionada in numericas else (numericas[-1] if numericas else None)
+        if indice is None:
+            return None
+        valores = [v for v in datos[indice] if _es_numero(v)]
+        if not valores:
+            return None
+        resultado = {
+            "suma": lambda: sum(valores),
+            "media": lambda: sum(valores) / len(valores),
+            "maximo": lambda: max(valores),
+            "minimo": lambda: min(valores),
+        }[operacion]()
+        return {"columnas": [f"{operacion}_{columnas[indice]}"], "filas": [(resultado,)]}
+
+    # Filtrar: "¿y en 2022?", "ahora solo mujeres"
+    condiciones = {}
+    anios_pedidos = []
+    for palabra in palabras[1:]:
+        if len(palabra) < 3:
+            continue
+        if re.fullmatch(r"(19|20)\d{2}", palabra):
+            anios_pedidos.append(palabra)
+        for i, col in enumerate(datos):
+            if any(normalizar_texto(str(v)) == palabra for v in col):
+                condiciones[i] = palabra
+                break
+
+    # Un año pedido que no está en el resultado no se puede sacar filtrando: "y mujeres en 2022"
+    # tras una pregunta de 2023 no debe devolver las filas de 2023
+    anios_ausentes = [a for a in anios_pedidos if a not in condiciones.values()]
+    if condiciones and not anios_ausentes:
+        filtradas = [f for f in filas
+                     if all(normalizar_texto(str(f[i])) == v for i, v in condiciones.items())]
+        return {"columnas": columnas, "filas": filtradas}
+
+    # El año pedido no está en el resultado: se cambia el único año de la consulta anterior.
+    # Si además se filtra por otra cosa, el SQL anterior no sirve y se genera uno nuevo
+    if condiciones:
+        return None
+    if len(anios_ausentes) == 1:
+        anios_sql = set(re.findall(r"\b(?:19|20)\d{2}\b", sesion["sql"]))
+        if len(anios_sql) == 1:
+            return {"sql": re.sub(rf"\b{anios_sql.pop()}\b", anios_ausentes[0], sesion["sql"])}
+
+    return None
@@ -0,0 +1,70 @@
+"""Normalización de texto y codificación compacta de resultados para los prompts."""
+import csv
+import datetime
+import io
+import math
+import re
+import unicodedata
+from decimal import Decimal
+
+
+def normalizar_texto(texto: str) -> str:
+    """Pasa a minúsculas, quita tildes y signos de puntuación (conserva "_" de los nombres de tabla)."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r"[^a-z0-9ñ_ ]+", " ", texto).strip()
+
+
+def formatear_valor(valor) -> str:
+    """Representación corta de un valor: sin Decimal(...) ni datetime.date(...)."""
+    if valor is None:
+        return ""
+    if isinstance(valor, Decimal):
+        return format(valor.normalize(), "f")
+    if isinstance(valor, float):
+        return format(round(valor, 4), "f").rstrip("0").rstrip(".")
+    if isinstance(valor, datetime.datetime):
+        return valor.isoformat(sep=" ")
+    if isinstance(valor, (datetime.date, datetime.time)):
+        return valor.isoformat()
+    if isinstance(valor, (bytes, memoryview)):
+        return bytes(valor).decode("utf-8", errors="replace")
+    return str(valor)
+
+
+def estimar_tokens(texto: str) -> int:
+    """Estimación local de tokens: ~4 caracteres por token en palabras, 1 por signo."""
+    return sum(math.ceil(len(p) / 4) if p[0].isalnum() else 1
+               for p in re.findall(r"\w+|[^\w\s]", texto))
+
+
+def codificar_resultados(columnas: list, filas: list, formato: str = "csv", max_tokens: int = 1500) -> str:
+    """Convierte el resultado en una tabla CSV o markdown con cabecera que cabe en max_tokens.
+
+    Si no caben todas las filas se corta y se añade una línea indicando cuántas se omiten.
+    """
+    if not columnas:
+        columnas = [f"columna_{i + 1}" for i in range(len(filas[0]) if filas else 0)]
+
+    if formato == "markdown":
+        def linea(valores):
+            return "| " + " | ".join(v.replace("|", "\\|") for v in valores) + " |"
+        cabecera = [linea(columnas), linea(["---"] * len(columnas))]
+    else:
+        def linea(valores):
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator="").writerow(valores)
+            return buffer.getvalue()
+        cabecera = [linea(columnas)]
+
+    lineas = list(cabecera)
+    tokens = sum(estimar_tokens(l) for l in lineas)
+    for incluidas, fila in enumerate(filas):
+        texto = linea([formatear_valor(v) for v in fila])
+        tokens += estimar_tokens(texto)
+        if tokens > max_tokens:
+            lineas.append(f"... {len(filas) - incluidas} filas más omitidas (total {len(filas)} filas)")
+            break
+        lineas.append(texto)
+
+    return "\n".join(lineas)
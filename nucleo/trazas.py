@@ -0,0 +1,153 @@
+"""Trazas por petición: spans de cada fase escritos en segundo plano a un JSONL rotativo.
+
+Uso desde la línea de comandos para ver las peticiones más lentas:
+
+    python -m nucleo.trazas trazas.jsonl --top 10
+"""
+import argparse
+import glob
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+SQL_MAX_TRAZA = 4000  # Caracteres del SQL ejecutado que se guardan en la traza
+
+
+class Traza:
+    """Spans de una petición. Se usan desde un solo hilo, el que ejecuta sus etapas."""
+
+    def __init__(self, atributos: dict = None):
+        self.id = uuid.uuid4().hex
+        self.inicio = time.time()
+        self.inicio_monotonico = time.perf_counter()
+        self.atributos = dict(atributos or {})
+        self.spans = []
+        self.abiertos = []
+
+    @contextmanager
+    def span(self, nombre: str, **atributos):
+        """Mide el bloque; el diccionario que devuelve admite más atributos durante el bloque."""
+        span = {
+            "nombre": nombre,
+            "padre": self.abiertos[-1]["nombre"] if self.abiertos else None,
+            "inicio_ms": round((time.perf_counter() - self.inicio_monotonico) * 1000, 3),
+            "atributos": atributos,
+        }
+        self.spans.append(span)
+        self.abiertos.append(span)
+        inicio = time.perf_counter()
+        try:
+            yield span["atributos"]
+        except BaseException as e:
+            span["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span["duracion_ms"] = round((time.perf_counter() - inicio) * 1000, 3)
+            self.abiertos.pop()
+
+    def ejecucion_sql(self, sql: str, origen: str, servidor: str):
+        """Span de una sentencia ejecutada, con el SQL para el asesor de índices (python -m nucleo.indices)."""
+        return self.span("sql_ejecucion", caracteres=len(sql), origen=origen, sql=sql[:SQL_MAX_TRAZA],
+                         servidor=servidor)
+
+    def registro(self, **atributos) -> dict:
+        return {
+            "traza": self.id,
+            "inicio": datetime.fromtimestamp(self.inicio, timezone.utc).isoformat(),
+            "duracion_ms": round((time.perf_counter() - self.inicio_monotonico) * 1000, 3),
+            **self.atributos,
+            **atributos,
+            "spans": self.spans,
+        }
+
+
+class EscritorTrazas:
+    """Escribe las trazas en JSONL desde un hilo propio para no retrasar la respuesta.
+
+    Usa QueueHandler y QueueListener de logging con un RotatingFileHandler, así el fichero
+    rota al llegar a max_bytes y se conservan los últimos `copias` ficheros.
+    """
+
+    escritores = {}
+    lock_escritores = threading.Lock()
+
+    @classmethod
+    def para(cls, ruta: str, max_bytes: int, copias: int) -> "EscritorTrazas":
+        with cls.lock_escritores:
+            if ruta not in cls.escritores:
+                cls.escritores[ruta] = cls(ruta, max_bytes, copias)
+            return cls.escritores[ruta]
+
+    def __init__(self, ruta: str, max_bytes: int, copias: int):
+        fichero = logging.handlers.RotatingFileHandler(ruta, maxBytes=max_bytes, backupCount=copias,
+                                                       encoding="utf-8", delay=True)
+        fichero.setFormatter(logging.Formatter("%(message)s"))
+        self.cola = queue.Queue()
+        self.listener = logging.handlers.QueueListener(self.cola, fichero)
+        self.listener.start()
+        self.logger = logging.getLogger(f"nucleo.trazas.{ruta}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(logging.handlers.QueueHandler(self.cola))
+
+    def escribir(self, registro: dict):
+        self.logger.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+    def cerrar(self):
+        self.listener.stop()
+
+
+def leer_trazas(ruta: str) -> list:
+    """Lee el fichero de trazas y sus copias rotadas."""
+    trazas = []
+    for fichero in sorted(glob.glob(f"{ruta}*")):
+        with open(fichero, encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    trazas.append(json.loads(linea))
+                except ValueError:
+                    continue
+    return trazas
+
+
+def percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def informe(trazas: list, top: int = 10) -> str:
+    """Las trazas más lentas con su span más costoso y el desglose por etapa."""
+    lineas = [f"{len(trazas)} trazas", "", f"Las {top} más lentas:"]
+    for traza in sorted(trazas, key=lambda t: t["duracion_ms"], reverse=True)[:top]:
+        etapas = [s for s in traza["spans"] if s["padre"] is None]
+        peor = max(etapas, key=lambda s: s.get("duracion_ms", 0), default=None)
+        detalle = f"{peor['nombre']} {peor['duracion_ms']:.0f} ms" if peor else "-"
+        lineas.append(f"  {traza['duracion_ms']:9.0f} ms  {traza['traza'][:12]}  [{detalle}]  {traza.get('pregunta', '')[:60]}")
+
+    duraciones = {}
+    for traza in trazas:
+        for span in traza["spans"]:
+            if "duracion_ms" in span:
+                duraciones.setdefault(span["nombre"], []).append(span["duracion_ms"])
+    lineas += ["", f"{'span':<24}{'n':>7}{'media':>10}{'p50':>10}{'p95':>10}{'% tiempo':>10}"]
+    total = sum(t["duracion_ms"] for t in trazas) or 1
+    for nombre, valores in sorted(duraciones.items(), key=lambda x: -sum(x[1])):
+        lineas.append(f"{nombre:<24}{len(valores):>7}{sum(valores) / len(valores):>10.1f}"
+                      f"{percentil(valores, 0.5):>10.1f}{percentil(valores, 0.95):>10.1f}"
+                      f"{100 * sum(valores) / total:>9.1f}%")
+    return "\n".join(lineas)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trazas más lentas y desglose por etapa")
+    parser.add_argument("fichero", nargs="?", default="trazas.jsonl")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    print(informe(leer_trazas(args.fichero), args.top))
@@ -1,29 +1,29 @@
 import os
+import sys
 import logging
-import psycopg2 # Biblioteca popular para interacturar con bases de datos PostgreSQL
 
+from typing import List
 
-from pydantic import BaseModel
-from typing import List, Union, Generator, Iterator
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nucleo.etapas import PipelineEtapas, comprobar_conexion, repetir_mensaje
+from nucleo.recursos import ValvesBase
 
 
 
 logging.basicConfig(level=logging.DEBUG)
 
-class Pipeline:
+class Pipeline(PipelineEtapas):
 
-    class Valves(BaseModel):
-        DB_HOST: str
-        DB_PORT: str
-        DB_USER: str
-        DB_PASSWORD: str
-        DB_DATABASE: str
+    class Valves(ValvesBase):
         DB_TABLES: List[str]
 
+    # Comprueba la conexión y repite el mensaje del usuario
+    etapas = [comprobar_conexion, repetir_mensaje]
+
     def __init__(self):
         self.name = "Repetir Mensaje Pipeline"
-        self.conn = None
-        self.nlsql_response = ""
+        self.model = "llama3"
 
         self.valves = self.Valves(
             **{
@@ -36,23 +36,3 @@ class Pipeline:
                 "DB_TABLES": ["XXXXX"],
             }
         )
-
-    def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
-        """ 
-        Establece una conexión con una base de datos PostgreSQL. 
-       
-        """ 
-  
-        try: 
-            conn = psycopg2.connect(
-                database=self.valves.DB_DATABASE,
-                user=self.valves.DB_USER,
-                password=self.valves.DB_PASSWORD,
-                host=self.valves.DB_HOST.split('//')[-1],
-                port=self.valves.DB_PORT
-                )
-
-            return (f"{user_message}")
-
-        except Exception as e:
-            print(f"Error connecting to PostgreSQL: {e}")
\ No newline at end of file
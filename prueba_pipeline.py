@@ -1,28 +1,30 @@
-import psycopg2
-from psycopg2 import sql
 import logging
-from typing import List, Union, Generator, Iterator
+from typing import List
 import os
-from pydantic import BaseModel
+import sys
+import tempfile
 
-import aiohttp
-import asyncio
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nucleo.etapas import PipelineEtapas, exportar, usar_mensaje_como_sql, ejecutar_sql, responder_filas
+from nucleo.recursos import ValvesBase
 
 logging.basicConfig(level=logging.DEBUG)
 
-class Pipeline:
-    class Valves(BaseModel):
-        DB_HOST: str
-        DB_PORT: str
-        DB_USER: str
-        DB_PASSWORD: str
-        DB_DATABASE: str
+
+class Pipeline(PipelineEtapas):
+    class Valves(ValvesBase):
         DB_TABLES: List[str]
+        EXPORT_FORMAT: str  # csv o binary
+        EXPORT_CHUNK_SIZE: int  # Bytes por bloque al exportar con COPY
+        EXPORT_DIR: str
+
+    # "exportar <consulta>": extracto completo con COPY; el resto de mensajes se ejecutan como SQL
+    etapas = [exportar, usar_mensaje_como_sql, ejecutar_sql, responder_filas]
 
     def __init__(self):
         self.name = "02 Database Query"
-        self.conn = None
-        self.nlsql_response = ""
+        self.model = "llama3"
 
         self.valves = self.Valves(
             **{
@@ -33,96 +35,8 @@ class Pipeline:
                 "DB_PASSWORD": os.getenv("PG_PASSWORD", "postgres"),
                 "DB_DATABASE": os.getenv("PG_DB", "prueba"),
                 "DB_TABLES": ["primeros_50_registros"],
+                "EXPORT_FORMAT": os.getenv("EXPORT_FORMAT", "csv"),
+                "EXPORT_CHUNK_SIZE": os.getenv("EXPORT_CHUNK_SIZE", 1024 * 1024),
+                "EXPORT_DIR": os.getenv("EXPORT_DIR", tempfile.gettempdir()),
             }
         )
-
-    def init_db_connection(self):
-        connection_params = {
-            'dbname': self.valves.DB_DATABASE,
-            'user': self.valves.DB_USER,
-            'password': self.valves.DB_PASSWORD,
-            'host': self.valves.DB_HOST.split('//')[-1],  # Remove the http:// or https:// prefix if present
-            'port': self.valves.DB_PORT
-        }
-
-        try:
-            self.conn = psycopg2.connect(**connection_params)
-            self.conn.set_client_encoding('UTF8')  # Establecer explícitamente la codificación a UTF8
-            print("Connection to PostgreSQL established successfully")
-        except Exception as e:
-            print(f"Error connecting to PostgreSQL: {e}")
-
-        # Create a cursor object
-        self.cur = self.conn.cursor()
-
-        # Query to get the list of tables
-        self.cur.execute("""
-            SELECT table_schema, table_name
-            FROM information_schema.tables
-            WHERE table_type = 'BASE TABLE'
-            AND table_schema NOT IN ('information_schema', 'pg_catalog');
-        """)
-
-        # Fetch and print the table names
-        tables = self.cur.fetchall()
-        print("Tables in the database:")
-        for schema, table in tables:
-            print(f"{schema}.{table}")
-
-    async def on_startup(self):
-        self.init_db_connection()
-
-    async def on_shutdown(self):
-        self.cur.close()
-        self.conn.close()
-
-    async def make_request_with_retry(self, url, params, retries=3, timeout=10):
-        for attempt in range(retries):
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, params=params, timeout=timeout) as response:
-                        response.raise_for_status()
-                        return await response.text()
-            except (aiohttp.ClientResponseError, aiohttp.ClientPayloadError, aiohttp.ClientConnectionError) as e:
-                logging.error(f"Attempt {attempt + 1} failed with error: {e}")
-                if attempt + 1 == retries:
-                    raise
-                await asyncio.sleep(2 ** attempt)  # Exponential backoff
-
-    def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
-        try:
-            conn = psycopg2.connect(
-                database=self.valves.DB_DATABASE,
-                user=self.valves.DB_USER,
-                password=self.valves.DB_PASSWORD,
-                host=self.valves.DB_HOST.split('//')[-1],
-                port=self.valves.DB_PORT
-            )
-            conn.set_client_encoding('UTF8')  # Establecer la codificación a UTF8
-            conn.autocommit=True
-            cursor = conn.cursor()
-            
-            sql_query = user_message
-            cursor.execute(sql_query)
-            result = cursor.fetchall()
-
-            # Decodificar los resultados para manejar posibles caracteres no válidos
-            decoded_result = [tuple(val.decode('utf-8', errors='replace') for val in row) for row in result]
-            
-            return str(decoded_result)
-
-        except psycopg2.Error as e:
-            logging.error(f"Database error: {e}")
-            return f"Database error: {e}"
-        except aiohttp.ClientResponseError as e:
-            logging.error(f"ClientResponseError: {e}")
-            return f"ClientResponseError: {e}"
-        except aiohttp.ClientPayloadError as e:
-            logging.error(f"ClientPayloadError: {e}")
-            return f"ClientPayloadError: {e}"
-        except aiohttp.ClientConnectionError as e:
-            logging.error(f"ClientConnectionError: {e}")
-            return f"ClientConnectionError: {e}"
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            return f"Unexpected error: {e}"
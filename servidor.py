@@ -1,7 +1,24 @@
+import hashlib
+import math
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Optional
+
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+import torch
 from transformers import pipeline, AutoTokenizer, AutoModelForQuestionAnswering
 
+# Hilos de cálculo de torch por proceso (0: los que decida torch). Con varios workers
+# conviene repartir los núcleos entre ellos; ver python -m nucleo.carga_servidor
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", 0))
+if TORCH_THREADS > 0:
+    torch.set_num_threads(TORCH_THREADS)
+
 app = FastAPI()
 
 
@@ -25,16 +42,222 @@ model = AutoModelForQuestionAnswering.from_pretrained(model_name)
 # Usar la tarea correcta en el pipeline
 qa_pipeline = pipeline("question-answering", model=model, tokenizer=tokenizer)
 
+# Documentos subidos una vez y consultados por id. El texto se guarda en disco para que lo
+# vean todos los workers; cada worker lo tokeniza la primera vez que le preguntan por él
+DOCUMENTOS_DIR = os.getenv("DOCUMENTOS_DIR", os.path.join(tempfile.gettempdir(), "servidor_documentos"))
+DOCUMENTOS_MAX = int(os.getenv("DOCUMENTOS_MAX", 100))  # Documentos tokenizados en memoria; se olvidan los menos usados
+FRAGMENTO_TOKENS = int(os.getenv("FRAGMENTO_TOKENS", 320))  # Tokens de documento por fragmento
+FRAGMENTO_SOLAPE = int(os.getenv("FRAGMENTO_SOLAPE", 64))  # Tokens compartidos entre fragmentos seguidos
+FRAGMENTOS_CONSULTA = int(os.getenv("FRAGMENTOS_CONSULTA", 3))  # Fragmentos que pasan al modelo por pregunta
+PREGUNTA_MAX_TOKENS = 64
+RESPUESTA_MAX_TOKENS = 30
+
+
+def palabras(texto: str) -> list:
+    """Palabras en minúsculas y sin tildes para el índice léxico."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return re.findall(r"\w+", texto)
+
+
+class Documento:
+    """Texto tokenizado una sola vez, partido en fragmentos con su índice BM25."""
+
+    def __init__(self, texto: str):
+        codificado = tokenizer(texto, add_special_tokens=False, return_offsets_mapping=True)
+        ids, offsets = codificado["input_ids"], codificado["offset_mapping"]
+        self.texto = texto
+        self.fragmentos = []  # [{"ids", "offsets", "texto"}]
+        paso = max(1, FRAGMENTO_TOKENS - FRAGMENTO_SOLAPE)
+        for inicio in range(0, max(1, len(ids)), paso):
+            fin = min(inicio + FRAGMENTO_TOKENS, len(ids))
+            if inicio >= fin:
+                break
+            self.fragmentos.append({
+                "ids": ids[inicio:fin],
+                "offsets": offsets[inicio:fin],
+                "texto": texto[offsets[inicio][0]:offsets[fin - 1][1]],
+            })
+            if fin == len(ids):
+                break
+
+        self.frecuencias = [Counter(palabras(f["texto"])) for f in self.fragmentos]
+        self.longitudes = [sum(f.values()) for f in self.frecuencias]
+        self.longitud_media = sum(self.longitudes) / max(1, len(self.longitudes))
+        documentos = Counter(p for f in self.frecuencias for p in f)
+        n = len(self.fragmentos)
+        self.idf = {p: math.log(1 + (n - df + 0.5) / (df + 0.5)) for p, df in documentos.items()}
+
+    def mejores(self, pregunta: str, k: int, k1: float = 1.2, b: float = 0.75) -> list:
+        """Índices de los k fragmentos con mayor puntuación BM25 para la pregunta."""
+        terminos = set(palabras(pregunta)) & set(self.idf)
+        puntuaciones = []
+        for i, frecuencias in enumerate(self.frecuencias):
+            norma = k1 * (1 - b + b * self.longitudes[i] / (self.longitud_media or 1))
+            puntuaciones.append(sum(
+                self.idf[t] * frecuencias[t] * (k1 + 1) / (frecuencias[t] + norma)
+                for t in terminos if t in frecuencias
+            ))
+        orden = sorted(range(len(self.fragmentos)), key=lambda i: -puntuaciones[i])
+        return orden[:k]
+
+
+documentos = OrderedDict()  # {id: Documento}
+lock_documentos = threading.Lock()
+
+
+def ruta_documento(doc_id: str) -> str:
+    return os.path.join(DOCUMENTOS_DIR, f"{doc_id}.txt")
+
+
+def recordar(doc_id: str, documento: Documento):
+    with lock_documentos:
+        documentos[doc_id] = documento
+        while len(documentos) > DOCUMENTOS_MAX:
+            documentos.popitem(last=False)
+
+
+def obtener_documento(doc_id: str) -> Optional[Documento]:
+    """El documento tokenizado de este worker o, si no lo tiene, el texto guardado en disco."""
+    if not re.fullmatch(r"[0-9a-f]{16}", doc_id):
+        return None
+    with lock_documentos:
+        documento = documentos.get(doc_id)
+        if documento is not None:
+            documentos.move_to_end(doc_id)
+            return documento
+    try:
+        with open(ruta_documento(doc_id), encoding="utf-8") as f:
+            texto = f.read()
+    except FileNotFoundError:
+        return None
+    documento = Documento(texto)
+    recordar(doc_id, documento)
+    return documento
+
+
+def responder_en_fragmentos(pregunta: str, documento: Documento, indices: list) -> dict:
+    """QA sobre los fragmentos elegidos reutilizando sus tokens: solo se tokeniza la pregunta.
+
+    Todos los fragmentos van en un solo lote y se queda la respuesta con más confianza,
+    calculada como hace el pipeline de question-answering (softmax de inicio y fin sobre
+    los tokens del documento).
+    """
+    pregunta_ids = tokenizer(pregunta, add_special_tokens=False)["input_ids"][:PREGUNTA_MAX_TOKENS]
+    prefijo = [tokenizer.cls_token_id] + pregunta_ids + [tokenizer.sep_token_id]
+    entradas = [prefijo + documento.fragmentos[i]["ids"] + [tokenizer.sep_token_id] for i in indices]
+    largo = max(len(e) for e in entradas)
+    input_ids = [e + [tokenizer.pad_token_id] * (largo - len(e)) for e in entradas]
+    attention_mask = [[1] * len(e) + [0] * (largo - len(e)) for e in entradas]
+    token_type_ids = [[0] * len(prefijo) + [1] * (largo - len(prefijo)) for _ in entradas]
+
+    with torch.no_grad():
+        salida = model(input_ids=torch.tensor(input_ids), attention_mask=torch.tensor(attention_mask),
+                       token_type_ids=torch.tensor(token_type_ids))
+    inicios, fines = salida.start_logits.tolist(), salida.end_logits.tolist()
+
+    mejor = None
+    for fila, i in enumerate(indices):
+        fragmento = documento.fragmentos[i]
+        desde, hasta = len(prefijo), len(prefijo) + len(fragmento["ids"])
+        p_inicio = _softmax(inicios[fila][desde:hasta])
+        p_fin = _softmax(fines[fila][desde:hasta])
+        candidatos_inicio = sorted(range(len(p_inicio)), key=lambda t: -p_inicio[t])[:20]
+        candidatos_fin = sorted(range(len(p_fin)), key=lambda t: -p_fin[t])[:20]
+        for s in candidatos_inicio:
+            for e in candidatos_fin:
+                if s <= e < s + RESPUESTA_MAX_TOKENS:
+                    confianza = p_inicio[s] * p_fin[e]
+                    if mejor is None or confianza > mejor["confianza"]:
+                        offsets = fragmento["offsets"]
+                        mejor = {"respuesta": documento.texto[offsets[s][0]:offsets[e][1]],
+                                 "confianza": confianza, "fragmento": i}
+    return mejor
+
+
+def _softmax(valores: list) -> list:
+    maximo = max(valores)
+    exponenciales = [math.exp(v - maximo) for v in valores]
+    total = sum(exponenciales)
+    return [v / total for v in exponenciales]
+
+
 class Query(BaseModel):
     pregunta: str
-    contexto: str
+    contexto: Optional[str] = None
+    documento_id: Optional[str] = None  # En lugar del contexto, un documento subido antes
+
+
+class DocumentoNuevo(BaseModel):
+    texto: str
 
 @app.get("/")
 def home():
-    return {"message": "¡Bienvenido a la API de Respuestas!"}
+    return {"message": "¡Bienvenido a la API de Respuestas!", "workers": int(os.getenv("SERVIDOR_WORKERS", 1)),
+            "torch_threads": torch.get_num_threads()}
+
+@app.post("/documentos/")
+def subir_documento(documento: DocumentoNuevo):
+    """Tokeniza y fragmenta el documento una vez; las preguntas lo citan por su id."""
+    doc_id = hashlib.sha256(documento.texto.encode("utf-8")).hexdigest()[:16]
+    with lock_documentos:
+        existente = documentos.get(doc_id)
+    if existente is None:
+        if not documento.texto.strip():
+            raise HTTPException(status_code=400, detail="Error: el documento está vacío")
+        existente = Documento(documento.texto)
+        try:
+            os.makedirs(DOCUMENTOS_DIR, exist_ok=True)
+            # Se escribe aparte y se renombra para que otro worker nunca lea un fichero a medias
+            temporal = f"{ruta_documento(doc_id)}.{os.getpid()}.tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                f.write(documento.texto)
+            os.replace(temporal, ruta_documento(doc_id))
+        except OSError as e:
+            raise HTTPException(status_code=500, detail=f"Error al guardar el documento: {e}")
+        recordar(doc_id, existente)
+    return {"documento_id": doc_id, "fragmentos": len(existente.fragmentos), "caracteres": len(documento.texto)}
+
+@app.get("/documentos/{documento_id}")
+def ver_documento(documento_id: str):
+    documento = obtener_documento(documento_id)
+    if documento is None:
+        raise HTTPException(status_code=404, detail=f"Error: no existe el documento {documento_id}")
+    return {"documento_id": documento_id, "fragmentos": len(documento.fragmentos), "caracteres": len(documento.texto)}
+
+@app.delete("/documentos/{documento_id}")
+def borrar_documento(documento_id: str):
+    # Los demás workers lo olvidan cuando lo expulsen de su memoria; hasta entonces pueden
+    # seguir respondiendo con él
+    if not re.fullmatch(r"[0-9a-f]{16}", documento_id):
+        raise HTTPException(status_code=404, detail=f"Error: no existe el documento {documento_id}")
+    with lock_documentos:
+        en_memoria = documentos.pop(documento_id, None) is not None
+    try:
+        os.remove(ruta_documento(documento_id))
+        en_disco = True
+    except FileNotFoundError:
+        en_disco = False
+    if not (en_memoria or en_disco):
+        raise HTTPException(status_code=404, detail=f"Error: no existe el documento {documento_id}")
+    return {"documento_id": documento_id, "borrado": True}
 
 @app.post("/consulta/")
 def responder_pregunta(query: Query):
+    if (query.contexto is None) == (query.documento_id is None):
+        raise HTTPException(status_code=400, detail="Error: indica el contexto o el documento_id, uno de los dos")
+    if query.documento_id is not None:
+        documento = obtener_documento(query.documento_id)
+        if documento is None:
+            raise HTTPException(status_code=404, detail=f"Error: no existe el documento {query.documento_id}")
+        try:
+            indices = documento.mejores(query.pregunta, FRAGMENTOS_CONSULTA)
+            respuesta = (responder_en_fragmentos(query.pregunta, documento, indices)
+                         or {"respuesta": "", "confianza": 0.0, "fragmento": None})
+            return {"respuesta": respuesta["respuesta"], "confianza": respuesta["confianza"],
+                    "documento_id": query.documento_id, "fragmento": respuesta["fragmento"]}
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
     try:
         # Usar el pipeline para obtener la respuesta
         
@@ -46,5 +269,11 @@ def responder_pregunta(query: Query):
 # Esta función correrá el servidor
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
-
+    workers = int(os.getenv("SERVIDOR_WORKERS", 1))
+    puerto = int(os.getenv("SERVIDOR_PORT", 5000))
+    if workers > 1:
+        # Con varios workers uvicorn necesita la aplicación como "módulo:atributo"
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        uvicorn.run("servidor:app", host="0.0.0.0", port=puerto, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=puerto)